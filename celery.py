@@ -7,16 +7,12 @@ app = Celery('neopharm')
 app.config_from_object('django.conf:settings', namespace='CELERY')
 app.autodiscover_tasks()
 
-@app.task(bind=True)
-def sync_offline_transactions(self):
-    from pharmacy.models import OfflineTransaction
-    
-    transactions = OfflineTransaction.objects.filter(synced=False)
-    for transaction in transactions:
-        try:
-            # Process the transaction
-            transaction.process()
-            transaction.synced = True
-            transaction.save()
-        except Exception as e:
-            self.retry(exc=e, countdown=60)  # Retry after 1 minute
+# Without a broker, `manage.py run_worker` runs this replay (and the other
+# periodic jobs) from the database-backed queue instead
+@app.task
+def sync_offline_transactions():
+    from pharmacy.services import OfflineReplayService
+
+    # Failures are retried per transaction with backoff by the replay engine,
+    # so the task itself never retries the whole queue
+    return OfflineReplayService.run()
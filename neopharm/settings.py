@@ -84,7 +84,65 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
-    }
+        # Keep connections open between requests so the PRAGMAs and page
+        # cache below are set up once per worker thread, not per request
+        'CONN_MAX_AGE': int(os.getenv('CONN_MAX_AGE', '600')),
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            # Concurrent replay workers write at the same time; take the write
+            # lock when a transaction begins (waiting up to busy_timeout)
+            # instead of failing when two readers both try to write
+            'transaction_mode': 'IMMEDIATE',
+        },
+    },
+    # Snapshot of `default` for reporting pages and exports, copied with the
+    # SQLite backup API by the refresh-reporting job (pharmacy/db.py)
+    'reporting': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': Path(os.getenv('REPORTING_DB_PATH', BASE_DIR / 'reporting.sqlite3')),
+        'CONN_MAX_AGE': int(os.getenv('CONN_MAX_AGE', '600')),
+        'CONN_HEALTH_CHECKS': True,
+        'TEST': {'MIRROR': 'default'},
+    },
+}
+
+DATABASE_ROUTERS = ['pharmacy.db.ReportingRouter']
+
+# Optional: keep each drug category's catalog, stock lots and stock movements
+# in a database file of its own, so a bulk stock change in one category does
+# not block dispensing from another (pharmacy/db.py CategoryRouter). Move an
+# existing database over with `manage.py split_category_databases`; new
+# files are created with `manage.py migrate --database=<category>`.
+CATEGORY_DATABASES = os.getenv('CATEGORY_DATABASES', 'False') == 'True'
+if CATEGORY_DATABASES:
+    for category in ('lpacemaker', 'ncap', 'oncology'):
+        DATABASES[category] = dict(
+            DATABASES['default'],
+            NAME=BASE_DIR / f'{category}.sqlite3',
+            OPTIONS=dict(DATABASES['default']['OPTIONS']),
+        )
+    DATABASE_ROUTERS.insert(0, 'pharmacy.db.CategoryRouter')
+
+# Reporting reads fall back to `default` once the snapshot is older than this
+# (seconds); the job worker refreshes it every 5 minutes
+REPORTING_MAX_STALENESS = int(os.getenv('REPORTING_MAX_STALENESS', '900'))
+
+# Snapshots written by `manage.py backup_db` (restored with restore_db); the
+# oldest are deleted once more than BACKUP_KEEP exist
+BACKUP_DIR = Path(os.getenv('BACKUP_DIR', BASE_DIR / 'backups'))
+BACKUP_KEEP = int(os.getenv('BACKUP_KEEP', '14'))
+
+# Files written by export jobs (pharmacy/services.py ExportService); removed
+# with their job after JOB_RETENTION_DAYS (7 by default)
+EXPORT_DIR = Path(os.getenv('EXPORT_DIR', BASE_DIR / 'exports'))
+
+# Applied to every SQLite connection as it opens (pharmacy/db.py)
+SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'busy_timeout': int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '20000')),
+    'mmap_size': int(os.getenv('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024))),
+    'cache_size': int(os.getenv('SQLITE_CACHE_SIZE', '-64000')),  # negative: KiB
 }
 
 
@@ -1,5 +1,10 @@
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.contrib.admin import helpers
+from django.db import transaction
+from django.utils import timezone
 from django.contrib.auth.admin import UserAdmin
+from django.http import QueryDict
+from django.template.response import TemplateResponse
 from django.utils.html import format_html
 from .models import (
     User,
@@ -10,8 +15,16 @@ from .models import (
     Form,
     FormItem,
     Profile,
-    OfflineTransaction
+    OfflineTransaction,
+    DailySalesRollup,
+    StockMovement,
+    PriceChange,
+    StockLot,
+    Job,
+    MARKUP_CHOICES
 )
+from .db import CATEGORY_DRUG_MODELS, categories_split, stock_atomic, stock_database
+from .services import ExpiryService, RepricingService, RepricingError, StockLotService
 
 @admin.register(User)
 class CustomUserAdmin(UserAdmin):
@@ -36,9 +49,10 @@ class CustomUserAdmin(UserAdmin):
 
 class DrugAdminMixin:
     list_display = ('name', 'brand', 'unit', 'price', 'stock', 'exp_date', 'stock_status')
-    list_filter = ('dosage_form', 'unit', 'brand')
+    list_filter = ('dosage_form', 'unit', 'brand', 'markup')
     search_fields = ('name', 'brand')
     ordering = ('name',)
+    actions = ['reprice_selected']
 
     def stock_status(self, obj):
         if obj.stock <= 0:
@@ -49,8 +63,56 @@ class DrugAdminMixin:
 
     stock_status.short_description = 'Stock Status'
 
+    def save_model(self, request, obj, form, change):
+        """Carry stock and expiry edits through to the lots, as edit_item does"""
+        previous_exp_date = form.initial.get('exp_date') if change else None
+        with stock_atomic(self.drug_type):
+            super().save_model(request, obj, form, change)
+            StockLotService.sync(self.drug_type, obj, previous_exp_date)
+
+    # Rows listed on the repricing preview page
+    REPRICE_PREVIEW_ROWS = 200
+
+    @admin.action(description='Reprice selected items')
+    def reprice_selected(self, request, queryset):
+        """
+        Preview (dry run) and apply a markup change to the selected drugs
+        through RepricingService; an empty markup recomputes prices at each
+        item's current markup.
+        """
+        markup = request.POST.get('markup', '')
+        tiers = {value: markup for value, _ in MARKUP_CHOICES} if markup else None
+        ids = list(queryset.values_list('pk', flat=True))
+
+        try:
+            summary = RepricingService.reprice(
+                self.drug_type, tiers=tiers, ids=ids,
+                dry_run='apply' not in request.POST, user=request.user,
+            )
+        except RepricingError as e:
+            self.message_user(request, str(e), messages.ERROR)
+            return None
+
+        if not summary['dry_run']:
+            self.message_user(request, f"Repriced {summary['changed']} item(s).", messages.SUCCESS)
+            return None
+
+        context = {
+            **self.admin_site.each_context(request),
+            'title': 'Reprice items',
+            'opts': self.model._meta,
+            'ids': ids,
+            'markup': markup,
+            'markup_choices': MARKUP_CHOICES,
+            'summary': summary,
+            'changes': summary['changes'][:self.REPRICE_PREVIEW_ROWS],
+            'action_checkbox_name': helpers.ACTION_CHECKBOX_NAME,
+        }
+        return TemplateResponse(request, 'admin/pharmacy/reprice.html', context)
+
 @admin.register(LpacemakerDrugs)
 class LpacemakerDrugsAdmin(DrugAdminMixin, admin.ModelAdmin):
+    drug_type = 'lpacemaker'
     list_display = DrugAdminMixin.list_display + ('get_total_value',)
 
     def get_total_value(self, obj):
@@ -61,6 +123,7 @@ class LpacemakerDrugsAdmin(DrugAdminMixin, admin.ModelAdmin):
 
 @admin.register(NcapDrugs)
 class NcapDrugsAdmin(DrugAdminMixin, admin.ModelAdmin):
+    drug_type = 'ncap'
     list_display = DrugAdminMixin.list_display + ('get_total_value',)
 
     def get_total_value(self, obj):
@@ -71,6 +134,7 @@ class NcapDrugsAdmin(DrugAdminMixin, admin.ModelAdmin):
 
 @admin.register(OncologyPharmacy)
 class OncologyPharmacyAdmin(DrugAdminMixin, admin.ModelAdmin):
+    drug_type = 'oncology'
     list_display = DrugAdminMixin.list_display + ('get_total_value',)
 
     def get_total_value(self, obj):
@@ -144,6 +208,170 @@ class FormItemAdmin(admin.ModelAdmin):
             obj.dispensed_by = request.user
         super().save_model(request, obj, form, change)
 
+@admin.register(DailySalesRollup)
+class DailySalesRollupAdmin(admin.ModelAdmin):
+    list_display = ('day', 'drug_type', 'dispensed_by', 'form_count', 'line_count', 'quantity', 'revenue')
+    list_filter = ('drug_type', 'day', 'dispensed_by')
+    date_hierarchy = 'day'
+    readonly_fields = ('day', 'drug_type', 'dispensed_by', 'form_count', 'line_count', 'quantity', 'revenue')
+
+    def has_add_permission(self, request):
+        return False
+
+class StockCategoryFilter(admin.SimpleListFilter):
+    """
+    Drug category of stock lots and movements. With CATEGORY_DATABASES the
+    categories are in separate files and cannot be listed together, so one
+    is always selected, the first by default.
+    """
+    title = 'category'
+    parameter_name = 'category'
+
+    def lookups(self, request, model_admin):
+        return [(category, category.upper()) for category in CATEGORY_DRUG_MODELS]
+
+    def value(self):
+        value = super().value()
+        if value is None and categories_split():
+            return next(iter(CATEGORY_DRUG_MODELS))
+        return value
+
+    def choices(self, changelist):
+        choices = super().choices(changelist)
+        if categories_split():
+            next(choices)  # "All"
+        yield from choices
+
+    def queryset(self, request, queryset):
+        category = self.value()
+        if category not in CATEGORY_DRUG_MODELS:
+            return None
+        if queryset.model is StockLot:
+            return queryset.filter(**{f'{category}_drug__isnull': False})
+        return queryset.filter(drug_type=category.upper())
+
+
+class CategoryStockAdmin(admin.ModelAdmin):
+    """
+    Admin for rows kept in their category's database with CATEGORY_DATABASES:
+    lists and change pages read from the file of the category picked in
+    StockCategoryFilter, which change pages get from the preserved filters
+    """
+
+    def stock_category(self, request):
+        category = request.GET.get('category') or QueryDict(request.GET.get('_changelist_filters', '')).get('category')
+        return category if category in CATEGORY_DRUG_MODELS else next(iter(CATEGORY_DRUG_MODELS))
+
+    def get_queryset(self, request):
+        queryset = super().get_queryset(request)
+        if categories_split():
+            queryset = queryset.using(stock_database(self.stock_category(request)))
+        return queryset
+
+@admin.register(StockMovement)
+class StockMovementAdmin(CategoryStockAdmin):
+    list_display = ('created_at', 'kind', 'drug_type', 'drug_count', 'quantity', 'window_start', 'window_end')
+    list_filter = (StockCategoryFilter, 'kind')
+    date_hierarchy = 'created_at'
+    readonly_fields = ('kind', 'drug_type', 'drug_count', 'quantity', 'window_start', 'window_end', 'details', 'created_at')
+
+    def has_add_permission(self, request):
+        return False
+
+@admin.register(OfflineTransaction)
+class OfflineTransactionAdmin(admin.ModelAdmin):
+    list_display = ('id', 'transaction_type', 'created_at', 'version', 'synced', 'quarantined', 'conflict', 'retry_count', 'next_attempt_at', 'claimed_by', 'last_error')
+    list_filter = ('transaction_type', 'synced', 'quarantined', 'conflict')
+    # Filter counts show how many transactions each conflict outcome holds
+    show_facets = admin.ShowFacets.ALWAYS
+    date_hierarchy = 'created_at'
+    readonly_fields = ('transaction_type', 'data', 'version', 'created_at', 'synced', 'retry_count', 'next_attempt_at', 'quarantined', 'conflict', 'claimed_by', 'lease_expires', 'last_error', 'processed_at')
+    actions = ['requeue', 'apply_reviewed']
+
+    def has_add_permission(self, request):
+        return False
+
+    @admin.action(description='Requeue selected transactions')
+    def requeue(self, request, queryset):
+        updated = queryset.filter(synced=False).update(
+            quarantined=False, retry_count=0, next_attempt_at=None, last_error='', conflict='',
+            claimed_by='', lease_expires=None,
+        )
+        self.message_user(request, f'Requeued {updated} transaction(s).', messages.SUCCESS)
+
+    @admin.action(description='Apply selected conflicts as queued')
+    def apply_reviewed(self, request, queryset):
+        applied = 0
+        for txn in queryset.filter(synced=False, conflict__in=['REVIEW', 'REJECTED']):
+            try:
+                with transaction.atomic():
+                    txn.process()
+            except Exception as e:
+                self.message_user(request, f'{txn}: {e}', messages.ERROR)
+                continue
+            OfflineTransaction.objects.filter(pk=txn.pk).update(
+                synced=True, quarantined=False, processed_at=timezone.now(), last_error='',
+            )
+            applied += 1
+        self.message_user(request, f'Applied {applied} transaction(s).', messages.SUCCESS)
+
+@admin.register(StockLot)
+class StockLotAdmin(CategoryStockAdmin):
+    list_display = ('get_drug_name', 'lot_number', 'exp_date', 'quantity', 'received_at')
+    list_filter = (StockCategoryFilter, 'exp_date')
+    search_fields = ('lot_number', 'lpacemaker_drug__name', 'ncap_drug__name', 'oncology_drug__name')
+    list_select_related = ('lpacemaker_drug', 'ncap_drug', 'oncology_drug')
+    # Quantities are changed through StockLotService so drug stock stays in step
+    readonly_fields = ('lpacemaker_drug', 'ncap_drug', 'oncology_drug', 'quantity', 'received_at')
+
+    def get_drug_name(self, obj):
+        drug = obj.get_item
+        return drug.name if drug else '-'
+    get_drug_name.short_description = 'Drug'
+
+    def save_model(self, request, obj, form, change):
+        """Refresh the drug's next expiry and write the lot off if it was moved behind the expiry watermark"""
+        drug_type = next(
+            (category for category in CATEGORY_DRUG_MODELS if getattr(obj, f'{category}_drug_id')), None
+        )
+        if drug_type is None:
+            return super().save_model(request, obj, form, change)
+        drug_id = getattr(obj, f'{drug_type}_drug_id')
+        with stock_atomic(drug_type):
+            super().save_model(request, obj, form, change)
+            StockLotService.adjust_drugs(drug_type, {drug_id: 0})
+            ExpiryService.write_off_edited(drug_type, [drug_id])
+
+    def has_add_permission(self, request):
+        return False
+
+@admin.register(PriceChange)
+class PriceChangeAdmin(admin.ModelAdmin):
+    list_display = ('created_at', 'drug_type', 'drug_name', 'old_markup', 'new_markup', 'old_price', 'new_price', 'changed_by')
+    list_filter = ('drug_type', 'new_markup')
+    search_fields = ('drug_name', 'batch')
+    date_hierarchy = 'created_at'
+    readonly_fields = ('batch', 'drug_type', 'drug_id', 'drug_name', 'cost', 'old_markup', 'new_markup', 'old_price', 'new_price', 'changed_by', 'created_at')
+
+    def has_add_permission(self, request):
+        return False
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'name', 'status', 'run_at', 'attempts', 'max_attempts', 'claimed_by', 'finished_at')
+    list_filter = ('status', 'name')
+    show_facets = admin.ShowFacets.ALWAYS
+    date_hierarchy = 'run_at'
+    readonly_fields = ('name', 'payload', 'unique_key', 'attempts', 'claimed_by', 'lease_expires', 'last_error', 'created_at', 'finished_at')
+    actions = ['retry']
+
+    @admin.action(description='Retry selected jobs now')
+    def retry(self, request, queryset):
+        updated = queryset.exclude(status='RUNNING').update(
+            status='QUEUED', run_at=timezone.now(), attempts=0, last_error='', finished_at=None,
+        )
+        self.message_user(request, f'Queued {updated} job(s) to run again.', messages.SUCCESS)
+
 # Customize admin site header and title
 admin.site.site_header = 'NEOPHARM Administration'
 admin.site.site_title = 'NEOPHARM Admin Portal'
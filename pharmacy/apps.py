@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class PharmacyConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'pharmacy'
+
+    def ready(self):
+        # Connects the SQLite PRAGMA hook to connection_created
+        from . import db  # noqa: F401
@@ -0,0 +1,641 @@
+"""
+Database connection set-up for NEOPHARM.
+Every SQLite connection is tuned as it opens with the PRAGMAs in
+settings.SQLITE_PRAGMAS: WAL journaling lets readers carry on while a
+writer commits, synchronous=NORMAL syncs at checkpoints instead of every
+commit, and the busy timeout makes a writer wait for the lock instead of
+failing with "database is locked".
+
+Reporting pages read from the `reporting` database, a snapshot of the
+primary copied with the SQLite online backup API (refresh_reporting_snapshot,
+run on a schedule by the job worker). ReportingRouter sends reads there only
+inside reporting_reads() blocks and only while the snapshot is younger than
+REPORTING_MAX_STALENESS seconds; everything else, including every read made
+inside a transaction, stays on the primary.
+
+With settings.CATEGORY_DATABASES each drug category's catalog, stock lots
+and stock movements live in a database file of their own (CategoryRouter),
+so a bulk stock change in one category does not hold the write lock that
+dispensing from another needs. Work that writes to a category file and the
+main file runs as one short transaction per file (coordinated_write), stock
+first, with the stock change undone if the main-file step fails; cart
+changes are also journaled so a crash between the commits is repaired
+(StockJournalService in services.py).
+
+take_backup copies every database file while the application runs, a few
+pages per step with a pause between steps, into a gzip-compressed,
+checksummed snapshot under settings.BACKUP_DIR; restore_backup copies one
+back after verifying it.
+"""
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import time
+from contextlib import ExitStack, closing, contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from pathlib import Path
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connection as default_connection, connections, transaction
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_migrate
+from django.dispatch import receiver
+from django.utils import timezone
+
+DEFAULT_SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'busy_timeout': 20000,  # milliseconds
+    'mmap_size': 256 * 1024 * 1024,  # bytes
+    'cache_size': -64000,  # negative sizes are in KiB
+}
+
+_PRAGMA_TOKEN = re.compile(r'^-?\w+$')
+
+REPORTING_DB_ALIAS = 'reporting'
+
+
+def sqlite_pragmas():
+    return getattr(settings, 'SQLITE_PRAGMAS', DEFAULT_SQLITE_PRAGMAS)
+
+
+@receiver(connection_created)
+def apply_sqlite_pragmas(sender, connection, **kwargs):
+    """Run settings.SQLITE_PRAGMAS on each new SQLite connection"""
+    if connection.vendor != 'sqlite':
+        return
+    cursor = connection.connection.cursor()
+    try:
+        for name, value in sqlite_pragmas().items():
+            if not (_PRAGMA_TOKEN.match(name) and _PRAGMA_TOKEN.match(str(value))):
+                raise ImproperlyConfigured(f'Invalid SQLITE_PRAGMAS entry {name!r}: {value!r}')
+            cursor.execute(f'PRAGMA {name} = {value}')
+    finally:
+        cursor.close()
+
+
+@contextmanager
+def scratch_sqlite_database(connection=default_connection):
+    """
+    Point `connection` at a freshly migrated SQLite file for benchmarks and
+    tests and yield its path; the file is removed and the original database
+    restored on exit.
+    """
+    scratch = tempfile.mkdtemp(prefix='neopharm-bench-')
+    path = os.path.join(scratch, 'bench.sqlite3')
+    original_name = connection.settings_dict['NAME']
+    original_test = connection.settings_dict.get('TEST')
+    # Django never closes an in-memory database (closing would drop it), so
+    # set the open one aside while the connection uses the scratch file
+    parked = connection.connection if connection.is_in_memory_db() else None
+    if parked is not None:
+        connection.connection = None
+    # Pointing the reporting alias at the scratch file too makes it a mirror,
+    # so the real snapshot is neither refreshed from nor read for the scratch
+    # database
+    reporting = connections[REPORTING_DB_ALIAS].settings_dict if REPORTING_DB_ALIAS in settings.DATABASES else {}
+    reporting_name = reporting.get('NAME')
+    if reporting:
+        reporting['NAME'] = path
+    connection.settings_dict['TEST'] = dict(connection.settings_dict.get('TEST') or {}, NAME=path)
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        yield path
+    finally:
+        connection.creation.destroy_test_db(original_name, verbosity=0)
+        connection.settings_dict['TEST'] = original_test
+        if parked is not None:
+            connection.connection = parked
+        if reporting:
+            reporting['NAME'] = reporting_name
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+SNAPSHOT_CHECK_SECONDS = 5
+
+_reporting_reads = ContextVar('reporting_reads', default=False)
+# Process-wide cache of the snapshot time, re-read every SNAPSHOT_CHECK_SECONDS
+_snapshot = {'checked_at': None, 'taken_at': 0}
+
+
+def reporting_configured():
+    """True when a separate reporting database is set up (tests mirror it onto the primary)"""
+    if REPORTING_DB_ALIAS not in settings.DATABASES:
+        return False
+    reporting = connections[REPORTING_DB_ALIAS].settings_dict
+    return reporting['ENGINE'].endswith('sqlite3') and str(reporting['NAME']) != str(
+        connections[DEFAULT_DB_ALIAS].settings_dict['NAME']
+    )
+
+
+def snapshot_taken_at():
+    """Unix time the reporting snapshot was copied (kept in its user_version header); 0 if never"""
+    with connections[REPORTING_DB_ALIAS].cursor() as cursor:
+        cursor.execute('PRAGMA user_version')
+        return cursor.fetchone()[0]
+
+
+def reporting_database():
+    """Alias reporting reads should use now: the snapshot while it is fresh enough, else the primary"""
+    if not reporting_configured():
+        return DEFAULT_DB_ALIAS
+    now = time.monotonic()
+    if _snapshot['checked_at'] is None or now - _snapshot['checked_at'] > SNAPSHOT_CHECK_SECONDS:
+        try:
+            _snapshot['taken_at'] = snapshot_taken_at()
+        except DatabaseError:
+            _snapshot['taken_at'] = 0
+        _snapshot['checked_at'] = now
+    max_age = getattr(settings, 'REPORTING_MAX_STALENESS', 900)
+    if time.time() - _snapshot['taken_at'] > max_age:
+        return DEFAULT_DB_ALIAS
+    return REPORTING_DB_ALIAS
+
+
+@contextmanager
+def reporting_reads():
+    """Let the queries run in this block read from the reporting snapshot"""
+    token = _reporting_reads.set(True)
+    try:
+        yield
+    finally:
+        _reporting_reads.reset(token)
+
+
+def reporting_view(view):
+    """Decorator for read-only report views whose queries may use the snapshot"""
+    @wraps(view)
+    def wrapped(request, *args, **kwargs):
+        with reporting_reads():
+            return view(request, *args, **kwargs)
+    return wrapped
+
+
+def reporting_queryset(queryset):
+    """Pin a queryset to the database a reporting read would use now, for results streamed after the view returns"""
+    with reporting_reads():
+        return queryset.using(queryset.db)
+
+
+class ReportingRouter:
+    """Route reads in reporting_reads() blocks to the snapshot; all writes and migrations go to the primary"""
+
+    def db_for_read(self, model, **hints):
+        if _reporting_reads.get() and not connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return reporting_database()
+        return None
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The snapshot holds the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # The snapshot gets its schema from the primary with every refresh
+        if db == REPORTING_DB_ALIAS:
+            return False
+        return None
+
+
+def refresh_reporting_snapshot():
+    """
+    Copy the primary into the reporting database with the SQLite online
+    backup API, in one step so the copy is consistent, and stamp it with the
+    time the copy started. Returns the pages copied and the seconds taken.
+    """
+    if not reporting_configured():
+        raise ImproperlyConfigured('No separate SQLite reporting database is configured')
+    primary = connections[DEFAULT_DB_ALIAS]
+    primary.ensure_connection()
+    taken_at = int(time.time())
+    started = time.monotonic()
+    target = sqlite3.connect(connections[REPORTING_DB_ALIAS].settings_dict['NAME'], timeout=30)
+    try:
+        primary.connection.backup(target)
+        target.execute(f'PRAGMA user_version = {taken_at}')
+        pages = target.execute('PRAGMA page_count').fetchone()[0]
+    finally:
+        target.close()
+    _snapshot.update(checked_at=None)
+    return {'pages': pages, 'seconds': time.monotonic() - started}
+
+
+@receiver(post_migrate)
+def refresh_snapshot_after_migrate(sender, using=DEFAULT_DB_ALIAS, **kwargs):
+    """A migrated primary makes the snapshot's schema outdated; copy it again"""
+    if sender.label == 'pharmacy' and using == DEFAULT_DB_ALIAS and reporting_configured():
+        refresh_reporting_snapshot()
+
+
+# Drug type -> model name of its catalog; with CATEGORY_DATABASES the drug
+# type is also the alias of the category's database
+CATEGORY_DRUG_MODELS = {
+    'lpacemaker': 'lpacemakerdrugs',
+    'ncap': 'ncapdrugs',
+    'oncology': 'oncologypharmacy',
+}
+
+
+def categories_split():
+    """True when each drug category has its own database file (settings.CATEGORY_DATABASES)"""
+    return getattr(settings, 'CATEGORY_DATABASES', False)
+
+
+def stock_database(drug_type):
+    """
+    Alias of the database holding a category's drugs, stock lots and stock
+    movements, or None when the categories share the main database (the
+    routers decide, so reporting reads can still use the snapshot)
+    """
+    if not categories_split():
+        return None
+    drug_type = drug_type.lower()
+    if drug_type not in CATEGORY_DRUG_MODELS:
+        raise ValueError(f"Invalid drug type: {drug_type}")
+    return drug_type
+
+
+def _instance_category(instance):
+    """Category of a drug, StockLot or StockMovement instance, or None"""
+    model_name = instance._meta.model_name
+    for category, drug_model in CATEGORY_DRUG_MODELS.items():
+        if model_name == drug_model:
+            return category
+    if model_name == 'stocklot':
+        for category in CATEGORY_DRUG_MODELS:
+            if getattr(instance, f'{category}_drug_id', None):
+                return category
+    elif model_name == 'stockmovement' and (instance.drug_type or '').lower() in CATEGORY_DRUG_MODELS:
+        return instance.drug_type.lower()
+    return None
+
+
+class CategoryRouter:
+    """
+    Route each category's drugs to the category's database. StockLot and
+    StockMovement rows follow the drug they belong to when the router is
+    given an instance (saving a lot, drug.lots); queries without one must
+    name the database, which StockLotService does with stock_database().
+    Every database gets the full schema, so relations can be followed
+    within a file; users, carts, forms and sessions stay in the main one.
+    """
+
+    def _database(self, model, hints):
+        if model._meta.app_label != 'pharmacy':
+            return None
+        for category, drug_model in CATEGORY_DRUG_MODELS.items():
+            if model._meta.model_name == drug_model:
+                return category
+        if model._meta.model_name in ('stocklot', 'stockmovement') and hints.get('instance') is not None:
+            return _instance_category(hints['instance'])
+        return None
+
+    def db_for_read(self, model, **hints):
+        return self._database(model, hints)
+
+    def db_for_write(self, model, **hints):
+        return self._database(model, hints)
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Cart lines in the main database point at drugs in the category files
+        return True
+
+
+def install_catalog_triggers(using=DEFAULT_DB_ALIAS):
+    """
+    Create the triggers that log every insert, update and delete of a drug
+    as a CatalogChange row in the same transaction, where missing. Table
+    rebuilds in later migrations drop a table's triggers, so this runs
+    after every migrate.
+    """
+    from django.apps import apps
+
+    connection = connections[using]
+    if connection.vendor != 'sqlite':
+        return
+    change_table = apps.get_model('pharmacy', 'CatalogChange')._meta.db_table
+    drug_tables = {
+        category: apps.get_model('pharmacy', model_name)._meta.db_table
+        for category, model_name in CATEGORY_DRUG_MODELS.items()
+    }
+    with connection.cursor() as cursor:
+        tables = set(connection.introspection.table_names(cursor))
+        if change_table not in tables:
+            return
+        for category, table in drug_tables.items():
+            for event, row in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD')):
+                cursor.execute(
+                    f'CREATE TRIGGER IF NOT EXISTS "{table}_catalog_{event.lower()}" AFTER {event} ON "{table}" '
+                    f'BEGIN INSERT INTO "{change_table}" ("drug_type", "drug_id") '
+                    f"VALUES ('{category.upper()}', {row}.\"id\"); END"
+                )
+
+
+@receiver(post_migrate)
+def install_catalog_triggers_after_migrate(sender, using=DEFAULT_DB_ALIAS, **kwargs):
+    if sender.label == 'pharmacy' and using != REPORTING_DB_ALIAS:
+        install_catalog_triggers(using)
+
+
+@contextmanager
+def stock_atomic(*drug_types):
+    """
+    atomic() over the databases holding these categories' stock: the main
+    database, or with per-category files one transaction per file, begun in
+    a fixed order so two callers never wait on each other. The files commit
+    one after another at the end of the block.
+    """
+    aliases = sorted({stock_database(drug_type) or DEFAULT_DB_ALIAS for drug_type in drug_types})
+    with ExitStack() as stack:
+        for alias in aliases:
+            stack.enter_context(transaction.atomic(using=alias))
+        yield
+
+
+def coordinated_write(steps):
+    """
+    Run [(alias, action, undo), ...] in order, alias None meaning the main
+    database, and return the last action's result. Steps on one database run
+    in a single transaction. Across databases each step commits on its own
+    before the next begins, so no write lock is held while waiting for
+    another file's; if a step raises, the undo of every step already
+    committed runs, newest first, and the error is re-raised.
+    """
+    aliases = [alias or DEFAULT_DB_ALIAS for alias, _, _ in steps]
+    result = None
+    if len(set(aliases)) == 1:
+        with transaction.atomic(using=aliases[0]):
+            for _, action, _ in steps:
+                result = action()
+        return result
+
+    committed = []
+    try:
+        for alias, (_, action, undo) in zip(aliases, steps):
+            with transaction.atomic(using=alias):
+                result = action()
+            committed.append((alias, undo))
+    except Exception:
+        for alias, undo in reversed(committed):
+            if undo is not None:
+                with transaction.atomic(using=alias):
+                    undo()
+        raise
+    return result
+
+
+def split_category_files(source, targets):
+    """
+    Copy the main SQLite file `source` into one file per category
+    ({drug type: path}) with the backup API, keep only that category's
+    drugs, lots, movements and catalog changes in each copy, then delete
+    those rows from `source`. Run with the application stopped.
+    """
+    from django.apps import apps
+
+    drug_tables = {
+        category: apps.get_model('pharmacy', model_name)._meta.db_table
+        for category, model_name in CATEGORY_DRUG_MODELS.items()
+    }
+    lot_table = apps.get_model('pharmacy', 'StockLot')._meta.db_table
+    movement_table = apps.get_model('pharmacy', 'StockMovement')._meta.db_table
+    change_table = apps.get_model('pharmacy', 'CatalogChange')._meta.db_table
+    category_tables = set(drug_tables.values()) | {lot_table, movement_table, change_table}
+    other_tables = sorted(
+        {model._meta.db_table for model in apps.get_models(include_auto_created=True)} - category_tables
+    )
+
+    # Plain sqlite3 connections do not enforce foreign keys, so the tables
+    # can be emptied in any order
+    with closing(sqlite3.connect(source, timeout=30)) as main:
+        for category, path in targets.items():
+            with closing(sqlite3.connect(path, timeout=30)) as target:
+                main.backup(target)
+                statements = [
+                    f'DELETE FROM "{lot_table}" WHERE "{category}_drug_id" IS NULL',
+                    f'DELETE FROM "{movement_table}" WHERE "drug_type" != \'{category.upper()}\'',
+                ]
+                statements += [
+                    f'DELETE FROM "{table}"'
+                    for table in [table for other, table in drug_tables.items() if other != category] + other_tables
+                ]
+                # After the drug deletes, whose triggers log them: the file
+                # keeps its category's catalog changes under the same ids,
+                # so delta-sync cursors stay valid
+                statements.append(f'DELETE FROM "{change_table}" WHERE "drug_type" != \'{category.upper()}\'')
+                for statement in statements:
+                    target.execute(statement)
+                target.commit()
+                target.execute('VACUUM')
+        for table in (lot_table, movement_table, *drug_tables.values(), change_table):
+            main.execute(f'DELETE FROM "{table}"')
+        main.commit()
+
+
+# Pages copied per backup step and the pause between steps (seconds)
+BACKUP_STEP_PAGES = 256
+BACKUP_STEP_SLEEP = 0.01
+# Copies restarted by writes between steps before the rest is copied in
+# one step
+BACKUP_MAX_RESTARTS = 3
+BACKUP_MANIFEST = 'manifest.json'
+
+
+class BackupError(ValueError):
+    """Raised when a snapshot is missing, damaged or does not match the configured databases"""
+
+
+class _CopyRestarting(Exception):
+    """Raised from the backup progress callback to stop a copy that keeps restarting"""
+
+
+def backup_directory():
+    return Path(getattr(settings, 'BACKUP_DIR', Path(settings.BASE_DIR) / 'backups'))
+
+
+def backup_aliases():
+    """The databases a backup covers; the reporting snapshot is rebuilt from the primary instead"""
+    return [
+        alias for alias in settings.DATABASES
+        if alias != REPORTING_DB_ALIAS and connections[alias].vendor == 'sqlite'
+    ]
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _copy_pages(source, target, pages, sleep):
+    """
+    Copy `source` into `target` with the backup API, `pages` pages per step
+    and `sleep` seconds between steps. Returns the pages, seconds and restarts.
+    """
+    state = {'remaining': None, 'restarts': 0}
+
+    def progress(status, remaining, total):
+        # A write to the source between steps starts the copy over
+        if state['remaining'] is not None and remaining > state['remaining']:
+            state['restarts'] += 1
+            if state['restarts'] > BACKUP_MAX_RESTARTS:
+                raise _CopyRestarting
+        state['remaining'] = remaining
+        if remaining and sleep:
+            time.sleep(sleep)
+
+    started = time.monotonic()
+    try:
+        source.backup(target, pages=pages, progress=progress)
+    except _CopyRestarting:
+        # Writes keep landing between steps; copy the rest in one go
+        source.backup(target)
+    return {
+        'pages': target.execute('PRAGMA page_count').fetchone()[0],
+        'seconds': time.monotonic() - started,
+        'restarts': state['restarts'],
+    }
+
+
+def take_backup(directory=None, pages=BACKUP_STEP_PAGES, sleep=BACKUP_STEP_SLEEP):
+    """
+    Write a snapshot of every database (backup_aliases) to a new directory
+    under `directory`, named for the UTC time it was taken: one gzip file
+    per database and a manifest with their SHA-256 checksums.
+
+    In WAL mode a read transaction is opened on every database before the
+    first page is copied, so the files are copied as of one moment without
+    blocking writers. In the other journal modes each step holds the read
+    lock only briefly; a write between steps restarts that file's copy, and
+    after BACKUP_MAX_RESTARTS restarts the rest is copied in one step.
+    Returns the snapshot's path and per-database figures.
+    """
+    directory = Path(directory or backup_directory())
+    directory.mkdir(parents=True, exist_ok=True)
+    taken_at = timezone.now()
+    name = taken_at.strftime('%Y%m%dT%H%M%SZ')
+    partial = directory / f'{name}.partial'
+    partial.mkdir()
+    manifest = {'taken_at': taken_at.isoformat(), 'databases': {}}
+    try:
+        with ExitStack() as stack:
+            sources = {}
+            for alias in backup_aliases():
+                source = stack.enter_context(closing(sqlite3.connect(
+                    str(connections[alias].settings_dict['NAME']), timeout=30, isolation_level=None,
+                )))
+                if source.execute('PRAGMA journal_mode').fetchone()[0] == 'wal':
+                    source.execute('BEGIN')
+                    source.execute('SELECT count(*) FROM sqlite_master').fetchone()
+                sources[alias] = source
+            for alias, source in sources.items():
+                raw = partial / f'{alias}.sqlite3'
+                with closing(sqlite3.connect(raw)) as target:
+                    figures = _copy_pages(source, target, pages, sleep)
+                # Let checkpoints past this file's snapshot again
+                source.close()
+                archive = partial / f'{alias}.sqlite3.gz'
+                with open(raw, 'rb') as file, gzip.open(archive, 'wb') as compressed:
+                    shutil.copyfileobj(file, compressed, 1024 * 1024)
+                figures.update(
+                    file=archive.name,
+                    sha256=_sha256(archive),
+                    bytes=raw.stat().st_size,
+                    compressed_bytes=archive.stat().st_size,
+                )
+                raw.unlink()
+                manifest['databases'][alias] = figures
+        (partial / BACKUP_MANIFEST).write_text(json.dumps(manifest, indent=2))
+        snapshot = partial.rename(directory / name)
+    except BaseException:
+        shutil.rmtree(partial, ignore_errors=True)
+        raise
+    return {'path': snapshot, 'databases': manifest['databases']}
+
+
+def list_backups(directory=None):
+    """Complete snapshots under `directory`, oldest first"""
+    directory = Path(directory or backup_directory())
+    if not directory.is_dir():
+        return []
+    return sorted(
+        path for path in directory.iterdir()
+        if path.is_dir() and not path.name.endswith('.partial') and (path / BACKUP_MANIFEST).is_file()
+    )
+
+
+def prune_backups(keep, directory=None):
+    """Delete all but the newest `keep` snapshots; returns the paths deleted"""
+    snapshots = list_backups(directory)
+    expired = snapshots[:-keep] if keep > 0 else snapshots
+    for path in expired:
+        shutil.rmtree(path)
+    return expired
+
+
+def read_backup_manifest(snapshot):
+    try:
+        return json.loads((Path(snapshot) / BACKUP_MANIFEST).read_text())
+    except (OSError, ValueError) as exc:
+        raise BackupError(f'{snapshot} is not a readable snapshot: {exc}')
+
+
+def restore_backup(snapshot):
+    """
+    Copy a snapshot back over the configured databases. Every file is
+    checked against its checksum and with PRAGMA quick_check before any
+    database is touched; each database is then replaced in one backup-API
+    step, so connections still open see either the old or the restored
+    contents. The reporting snapshot is copied again afterwards.
+    Returns the pages and seconds per database.
+    """
+    snapshot = Path(snapshot)
+    databases = read_backup_manifest(snapshot)['databases']
+    aliases = backup_aliases()
+    if set(databases) != set(aliases):
+        raise BackupError(
+            f"The snapshot holds {', '.join(sorted(databases))} but the configured databases are "
+            f"{', '.join(sorted(aliases))}; check CATEGORY_DATABASES"
+        )
+    for alias, figures in databases.items():
+        archive = snapshot / figures['file']
+        if not archive.is_file() or _sha256(archive) != figures['sha256']:
+            raise BackupError(f'{archive} is missing or does not match its checksum')
+
+    restored = {}
+    with ExitStack() as stack:
+        copies = {}
+        for alias, figures in databases.items():
+            live = Path(connections[alias].settings_dict['NAME'])
+            handle, path = tempfile.mkstemp(prefix=f'{live.name}.', suffix='.restore', dir=live.parent)
+            os.close(handle)
+            stack.callback(os.remove, path)
+            with gzip.open(snapshot / figures['file'], 'rb') as compressed, open(path, 'wb') as file:
+                shutil.copyfileobj(compressed, file, 1024 * 1024)
+            with closing(sqlite3.connect(path)) as copy:
+                check = copy.execute('PRAGMA quick_check').fetchone()[0]
+            if check != 'ok':
+                raise BackupError(f"{figures['file']} fails its integrity check: {check}")
+            copies[alias] = (path, live)
+
+        for alias, (path, live) in copies.items():
+            connections[alias].close()
+            started = time.monotonic()
+            with closing(sqlite3.connect(path)) as source, closing(sqlite3.connect(live, timeout=30)) as target:
+                source.backup(target)
+                pages = target.execute('PRAGMA page_count').fetchone()[0]
+            restored[alias] = {'pages': pages, 'seconds': time.monotonic() - started}
+    if reporting_configured():
+        refresh_reporting_snapshot()
+    return restored
@@ -0,0 +1,110 @@
+"""
+Streaming exports for NEOPHARM.
+Rows are read with QuerySet.iterator() over values_list() projections and
+written out as they arrive, so memory use stays flat whether an export has
+a hundred rows or a few million. The export pages have the job worker
+write the file (write_export) and offer it for download once it is done.
+"""
+import csv
+import tempfile
+from datetime import datetime
+
+from django.http import StreamingHttpResponse, FileResponse
+from django.utils import timezone
+
+try:
+    from openpyxl import Workbook
+except ImportError:  # XLSX export is optional
+    Workbook = None
+
+EXPORT_CHUNK_SIZE = 2000
+
+
+class _Echo:
+    """File-like object whose write() hands the value straight back"""
+
+    def write(self, value):
+        return value
+
+
+def _export_value(value):
+    """Convert aware datetimes to local naive ones, which both CSV and XLSX handle"""
+    if isinstance(value, datetime) and timezone.is_aware(value):
+        return timezone.make_naive(value)
+    return value
+
+
+def iter_rows(queryset, fields, chunk_size=EXPORT_CHUNK_SIZE):
+    """Yield tuples of `fields` from `queryset` without caching the result set"""
+    for row in queryset.values_list(*fields).iterator(chunk_size=chunk_size):
+        yield tuple(_export_value(value) for value in row)
+
+
+def _csv_chunks(header, rows, rows_per_chunk):
+    writer = csv.writer(_Echo())
+    buffer = [writer.writerow(header)]
+    for row in rows:
+        buffer.append(writer.writerow(row))
+        if len(buffer) >= rows_per_chunk:
+            yield ''.join(buffer)
+            buffer = []
+    if buffer:
+        yield ''.join(buffer)
+
+
+def csv_response(filename, header, rows, rows_per_chunk=500):
+    """StreamingHttpResponse that writes `rows` as CSV in batches of lines"""
+    response = StreamingHttpResponse(
+        _csv_chunks(header, rows, rows_per_chunk),
+        content_type='text/csv; charset=utf-8',
+    )
+    response['Content-Disposition'] = f'attachment; filename="{filename}.csv"'
+    return response
+
+
+def xlsx_available():
+    return Workbook is not None
+
+
+def _write_xlsx(target, title, header, rows):
+    """
+    Write `rows` with openpyxl's write-only workbook, which flushes each row
+    to a temporary file instead of keeping the sheet in memory.
+    """
+    if Workbook is None:
+        raise RuntimeError('openpyxl is required for XLSX exports')
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(title=title[:31])
+    sheet.append(header)
+    for row in rows:
+        sheet.append(row)
+    workbook.save(target)
+
+
+def xlsx_response(filename, header, rows):
+    spool = tempfile.TemporaryFile()
+    _write_xlsx(spool, filename, header, rows)
+    spool.seek(0)
+    return FileResponse(
+        spool,
+        as_attachment=True,
+        filename=f'{filename}.xlsx',
+        content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    )
+
+
+def export_response(export_format, filename, header, rows):
+    if export_format == 'xlsx':
+        return xlsx_response(filename, header, rows)
+    return csv_response(filename, header, rows)
+
+
+def write_export(export_format, path, title, header, rows):
+    """Write `rows` to the file at `path` as CSV or XLSX, for exports built by a background job"""
+    if export_format == 'xlsx':
+        _write_xlsx(path, title, header, rows)
+        return
+    with open(path, 'w', newline='', encoding='utf-8') as output:
+        writer = csv.writer(output)
+        writer.writerow(header)
+        writer.writerows(rows)
@@ -295,7 +295,7 @@ class UserPermissionForm(forms.ModelForm):
         self.fields['groups'].queryset = Group.objects.all()
         self.fields['user_permissions'].queryset = Permission.objects.filter(
             content_type__app_label__in=['pharmacy', 'auth', 'admin']
-        ).order_by('content_type__model', 'codename')
+        ).select_related('content_type').order_by('content_type__model', 'codename')
 
 
 class UserManageForm(forms.ModelForm):
@@ -390,7 +390,7 @@ class GroupManageForm(forms.ModelForm):
         
         self.fields['permissions'].queryset = Permission.objects.filter(
             content_type__app_label__in=['pharmacy', 'auth', 'admin']
-        ).order_by('content_type__model', 'codename')
+        ).select_related('content_type').order_by('content_type__model', 'codename')
 
 
 class BulkPermissionActionForm(forms.Form):
@@ -423,7 +423,7 @@ class BulkPermissionActionForm(forms.Form):
         
         self.fields['permission'].queryset = Permission.objects.filter(
             content_type__app_label__in=['pharmacy', 'auth', 'admin']
-        ).order_by('content_type__model', 'codename')
+        ).select_related('content_type').order_by('content_type__model', 'codename')
 
 
 class UserCategoryFilterForm(forms.Form):
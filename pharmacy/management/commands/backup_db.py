@@ -0,0 +1,57 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from pharmacy.db import BACKUP_STEP_PAGES, BACKUP_STEP_SLEEP, backup_directory, prune_backups, take_backup
+
+
+class Command(BaseCommand):
+    help = (
+        'Write a compressed, checksummed snapshot of the database files to BACKUP_DIR '
+        'while the application keeps running, then delete the oldest snapshots beyond '
+        'BACKUP_KEEP. The job worker runs this nightly; restore with restore_db.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--pages',
+            type=int,
+            default=BACKUP_STEP_PAGES,
+            help=f'Pages copied per step (default {BACKUP_STEP_PAGES}); -1 copies each file in one step',
+        )
+        parser.add_argument(
+            '--sleep',
+            type=float,
+            default=BACKUP_STEP_SLEEP,
+            help=f'Seconds to pause between steps (default {BACKUP_STEP_SLEEP:g})',
+        )
+        parser.add_argument(
+            '--keep',
+            type=int,
+            default=None,
+            help='Snapshots to keep, this one included (default BACKUP_KEEP)',
+        )
+        parser.add_argument(
+            '--dir',
+            default=None,
+            help='Directory for the snapshots (default BACKUP_DIR)',
+        )
+
+    def handle(self, *args, **options):
+        keep = options['keep'] if options['keep'] is not None else getattr(settings, 'BACKUP_KEEP', 14)
+        if options['pages'] == 0 or options['pages'] < -1 or options['sleep'] < 0:
+            raise CommandError('--pages must be positive or -1 and --sleep cannot be negative')
+        if keep < 1:
+            raise CommandError('--keep must be at least 1')
+        directory = options['dir'] or backup_directory()
+
+        result = take_backup(directory, pages=options['pages'], sleep=options['sleep'])
+        for alias, figures in result['databases'].items():
+            rate = figures['pages'] / figures['seconds'] if figures['seconds'] else 0
+            restarts = f", {figures['restarts']} restart(s)" if figures['restarts'] else ''
+            self.stdout.write(
+                f"  {alias}: {figures['pages']} pages in {figures['seconds']:.2f}s ({rate:.0f} pages/s{restarts}), "
+                f"{figures['bytes'] / 1024 ** 2:.1f} MB -> {figures['compressed_bytes'] / 1024 ** 2:.1f} MB"
+            )
+        expired = prune_backups(keep, directory)
+        self.stdout.write(self.style.SUCCESS(f"Snapshot written to {result['path']}."))
+        if expired:
+            self.stdout.write(f'Deleted {len(expired)} old snapshot(s): {", ".join(path.name for path in expired)}')
@@ -0,0 +1,195 @@
+import multiprocessing
+import os
+import random
+import tempfile
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from pharmacy.db import CATEGORY_DRUG_MODELS, scratch_sqlite_database, split_category_files
+
+
+def _counter_worker(paths, split, role, category, user_id, seconds, bulk_size, barrier, results):
+    """Worker process: dispense one item at a time, or apply bulk stock changes"""
+    # The category databases and their router are set up from the
+    # environment when settings load
+    os.environ['CATEGORY_DATABASES'] = 'True' if split else 'False'
+    import django
+    django.setup()
+    from django.db import connections, OperationalError
+    from pharmacy.db import stock_atomic
+    from pharmacy.models import User
+    from pharmacy.services import DrugService, StockLotService
+
+    for alias, path in paths.items():
+        connections[alias].settings_dict['NAME'] = path
+    drug_ids = list(DrugService.get_drug_model(category).objects.values_list('id', flat=True))
+    user = User.objects.get(pk=user_id)
+
+    rng = random.Random()
+    operations = errors = 0
+    barrier.wait()
+    deadline = time.perf_counter() + seconds
+    try:
+        while time.perf_counter() < deadline:
+            try:
+                if role == 'bulk':
+                    # A delivery or stock count touching many drugs of the category
+                    with stock_atomic(category):
+                        StockLotService.adjust_drugs(category, {drug_id: 1 for drug_id in rng.sample(drug_ids, bulk_size)})
+                else:
+                    success, _, _ = DrugService.add_to_cart(user, category, rng.choice(drug_ids), 1)
+                    if not success:
+                        errors += 1
+                        continue
+                    DrugService.checkout(user, 'bench patient')
+                operations += 1
+            except OperationalError:
+                errors += 1
+    finally:
+        # Report even if the worker fails, so the parent is not left waiting
+        for connection in connections.all():
+            connection.close()
+        results.put((role, category, operations, errors))
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure dispensing throughput with counters working in all three drug '
+        'categories at once while a bulk stock update runs in one of them, with one '
+        'database file and with a file per category (CATEGORY_DATABASES). Runs '
+        'against throwaway databases; the real database is not touched.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--counters',
+            type=int,
+            default=2,
+            help='Dispensing processes per category (default 2)',
+        )
+        parser.add_argument(
+            '--seconds',
+            type=float,
+            default=5,
+            help='Duration of each run (default 5)',
+        )
+        parser.add_argument(
+            '--drugs',
+            type=int,
+            default=500,
+            help='Drugs per category (default 500)',
+        )
+        parser.add_argument(
+            '--bulk-category',
+            default='oncology',
+            choices=list(CATEGORY_DRUG_MODELS) + ['none'],
+            help='Category receiving bulk stock updates during the run, or none (default oncology)',
+        )
+        parser.add_argument(
+            '--bulk-size',
+            type=int,
+            default=300,
+            help='Drugs changed by each bulk update (default 300)',
+        )
+
+    def handle(self, *args, **options):
+        from django.db import connection
+
+        if options['counters'] < 1 or options['seconds'] <= 0 or options['drugs'] < 1:
+            raise CommandError('--counters, --seconds and --drugs must be positive')
+        if not 0 < options['bulk_size'] <= options['drugs']:
+            raise CommandError('--bulk-size must be between 1 and --drugs')
+        if connection.vendor != 'sqlite':
+            raise CommandError('The benchmark builds throwaway SQLite databases; run it with the SQLite settings')
+
+        self.stdout.write('Building benchmark database...')
+        with scratch_sqlite_database() as db_name, tempfile.TemporaryDirectory(prefix='neopharm-bench-') as scratch:
+            users = self.seed(options['counters'] * len(CATEGORY_DRUG_MODELS), options['drugs'])
+            bulk = options['bulk_category']
+            self.stdout.write(
+                f"{options['counters']} counter(s) per category, {options['drugs']} drugs per category, "
+                f"{options['seconds']:g}s per run"
+                + (f", bulk updates of {options['bulk_size']} {bulk} drugs" if bulk != 'none' else '')
+            )
+            columns = ''.join(f'{category + "/s":>13}' for category in CATEGORY_DRUG_MODELS)
+            self.stdout.write(f"{'database':>10}{columns}{'total/s':>10}{'bulk/s':>9}{'errors':>8}")
+
+            paths = {'default': db_name}
+            for label in ('one file', 'per category'):
+                if label == 'per category':
+                    connection.close()
+                    targets = {category: os.path.join(scratch, f'{category}.sqlite3') for category in CATEGORY_DRUG_MODELS}
+                    split_category_files(db_name, targets)
+                    paths.update(targets)
+                rates, bulk_rate, errors = self.measure(paths, label == 'per category', users, options)
+                self.stdout.write(
+                    f"{label:>10}"
+                    + ''.join(f'{rates[category]:>13.1f}' for category in CATEGORY_DRUG_MODELS)
+                    + f"{sum(rates.values()):>10.1f}{bulk_rate:>9.1f}{errors:>8}"
+                )
+
+    def seed(self, user_count, drug_count):
+        from django.utils import timezone
+        from pharmacy.models import StockLot, User
+        from pharmacy.services import DrugService
+
+        # Bulk inserts skip password hashing and profile signals, which
+        # dispensing does not need
+        users = User.objects.bulk_create(
+            [User(mobile=f'0900{i:07d}', username=f'bench{i}') for i in range(user_count)]
+        )
+        exp_date = timezone.now().date() + timedelta(days=365)
+        for category in CATEGORY_DRUG_MODELS:
+            model = DrugService.get_drug_model(category)
+            drugs = model.objects.bulk_create(
+                [
+                    model(name=f'bench {category} {i:05d}', unit='Tab', dosage_form='Tablet', cost=10, price=11,
+                          stock=10 ** 9, exp_date=exp_date)
+                    for i in range(drug_count)
+                ],
+                batch_size=500,
+            )
+            field = DrugService.get_drug_field_name(category)
+            StockLot.objects.bulk_create(
+                [StockLot(**{field: drug}, exp_date=exp_date, quantity=drug.stock) for drug in drugs],
+                batch_size=500,
+            )
+        return users
+
+    def measure(self, paths, split, users, options):
+        from django.db import connection
+
+        connection.close()
+        context = multiprocessing.get_context('spawn')
+        roles = [
+            ('counter', category, users[i * options['counters'] + n].pk)
+            for i, category in enumerate(CATEGORY_DRUG_MODELS)
+            for n in range(options['counters'])
+        ]
+        if options['bulk_category'] != 'none':
+            roles.append(('bulk', options['bulk_category'], users[0].pk))
+        barrier = context.Barrier(len(roles) + 1)
+        results = context.Queue()
+        processes = [
+            context.Process(
+                target=_counter_worker,
+                args=(paths, split, role, category, user_id, options['seconds'], options['bulk_size'], barrier, results),
+            )
+            for role, category, user_id in roles
+        ]
+        for process in processes:
+            process.start()
+        barrier.wait()
+        finished = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+
+        seconds = options['seconds']
+        rates = {
+            category: sum(operations for role, cat, operations, _ in finished if role == 'counter' and cat == category) / seconds
+            for category in CATEGORY_DRUG_MODELS
+        }
+        bulk_rate = sum(operations for role, _, operations, _ in finished if role == 'bulk') / seconds
+        errors = sum(errors for _, _, _, errors in finished)
+        return rates, bulk_rate, errors
@@ -0,0 +1,193 @@
+import multiprocessing
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from pharmacy.db import scratch_sqlite_database
+
+
+def _replay_worker(db_name, worker, chunk_size, barrier, results):
+    """Worker process: replay until the benchmark queue is drained"""
+    import django
+    django.setup()
+    from django.conf import settings
+    from django.db import connections, OperationalError
+    from pharmacy.models import OfflineTransaction
+    from pharmacy.services import OfflineReplayService
+
+    # Benchmark adds never conflict on stock, so apply them all
+    settings.OFFLINE_REPLAY_CONFLICT_POLICY = 'clamp'
+    connection = connections['default']
+    connection.close()
+    connection.settings_dict['NAME'] = db_name
+
+    totals = {'chunks': 0, 'synced': 0, 'failed': 0, 'deferred': 0, 'lock_timeouts': 0}
+    barrier.wait()
+    while True:
+        try:
+            summary = OfflineReplayService.run(chunk_size=chunk_size, worker=worker)
+        except OperationalError:
+            # SQLite does not queue writers fairly; a worker can wait out the
+            # busy timeout while the others keep the lock. Claim again.
+            totals['lock_timeouts'] += 1
+            continue
+        for key in summary.keys() & totals.keys():
+            totals[key] += summary[key]
+        if summary['chunks']:
+            continue
+        # Nothing claimable; stop once no other worker holds unfinished rows
+        if not OfflineTransaction.objects.filter(synced=False, quarantined=False, next_attempt_at__isnull=True).exists():
+            break
+        time.sleep(0.01)
+    connection.close()
+    results.put((worker, totals))
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure offline replay throughput with 1, 2 and 4 worker processes. '
+        'Runs against a throwaway SQLite database; the real database is not touched.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--transactions',
+            type=int,
+            default=2000,
+            help='Queued add-to-cart transactions per run (default 2000)',
+        )
+        parser.add_argument(
+            '--users',
+            type=int,
+            default=200,
+            help='Counter users the transactions are spread over (default 200)',
+        )
+        parser.add_argument(
+            '--workers',
+            type=int,
+            nargs='+',
+            default=[1, 2, 4],
+            help='Worker process counts to measure (default 1 2 4)',
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=50,
+            help='Transactions claimed per chunk (default 50)',
+        )
+
+    def handle(self, *args, **options):
+        from django.db import connection
+
+        if options['transactions'] < 1 or options['users'] < 1 or options['chunk_size'] < 1:
+            raise CommandError('--transactions, --users and --chunk-size must be at least 1')
+        if any(workers < 1 for workers in options['workers']):
+            raise CommandError('--workers must be at least 1')
+        if connection.vendor != 'sqlite':
+            raise CommandError('The benchmark builds a throwaway SQLite database; run it with the SQLite settings')
+
+        self.stdout.write('Building benchmark database...')
+        with scratch_sqlite_database() as db_name:
+            users, drugs = self.seed_catalog(options['users'])
+            self.stdout.write(
+                f"{options['transactions']} transactions over {options['users']} users, "
+                f"chunks of {options['chunk_size']}"
+            )
+            self.stdout.write(
+                f"{'workers':>8} {'seconds':>9} {'txn/s':>9} {'speedup':>8} {'synced':>8} {'failed':>7} {'lock waits':>11}"
+            )
+            baseline = None
+            for workers in options['workers']:
+                self.seed_queue(users, drugs, options['transactions'])
+                elapsed, totals = self.measure(db_name, workers, options['chunk_size'])
+                rate = options['transactions'] / elapsed
+                baseline = baseline or rate
+                self.stdout.write(
+                    f"{workers:>8} {elapsed:>9.2f} {rate:>9.0f} {rate / baseline:>7.2f}x "
+                    f"{totals['synced']:>8} {totals['failed']:>7} {totals['lock_timeouts']:>11}"
+                )
+                self.check_no_overlap(options['transactions'], totals)
+
+    def seed_catalog(self, user_count):
+        from django.utils import timezone
+        from pharmacy.models import NcapDrugs, StockLot, User
+
+        # Bulk inserts skip password hashing and profile signals, which the
+        # replay does not need
+        users = User.objects.bulk_create(
+            [User(mobile=f'0900{i:07d}', username=f'bench{i}') for i in range(user_count)]
+        )
+        exp_date = timezone.now().date() + timedelta(days=365)
+        drugs = NcapDrugs.objects.bulk_create(
+            [
+                NcapDrugs(name=f'bench drug {i}', unit='Tab', dosage_form='Tablet', cost=10, price=11,
+                          stock=10 ** 9, exp_date=exp_date)
+                for i in range(50)
+            ]
+        )
+        StockLot.objects.bulk_create(
+            [StockLot(ncap_drug=drug, exp_date=exp_date, quantity=drug.stock) for drug in drugs]
+        )
+        return users, drugs
+
+    def seed_queue(self, users, drugs, count):
+        from pharmacy.models import Cart, OfflineTransaction
+
+        Cart.objects.all().delete()
+        OfflineTransaction.objects.all().delete()
+        OfflineTransaction.objects.bulk_create(
+            [
+                OfflineTransaction(
+                    transaction_type='ADD_TO_CART',
+                    data={'user_id': users[i % len(users)].pk, 'drug_type': 'ncap',
+                          'drug_id': drugs[i % len(drugs)].pk, 'quantity': 1},
+                )
+                for i in range(count)
+            ],
+            batch_size=500,
+        )
+
+    def measure(self, db_name, workers, chunk_size):
+        from django.db import connection
+
+        connection.close()
+        # Spawned workers start from a clean interpreter on every platform;
+        # Django start-up happens before the barrier and is not timed
+        context = multiprocessing.get_context('spawn')
+        barrier = context.Barrier(workers + 1)
+        results = context.Queue()
+        processes = [
+            context.Process(target=_replay_worker, args=(db_name, f'bench-{i}', chunk_size, barrier, results))
+            for i in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        barrier.wait()
+        started = time.perf_counter()
+        finished = [results.get() for _ in processes]
+        elapsed = time.perf_counter() - started
+        for process in processes:
+            process.join()
+
+        totals = {'synced': 0, 'failed': 0, 'lock_timeouts': 0}
+        for _, counts in finished:
+            for key in totals:
+                totals[key] += counts[key]
+        return elapsed, totals
+
+    def check_no_overlap(self, count, totals):
+        from django.db.models import Sum
+        from pharmacy.models import Cart, OfflineTransaction
+
+        synced = OfflineTransaction.objects.filter(synced=True).count()
+        in_carts = Cart.objects.aggregate(total=Sum('quantity'))['total'] or 0
+        if totals['synced'] != synced or in_carts != synced:
+            raise CommandError(
+                f'Overlap detected: workers reported {totals["synced"]} synced, '
+                f'{synced} rows are synced and carts hold {in_carts} units'
+            )
+        if synced != count:
+            errors = set(OfflineTransaction.objects.filter(synced=False).values_list('last_error', flat=True))
+            self.stdout.write(self.style.WARNING(
+                f"{count - synced} transaction(s) were not synced: {'; '.join(sorted(errors))}"
+            ))
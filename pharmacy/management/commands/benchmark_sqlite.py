@@ -0,0 +1,159 @@
+import multiprocessing
+import random
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from pharmacy.db import scratch_sqlite_database
+
+# SQLite's own defaults, with a connection opened per request as
+# CONN_MAX_AGE=0 does
+BASELINE = {
+    'pragmas': {'journal_mode': 'delete', 'synchronous': 'full', 'busy_timeout': 5000},
+    'persistent': False,
+}
+
+
+def _load_worker(db_name, role, pragmas, persistent, seconds, barrier, results):
+    """Worker process: run store reads or stock writes until time is up"""
+    import django
+    django.setup()
+    from django.conf import settings
+    from django.db import connections, transaction, OperationalError
+    from django.db.models import Sum
+    from pharmacy.models import NcapDrugs
+    from pharmacy.services import StockLotService
+
+    settings.SQLITE_PRAGMAS = pragmas
+    connection = connections['default']
+    connection.close()
+    connection.settings_dict['NAME'] = db_name
+    drug_ids = list(NcapDrugs.objects.values_list('id', flat=True))
+    connection.close()
+
+    rng = random.Random()
+    operations = errors = 0
+    barrier.wait()
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        try:
+            if role == 'read':
+                # The store page: one page of drugs and the stock total
+                list(NcapDrugs.objects.filter(stock__gt=0).order_by('name')[:50])
+                NcapDrugs.objects.aggregate(total=Sum('stock'))
+            else:
+                with transaction.atomic():
+                    StockLotService.adjust_drugs('ncap', {rng.choice(drug_ids): rng.choice((-1, 1))})
+            operations += 1
+        except OperationalError:
+            errors += 1
+        if not persistent:
+            connection.close()
+    connection.close()
+    results.put((role, operations, errors))
+
+
+class Command(BaseCommand):
+    help = (
+        'Measure SQLite read and write throughput under concurrent load, with '
+        'SQLite defaults and with settings.SQLITE_PRAGMAS plus persistent connections. '
+        'Runs against a throwaway database; the real database is not touched.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--readers',
+            type=int,
+            default=4,
+            help='Reading processes (default 4)',
+        )
+        parser.add_argument(
+            '--writers',
+            type=int,
+            default=2,
+            help='Writing processes (default 2)',
+        )
+        parser.add_argument(
+            '--seconds',
+            type=float,
+            default=5,
+            help='Duration of each run (default 5)',
+        )
+        parser.add_argument(
+            '--drugs',
+            type=int,
+            default=2000,
+            help='Drugs in the benchmark catalog (default 2000)',
+        )
+
+    def handle(self, *args, **options):
+        from django.db import connection
+        from pharmacy.db import sqlite_pragmas
+
+        if options['readers'] < 0 or options['writers'] < 0 or options['readers'] + options['writers'] == 0:
+            raise CommandError('Need at least one reader or writer')
+        if options['seconds'] <= 0 or options['drugs'] < 1:
+            raise CommandError('--seconds and --drugs must be positive')
+        if connection.vendor != 'sqlite':
+            raise CommandError('The benchmark builds a throwaway SQLite database; run it with the SQLite settings')
+
+        tuned = {'pragmas': sqlite_pragmas(), 'persistent': True}
+        self.stdout.write('Building benchmark database...')
+        with scratch_sqlite_database() as db_name:
+            self.seed(options['drugs'])
+            self.stdout.write(
+                f"{options['readers']} reader(s), {options['writers']} writer(s), "
+                f"{options['seconds']:g}s per run, {options['drugs']} drugs"
+            )
+            self.stdout.write(f"{'config':>9} {'reads/s':>9} {'writes/s':>9} {'errors':>7}")
+            for label, config in (('baseline', BASELINE), ('tuned', tuned)):
+                reads, writes, errors = self.measure(db_name, config, options)
+                self.stdout.write(
+                    f"{label:>9} {reads / options['seconds']:>9.0f} {writes / options['seconds']:>9.0f} {errors:>7}"
+                )
+            self.stdout.write(f"tuned = {tuned['pragmas']}, persistent connections")
+
+    def seed(self, count):
+        from django.utils import timezone
+        from pharmacy.models import NcapDrugs
+
+        exp_date = timezone.now().date() + timedelta(days=365)
+        NcapDrugs.objects.bulk_create(
+            [
+                NcapDrugs(name=f'bench drug {i:05d}', unit='Tab', dosage_form='Tablet', cost=10, price=11,
+                          stock=1000, exp_date=exp_date)
+                for i in range(count)
+            ],
+            batch_size=500,
+        )
+
+    def measure(self, db_name, config, options):
+        from django.db import connection
+
+        # The journal mode belongs to the database file and can only change
+        # while no other connection is open, so set it before the workers start
+        with connection.cursor() as cursor:
+            cursor.execute(f"PRAGMA journal_mode = {config['pragmas'].get('journal_mode', 'delete')}")
+        connection.close()
+        context = multiprocessing.get_context('spawn')
+        roles = ['read'] * options['readers'] + ['write'] * options['writers']
+        barrier = context.Barrier(len(roles) + 1)
+        results = context.Queue()
+        processes = [
+            context.Process(
+                target=_load_worker,
+                args=(db_name, role, config['pragmas'], config['persistent'], options['seconds'], barrier, results),
+            )
+            for role in roles
+        ]
+        for process in processes:
+            process.start()
+        barrier.wait()
+        finished = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+
+        reads = sum(operations for role, operations, _ in finished if role == 'read')
+        writes = sum(operations for role, operations, _ in finished if role == 'write')
+        errors = sum(errors for _, _, errors in finished)
+        return reads, writes, errors
@@ -1,10 +1,14 @@
-from django.core.management.base import BaseCommand
-from pharmacy.services import DrugService
-from django.utils import timezone
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+from pharmacy.services import ExpiryService
 
 
 class Command(BaseCommand):
-    help = 'Check and zero out stock for expired drug items'
+    help = (
+        'Write off stock lots that expired since the last run. '
+        'Schedule this daily (e.g. from cron) shortly after midnight.'
+    )
 
     def add_arguments(self, parser):
         parser.add_argument(
@@ -12,47 +16,46 @@ class Command(BaseCommand):
             action='store_true',
             help='Show what would be updated without making changes',
         )
+        parser.add_argument(
+            '--since',
+            help='Re-scan items that expired after this date (YYYY-MM-DD) instead of the stored watermark',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=ExpiryService.BATCH_SIZE,
+            help=f'Lots written off per batch and movement record (default {ExpiryService.BATCH_SIZE})',
+        )
 
     def handle(self, *args, **options):
-        current_date = timezone.now().date()
-        
-        if options['dry_run']:
+        try:
+            since = date.fromisoformat(options['since']) if options['since'] else None
+        except ValueError as e:
+            raise CommandError(f'Invalid date: {e}')
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1')
+
+        dry_run = options['dry_run']
+        summary = ExpiryService.run(since=since, batch_size=options['batch_size'], dry_run=dry_run)
+
+        window_start = summary['window_start'] or 'the beginning'
+        if dry_run:
             self.stdout.write("DRY RUN - No changes will be made")
-            self.stdout.write(f"Current date: {current_date}")
-            self.stdout.write("")
-            
-            from pharmacy.models import LpacemakerDrugs, NcapDrugs, OncologyPharmacy
-            
-            total_expired = 0
-            for model, name in [(LpacemakerDrugs, 'Lpacemaker'), 
-                               (NcapDrugs, 'NCAP'), 
-                               (OncologyPharmacy, 'Oncology')]:
-                expired = model.objects.filter(
-                    exp_date__isnull=False,
-                    exp_date__lt=current_date,
-                    stock__gt=0
+        self.stdout.write(f"Window: after {window_start} up to {summary['window_end']}")
+
+        for batch in summary['batches']:
+            for item in batch['items']:
+                self.stdout.write(
+                    f"  - {item['name']} ({batch['drug_type']}, ID: {item['id']}, lot {item['lot']}): "
+                    f"{item['stock']} written off (expired: {item['exp_date']})"
                 )
-                count = expired.count()
-                total_expired += count
-                
-                if count > 0:
-                    self.stdout.write(f"{name} - {count} expired items:")
-                    for drug in expired:
-                        self.stdout.write(f"  - {drug.name} (ID: {drug.id}) - stock: {drug.stock} (would be set to 0)")
-                else:
-                    self.stdout.write(f"{name} - No expired items with stock")
-            
-            self.stdout.write("")
-            self.stdout.write(self.style.WARNING(f"DRY RUN: Would update {total_expired} items"))
-            return
-        
-        # Run the actual check
-        count, items = DrugService.check_expired_items()
-        
-        if count == 0:
+
+        if summary['drug_count'] == 0:
             self.stdout.write(self.style.SUCCESS('No expired items found.'))
-            return
-        
-        self.stdout.write(self.style.SUCCESS(f'Successfully updated {count} expired item(s):'))
-        for item in items:
-            self.stdout.write(f'  - {item["name"]} ({item["type"]}): stock reduced from {item["old_stock"]} to 0 (expired: {item["exp_date"]})')
+        elif dry_run:
+            self.stdout.write(self.style.WARNING(f"DRY RUN: Would update {summary['drug_count']} items"))
+        else:
+            self.stdout.write(self.style.SUCCESS(
+                f"Successfully wrote off {summary['quantity']} expired unit(s) "
+                f"from {summary['drug_count']} item(s) in {summary['movements']} batch(es)."
+            ))
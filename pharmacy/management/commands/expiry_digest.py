@@ -0,0 +1,74 @@
+from django.conf import settings
+from django.core.mail import send_mail
+from django.core.management.base import BaseCommand, CommandError
+from pharmacy.services import ExpiryForecastService
+
+
+class Command(BaseCommand):
+    help = (
+        'Summarise stock expiring within the forecast windows and optionally email it. '
+        'Schedule this daily (e.g. from cron) after check_expired_items.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--email',
+            action='append',
+            default=[],
+            help='Recipient address (repeatable). Defaults to settings.EXPIRY_DIGEST_RECIPIENTS',
+        )
+        parser.add_argument(
+            '--items',
+            type=int,
+            default=20,
+            help='Number of soonest-expiring items to list (default 20)',
+        )
+
+    def handle(self, *args, **options):
+        if options['items'] < 0:
+            raise CommandError('--items cannot be negative')
+
+        report = ExpiryForecastService.report()
+        body = self.render(report, options['items'])
+        self.stdout.write(body)
+
+        recipients = options['email'] or list(getattr(settings, 'EXPIRY_DIGEST_RECIPIENTS', []))
+        if not recipients:
+            return
+
+        longest = report['totals'][report['windows'][-1]]
+        subject = (
+            f"NEOPHARM expiry digest {report['date']:%Y-%m-%d}: "
+            f"{longest['count']} item(s) within {report['windows'][-1]} days"
+        )
+        try:
+            send_mail(subject, body, None, recipients)
+        except Exception as e:
+            raise CommandError(f'Could not send digest: {e}')
+        self.stdout.write(self.style.SUCCESS(f"Digest sent to {', '.join(recipients)}"))
+
+    def render(self, report, item_limit):
+        lines = [f"Expiring stock as of {report['date']:%Y-%m-%d}", '']
+        for window in report['windows']:
+            totals = report['totals'][window]
+            lines.append(
+                f"Within {window} days: {totals['count']} item(s), "
+                f"{totals['quantity']} units, value {totals['value']:,.2f}"
+            )
+            for category, buckets in report['categories'].items():
+                bucket = buckets[window]
+                lines.append(
+                    f"  - {category}: {bucket['count']} item(s), "
+                    f"{bucket['quantity']} units, value {bucket['value']:,.2f}"
+                )
+
+        items = report['items'][:item_limit]
+        if items:
+            lines += ['', 'Soonest to expire:']
+            for item in items:
+                lines.append(
+                    f"  - {item['name']} ({item['category']}, ID: {item['id']}): "
+                    f"{item['stock']} {item['unit']} expires {item['exp_date']:%Y-%m-%d} "
+                    f"({item['days_left']} days)"
+                )
+        return '\n'.join(lines)
@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand, CommandError
+from pharmacy.services import InventoryImportService, InventoryImportError
+
+
+class Command(BaseCommand):
+    help = 'Bulk import drugs from a CSV file, updating drugs that already exist'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV file with category, name, brand, unit, cost, markup, stock and exp_date columns')
+        parser.add_argument(
+            '--replace-stock',
+            action='store_true',
+            help='Overwrite stock levels instead of adding to them',
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=InventoryImportService.CHUNK_SIZE,
+            help=f'Rows written per transaction (default {InventoryImportService.CHUNK_SIZE})',
+        )
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be at least 1')
+
+        def report(summary):
+            self.stdout.write(
+                f"  {summary['processed']} rows read: {summary['created']} created, "
+                f"{summary['updated']} updated, {len(summary['errors'])} skipped"
+            )
+
+        try:
+            with open(options['path'], newline='', encoding='utf-8-sig') as f:
+                summary = InventoryImportService.import_csv(
+                    f,
+                    replace_stock=options['replace_stock'],
+                    chunk_size=options['chunk_size'],
+                    progress=report,
+                )
+        except OSError as e:
+            raise CommandError(f'Cannot read {options["path"]}: {e}')
+        except (InventoryImportError, UnicodeDecodeError) as e:
+            raise CommandError(str(e))
+
+        for line_number, message in summary['errors']:
+            self.stdout.write(self.style.WARNING(f'  line {line_number}: {message}'))
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {summary['created']} new and {summary['updated']} existing drug(s)."
+        ))
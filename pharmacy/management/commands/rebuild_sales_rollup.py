@@ -0,0 +1,42 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+from pharmacy.services import JobQueueService, SalesRollupService
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the daily sales rollup table from dispensed form items'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--start',
+            help='First day to rebuild (YYYY-MM-DD). Defaults to the earliest form.',
+        )
+        parser.add_argument(
+            '--end',
+            help='Last day to rebuild (YYYY-MM-DD). Defaults to the latest form.',
+        )
+        parser.add_argument(
+            '--background',
+            action='store_true',
+            help='Queue the rebuild for the job worker (manage.py run_worker) instead of running it here',
+        )
+
+    def handle(self, *args, **options):
+        try:
+            start = date.fromisoformat(options['start']) if options['start'] else None
+            end = date.fromisoformat(options['end']) if options['end'] else None
+        except ValueError as e:
+            raise CommandError(f'Invalid date: {e}')
+
+        if start and end and start > end:
+            raise CommandError('--start must not be after --end')
+
+        period = f' from {start or "the beginning"} to {end or "today"}' if start or end else ''
+        if options['background']:
+            job = JobQueueService.enqueue('rebuild_rollup', {'start': options['start'], 'end': options['end']})
+            self.stdout.write(self.style.SUCCESS(f'Queued rollup rebuild{period} as job #{job.pk}.'))
+            return
+
+        count = SalesRollupService.rebuild(start=start, end=end)
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {count} rollup row(s){period}.'))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from pharmacy.db import categories_split
+from pharmacy.services import StockJournalService
+
+
+class Command(BaseCommand):
+    help = (
+        'With per-category database files (CATEGORY_DATABASES), finish or undo cart '
+        'changes a crash left committed in one file but not the other. The job worker '
+        'runs this every 5 minutes; changes younger than STOCK_JOURNAL_GRACE_SECONDS '
+        'are left to the request still making them.'
+    )
+
+    def handle(self, *args, **options):
+        if not categories_split():
+            self.stdout.write('Categories share one database; nothing to reconcile.')
+            return
+        summary = StockJournalService.reconcile()
+        self.stdout.write(self.style.SUCCESS(
+            f"Applied {summary['released']} release(s), put back {summary['rolled_back']} take(s), "
+            f"cleared {summary['completed']} completed take(s)."
+        ))
@@ -0,0 +1,66 @@
+from django.core.management.base import BaseCommand, CommandError
+from pharmacy.services import OfflineReplayService, OfflineReplayError
+
+
+class Command(BaseCommand):
+    help = (
+        'Replay queued offline transactions (add to cart, remove from cart, checkout). '
+        'Schedule this every few minutes; failures are retried with backoff and adds queued '
+        'against an outdated drug version are resolved by OFFLINE_REPLAY_CONFLICT_POLICY.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=OfflineReplayService.CHUNK_SIZE,
+            help=f'Transactions claimed and recorded per chunk (default {OfflineReplayService.CHUNK_SIZE})',
+        )
+        parser.add_argument(
+            '--limit',
+            type=int,
+            help='Stop after this many transactions',
+        )
+        parser.add_argument(
+            '--worker',
+            help='Name recorded on claimed transactions (default: host and process id). '
+                 'Several workers may run at once.',
+        )
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be at least 1')
+        if options['limit'] is not None and options['limit'] < 1:
+            raise CommandError('--limit must be at least 1')
+
+        def report(summary):
+            self.stdout.write(
+                f"  chunk {summary['chunks']}: {summary['synced']} synced, "
+                f"{summary['failed']} failed, {summary['deferred']} deferred, "
+                f"{summary['clamped'] + summary['rejected'] + summary['review']} conflicts"
+            )
+
+        try:
+            summary = OfflineReplayService.run(
+                chunk_size=options['chunk_size'], limit=options['limit'], progress=report,
+                worker=options['worker'],
+            )
+        except OfflineReplayError as e:
+            raise CommandError(str(e))
+
+        if summary['chunks'] == 0:
+            self.stdout.write(self.style.SUCCESS('No offline transactions due.'))
+            return
+        if summary['quarantined']:
+            self.stdout.write(self.style.WARNING(
+                f"{summary['quarantined']} transaction(s) quarantined after repeated failures"
+            ))
+        if summary['clamped'] or summary['rejected'] or summary['review']:
+            self.stdout.write(self.style.WARNING(
+                f"Version conflicts: {summary['clamped']} clamped to stock, "
+                f"{summary['rejected']} rejected, {summary['review']} held for review"
+            ))
+        self.stdout.write(self.style.SUCCESS(
+            f"Replayed {summary['synced']} transaction(s); "
+            f"{summary['failed'] + summary['deferred']} will be retried or need review."
+        ))
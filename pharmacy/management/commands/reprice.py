@@ -0,0 +1,53 @@
+from django.core.management.base import BaseCommand, CommandError
+from pharmacy.services import RepricingService, RepricingError
+
+
+class Command(BaseCommand):
+    help = 'Move a store from one markup tier to another and recompute prices in a single UPDATE'
+
+    def add_arguments(self, parser):
+        parser.add_argument('category', choices=['lpacemaker', 'ncap', 'oncology'])
+        parser.add_argument(
+            '--tier',
+            action='append',
+            default=[],
+            metavar='OLD:NEW',
+            help='Markup change, e.g. 10:15 (repeatable). Without --tier every price is recomputed at its current markup',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Show the price changes without writing them',
+        )
+
+    def handle(self, *args, **options):
+        tiers = None
+        if options['tier']:
+            tiers = {}
+            for tier in options['tier']:
+                old, sep, new = tier.partition(':')
+                if not sep:
+                    raise CommandError(f"Invalid tier '{tier}', expected OLD:NEW")
+                tiers[old] = new
+
+        try:
+            summary = RepricingService.reprice(options['category'], tiers=tiers, dry_run=options['dry_run'])
+        except RepricingError as e:
+            raise CommandError(str(e))
+
+        if options['dry_run']:
+            self.stdout.write("DRY RUN - No changes will be made")
+        for change in summary['changes']:
+            self.stdout.write(
+                f"  - {change['name']} (ID: {change['id']}): markup {change['markup']}% -> {change['new_markup']}%, "
+                f"price {change['price']} -> {change['new_price']}"
+            )
+
+        if summary['changed'] == 0:
+            self.stdout.write(self.style.SUCCESS('No prices to change.'))
+        elif options['dry_run']:
+            self.stdout.write(self.style.WARNING(f"DRY RUN: Would reprice {summary['changed']} item(s)"))
+        else:
+            self.stdout.write(self.style.SUCCESS(
+                f"Repriced {summary['changed']} item(s) (price history batch {summary['batch']})."
+            ))
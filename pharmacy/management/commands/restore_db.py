@@ -0,0 +1,68 @@
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from pharmacy.db import BackupError, backup_directory, list_backups, read_backup_manifest, restore_backup
+
+
+class Command(BaseCommand):
+    help = (
+        'Replace the database files with a snapshot written by backup_db, after '
+        'checking its checksums. Stop the web server and workers first. Without a '
+        'snapshot name, lists the snapshots available.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'snapshot',
+            nargs='?',
+            help='Snapshot name (e.g. 20260101T010000Z), "latest", or a path to a snapshot directory',
+        )
+        parser.add_argument(
+            '--noinput',
+            '--no-input',
+            action='store_false',
+            dest='interactive',
+            help='Do not ask for confirmation',
+        )
+        parser.add_argument(
+            '--dir',
+            default=None,
+            help='Directory holding the snapshots (default BACKUP_DIR)',
+        )
+
+    def handle(self, *args, **options):
+        directory = Path(options['dir'] or backup_directory())
+        snapshots = list_backups(directory)
+        if not options['snapshot']:
+            if not snapshots:
+                self.stdout.write(f'No snapshots in {directory}.')
+            for path in snapshots:
+                databases = read_backup_manifest(path)['databases']
+                size = sum(figures['compressed_bytes'] for figures in databases.values())
+                self.stdout.write(f"  {path.name}  {', '.join(databases)}  {size / 1024 ** 2:.1f} MB")
+            return
+
+        if options['snapshot'] == 'latest':
+            if not snapshots:
+                raise CommandError(f'No snapshots in {directory}')
+            snapshot = snapshots[-1]
+        else:
+            snapshot = Path(options['snapshot'])
+            if not snapshot.is_dir():
+                snapshot = directory / options['snapshot']
+        if options['interactive']:
+            answer = input(
+                f'This replaces the current data with the snapshot {snapshot.name}; '
+                f'changes made since it was taken are lost. Type "yes" to continue: '
+            )
+            if answer != 'yes':
+                raise CommandError('Restore cancelled.')
+
+        try:
+            restored = restore_backup(snapshot)
+        except BackupError as exc:
+            raise CommandError(str(exc))
+        for alias, figures in restored.items():
+            rate = figures['pages'] / figures['seconds'] if figures['seconds'] else 0
+            self.stdout.write(f"  {alias}: {figures['pages']} pages in {figures['seconds']:.2f}s ({rate:.0f} pages/s)")
+        self.stdout.write(self.style.SUCCESS(f'Restored the snapshot {snapshot.name}.'))
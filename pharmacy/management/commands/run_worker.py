@@ -0,0 +1,64 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from pharmacy.services import JobQueueService, worker_name
+
+
+class Command(BaseCommand):
+    help = (
+        'Run background jobs queued in the database and enqueue the scheduled ones '
+        '(expiry write-off, expiry digest, offline replay, reporting snapshot, nightly backup). No broker is needed; '
+        'run one or more workers alongside the web server.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Enqueue the scheduled jobs, run everything due and exit (for cron or testing)',
+        )
+        parser.add_argument(
+            '--poll',
+            type=float,
+            default=5,
+            help='Seconds to wait when no job is due (default 5)',
+        )
+        parser.add_argument(
+            '--no-schedule',
+            action='store_true',
+            help='Only run queued jobs; do not enqueue the periodic ones',
+        )
+        parser.add_argument(
+            '--worker',
+            help='Name recorded on claimed jobs (default: host and process id)',
+        )
+
+    def handle(self, *args, **options):
+        if options['poll'] <= 0:
+            raise CommandError('--poll must be positive')
+        worker = options['worker'] or worker_name()
+
+        def report(job, outcome, seconds):
+            line = f"  {job.payload.get('command', job.name)} #{job.pk}: {outcome} in {seconds:.1f}s"
+            if outcome == 'done':
+                self.stdout.write(line)
+            else:
+                self.stdout.write(self.style.WARNING(f'{line} (attempt {job.attempts} of {job.max_attempts})'))
+
+        self.stdout.write(f'Worker {worker} started.')
+        try:
+            while True:
+                if not options['no_schedule']:
+                    JobQueueService.enqueue_due()
+                summary = JobQueueService.run_pending(worker, progress=report)
+                if options['once']:
+                    break
+                if not any(summary.values()):
+                    time.sleep(options['poll'])
+        except KeyboardInterrupt:
+            self.stdout.write('Stopping.')
+            return
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Ran {summary['done']} job(s); {summary['retry']} will be retried, {summary['dead']} dead."
+        ))
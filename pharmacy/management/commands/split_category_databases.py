@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, connections
+from pharmacy.db import CATEGORY_DRUG_MODELS, categories_split, split_category_files
+
+
+class Command(BaseCommand):
+    help = (
+        'Move each drug category (catalog, stock lots, stock movements) out of the '
+        'main database into its own file, for CATEGORY_DATABASES=True. Stop the '
+        'web server and workers first.'
+    )
+
+    def handle(self, *args, **options):
+        from pharmacy.services import DrugService
+
+        if not categories_split():
+            raise CommandError('Set CATEGORY_DATABASES=True first; the category databases are not configured')
+        for category in CATEGORY_DRUG_MODELS:
+            try:
+                existing = DrugService.get_drug_model(category).objects.using(category).exists()
+            except DatabaseError:
+                existing = False  # no schema yet
+            if existing:
+                raise CommandError(f'The {category} database already holds drugs; it has been split before')
+
+        targets = {category: str(connections[category].settings_dict['NAME']) for category in CATEGORY_DRUG_MODELS}
+        for alias in ['default', *targets]:
+            connections[alias].close()
+        split_category_files(str(connections['default'].settings_dict['NAME']), targets)
+        for category, path in targets.items():
+            self.stdout.write(f'  {category}: {path}')
+        self.stdout.write(self.style.SUCCESS('Drug categories moved to their own database files.'))
@@ -0,0 +1,17 @@
+# Generated by Django 5.1.7 on 2026-10-19 12:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacy', '0013_lpacemakerdrugs_created_at_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='form',
+            index=models.Index(fields=['-date', '-id'], name='form_date_id_idx'),
+        ),
+    ]
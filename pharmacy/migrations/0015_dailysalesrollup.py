@@ -0,0 +1,67 @@
+# Generated by Django 5.1.7 on 2026-10-19 12:32
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate, Upper
+
+
+def backfill_rollups(apps, schema_editor):
+    FormItem = apps.get_model('pharmacy', 'FormItem')
+    DailySalesRollup = apps.get_model('pharmacy', 'DailySalesRollup')
+    db_alias = schema_editor.connection.alias
+    rows = (
+        FormItem.objects.using(db_alias).annotate(day=TruncDate('form__date'), category=Upper('drug_type'))
+        .values('day', 'category', 'form__dispensed_by')
+        .annotate(
+            form_count=Count('form', distinct=True),
+            line_count=Count('id'),
+            quantity=Sum('quantity'),
+            revenue=Sum('subtotal'),
+        )
+        .order_by()
+    )
+    DailySalesRollup.objects.using(db_alias).bulk_create(
+        [
+            DailySalesRollup(
+                day=row['day'],
+                drug_type=row['category'],
+                dispensed_by_id=row['form__dispensed_by'],
+                form_count=row['form_count'],
+                line_count=row['line_count'],
+                quantity=row['quantity'] or 0,
+                revenue=row['revenue'] or 0,
+            )
+            for row in rows
+        ],
+        batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacy', '0014_form_date_id_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailySalesRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('drug_type', models.CharField(max_length=50)),
+                ('form_count', models.IntegerField(default=0)),
+                ('line_count', models.IntegerField(default=0)),
+                ('quantity', models.IntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('dispensed_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-day', 'drug_type'],
+                'constraints': [models.UniqueConstraint(fields=('day', 'drug_type', 'dispensed_by'), name='unique_daily_sales_rollup')],
+            },
+        ),
+        migrations.RunPython(backfill_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 5.1.7 on 2026-10-19 12:34
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate, Upper
+
+
+def backfill_drug_rollups(apps, schema_editor):
+    FormItem = apps.get_model('pharmacy', 'FormItem')
+    DailyDrugSalesRollup = apps.get_model('pharmacy', 'DailyDrugSalesRollup')
+    db_alias = schema_editor.connection.alias
+    rows = (
+        FormItem.objects.using(db_alias).annotate(day=TruncDate('form__date'), category=Upper('drug_type'))
+        .values('day', 'category', 'drug_name')
+        .annotate(line_count=Count('id'), quantity=Sum('quantity'), revenue=Sum('subtotal'))
+        .order_by()
+    )
+    DailyDrugSalesRollup.objects.using(db_alias).bulk_create(
+        [
+            DailyDrugSalesRollup(
+                day=row['day'],
+                drug_type=row['category'],
+                drug_name=row['drug_name'],
+                line_count=row['line_count'],
+                quantity=row['quantity'] or 0,
+                revenue=row['revenue'] or 0,
+            )
+            for row in rows
+        ],
+        batch_size=500,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacy', '0015_dailysalesrollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyDrugSalesRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('drug_type', models.CharField(max_length=50)),
+                ('drug_name', models.CharField(max_length=255)),
+                ('line_count', models.IntegerField(default=0)),
+                ('quantity', models.IntegerField(default=0)),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+            ],
+            options={
+                'ordering': ['-day', 'drug_type', 'drug_name'],
+                'constraints': [models.UniqueConstraint(fields=('day', 'drug_type', 'drug_name'), name='unique_daily_drug_sales_rollup')],
+            },
+        ),
+        migrations.RunPython(backfill_drug_rollups, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.7 on 2026-10-19 12:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('pharmacy', '0016_dailydrugsalesrollup'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='profile',
+            name='user_type',
+            field=models.CharField(blank=True, choices=[('Admin', 'Admin'), ('Pharmacist', 'Pharmacist'), ('Pharm-Tech', 'Pharm-Tech')], db_index=True, max_length=200, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['username'], name='user_username_idx'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.1.7 on 2026-10-19 12:45
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacy', '0017_user_search_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReceiptDocument',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('variant', models.CharField(choices=[('html', 'HTML'), ('print', 'Print')], default='html', max_length=10)),
+                ('content_hash', models.CharField(max_length=64)),
+                ('body', models.BinaryField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('form', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='receipt_documents', to='pharmacy.form')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('form', 'variant'), name='unique_receipt_document')],
+            },
+        ),
+    ]
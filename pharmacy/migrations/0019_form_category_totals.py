@@ -0,0 +1,54 @@
+# Generated by Django 5.1.7 on 2026-10-19 12:46
+
+from decimal import Decimal
+
+from django.db import migrations, models
+from django.db.models import DecimalField, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+
+def backfill_category_totals(apps, schema_editor):
+    Form = apps.get_model('pharmacy', 'Form')
+    FormItem = apps.get_model('pharmacy', 'FormItem')
+
+    def items_total(category):
+        items = (
+            FormItem.objects.filter(form=OuterRef('pk'), drug_type__iexact=category)
+            .order_by()
+            .values('form')
+            .annotate(total=Sum('subtotal'))
+            .values('total')
+        )
+        return Coalesce(Subquery(items), Value(Decimal('0')), output_field=DecimalField(max_digits=10, decimal_places=2))
+
+    Form.objects.using(schema_editor.connection.alias).update(
+        lpacemaker_total=items_total('LPACEMAKER'),
+        ncap_total=items_total('NCAP'),
+        oncology_total=items_total('ONCOLOGY'),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacy', '0018_receiptdocument'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='form',
+            name='lpacemaker_total',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=10),
+        ),
+        migrations.AddField(
+            model_name='form',
+            name='ncap_total',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=10),
+        ),
+        migrations.AddField(
+            model_name='form',
+            name='oncology_total',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=10),
+        ),
+        migrations.RunPython(backfill_category_totals, migrations.RunPython.noop),
+    ]
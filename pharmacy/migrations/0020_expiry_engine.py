@@ -0,0 +1,51 @@
+# Generated by Django 5.1.7 on 2026-10-19 12:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacy', '0019_form_category_totals'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProcessingWatermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('value', models.DateField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='StockMovement',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('expiry', 'Expiry write-off')], max_length=20)),
+                ('drug_type', models.CharField(max_length=50)),
+                ('drug_count', models.IntegerField(default=0)),
+                ('quantity', models.IntegerField(default=0)),
+                ('window_start', models.DateField(blank=True, null=True)),
+                ('window_end', models.DateField(blank=True, null=True)),
+                ('details', models.JSONField(blank=True, default=list)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='lpacemakerdrugs',
+            index=models.Index(fields=['exp_date'], name='lpacemaker_exp_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ncapdrugs',
+            index=models.Index(fields=['exp_date'], name='ncap_exp_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='oncologypharmacy',
+            index=models.Index(fields=['exp_date'], name='oncology_exp_date_idx'),
+        ),
+    ]
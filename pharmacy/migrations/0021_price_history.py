@@ -0,0 +1,36 @@
+# Generated by Django 5.1.7 on 2026-10-19 12:51
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacy', '0020_expiry_engine'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PriceChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('batch', models.CharField(db_index=True, max_length=32)),
+                ('drug_type', models.CharField(max_length=50)),
+                ('drug_id', models.PositiveIntegerField()),
+                ('drug_name', models.CharField(max_length=200)),
+                ('cost', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('old_markup', models.CharField(max_length=10)),
+                ('new_markup', models.CharField(max_length=10)),
+                ('old_price', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('new_price', models.DecimalField(decimal_places=2, max_digits=12)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('changed_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-created_at'],
+                'indexes': [models.Index(fields=['drug_type', 'drug_id'], name='pricechange_drug_idx')],
+            },
+        ),
+    ]
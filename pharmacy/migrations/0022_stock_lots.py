@@ -0,0 +1,56 @@
+# Generated by Django 5.1.7 on 2026-10-19 12:55
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def create_opening_lots(apps, schema_editor):
+    """One lot per drug holding its current stock and expiry"""
+    StockLot = apps.get_model('pharmacy', 'StockLot')
+    db_alias = schema_editor.connection.alias
+    for model_name, field in (
+        ('LpacemakerDrugs', 'lpacemaker_drug'),
+        ('NcapDrugs', 'ncap_drug'),
+        ('OncologyPharmacy', 'oncology_drug'),
+    ):
+        drugs = apps.get_model('pharmacy', model_name).objects.using(db_alias).filter(stock__gt=0)
+        StockLot.objects.using(db_alias).bulk_create(
+            (
+                StockLot(**{field + '_id': drug_id}, exp_date=exp_date, quantity=stock)
+                for drug_id, exp_date, stock in drugs.values_list('id', 'exp_date', 'stock').iterator()
+            ),
+            batch_size=500,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacy', '0021_price_history'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cart',
+            name='lot_allocations',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.CreateModel(
+            name='StockLot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('lot_number', models.CharField(blank=True, default='', max_length=100)),
+                ('exp_date', models.DateField(blank=True, null=True)),
+                ('quantity', models.PositiveIntegerField(default=0)),
+                ('received_at', models.DateTimeField(auto_now_add=True)),
+                ('lpacemaker_drug', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='lots', to='pharmacy.lpacemakerdrugs')),
+                ('ncap_drug', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='lots', to='pharmacy.ncapdrugs')),
+                ('oncology_drug', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='lots', to='pharmacy.oncologypharmacy')),
+            ],
+            options={
+                'ordering': ('exp_date', 'id'),
+                'indexes': [models.Index(fields=['lpacemaker_drug', 'exp_date'], name='stocklot_lpacemaker_exp_idx'), models.Index(fields=['ncap_drug', 'exp_date'], name='stocklot_ncap_exp_idx'), models.Index(fields=['oncology_drug', 'exp_date'], name='stocklot_oncology_exp_idx'), models.Index(fields=['exp_date'], name='stocklot_exp_date_idx')],
+            },
+        ),
+        migrations.RunPython(create_opening_lots, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.1.7 on 2026-10-19 12:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacy', '0022_stock_lots'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='offlinetransaction',
+            name='last_error',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='offlinetransaction',
+            name='next_attempt_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='offlinetransaction',
+            name='processed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='offlinetransaction',
+            name='quarantined',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddIndex(
+            model_name='offlinetransaction',
+            index=models.Index(fields=['synced', 'quarantined', 'created_at'], name='offline_pending_idx'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.1.7 on 2026-10-19 13:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacy', '0023_offline_replay'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='offlinetransaction',
+            name='client_id',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='offlinetransaction',
+            name='sequence',
+            field=models.PositiveBigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddConstraint(
+            model_name='offlinetransaction',
+            constraint=models.UniqueConstraint(fields=('client_id', 'sequence'), name='offline_client_sequence_uniq'),
+        ),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 5.1.7 on 2026-10-19 13:01
+
+from django.db import migrations, models
+from django.db.models import Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+
+def backfill_updated_at(apps, schema_editor):
+    """Delta sync pages by updated_at, so every drug needs one"""
+    now = timezone.now()
+    for model_name in ('LpacemakerDrugs', 'NcapDrugs', 'OncologyPharmacy'):
+        apps.get_model('pharmacy', model_name).objects.using(schema_editor.connection.alias).filter(updated_at__isnull=True).update(
+            updated_at=Coalesce('created_at', Value(now))
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacy', '0024_offline_client_sequence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogTombstone',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('drug_type', models.CharField(max_length=50)),
+                ('drug_id', models.PositiveIntegerField()),
+                ('deleted_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='lpacemakerdrugs',
+            index=models.Index(fields=['updated_at', 'id'], name='lpacemaker_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ncapdrugs',
+            index=models.Index(fields=['updated_at', 'id'], name='ncap_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='oncologypharmacy',
+            index=models.Index(fields=['updated_at', 'id'], name='oncology_updated_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='catalogtombstone',
+            index=models.Index(fields=['drug_type', 'id'], name='tombstone_type_idx'),
+        ),
+        migrations.RunPython(backfill_updated_at, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.1.7 on 2026-10-19 13:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacy', '0025_catalog_delta_sync'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lpacemakerdrugs',
+            name='version',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='ncapdrugs',
+            name='version',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='offlinetransaction',
+            name='conflict',
+            field=models.CharField(blank=True, choices=[('REJECTED', 'Rejected'), ('CLAMPED', 'Clamped to stock'), ('REVIEW', 'Held for review')], default='', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='oncologypharmacy',
+            name='version',
+            field=models.PositiveIntegerField(default=1),
+        ),
+    ]
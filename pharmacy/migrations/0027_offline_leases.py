@@ -0,0 +1,27 @@
+# Generated by Django 5.1.7 on 2026-10-19 13:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacy', '0026_offline_conflicts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='offlinetransaction',
+            name='claimed_by',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='offlinetransaction',
+            name='lease_expires',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='offlinetransaction',
+            index=models.Index(fields=['synced', 'lease_expires'], name='offline_lease_idx'),
+        ),
+    ]
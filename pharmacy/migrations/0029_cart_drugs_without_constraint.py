@@ -0,0 +1,29 @@
+# Generated by Django 5.1.7 on 2026-10-19 13:45
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacy', '0028_job_queue'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='cart',
+            name='lpacemaker_drug',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.CASCADE, to='pharmacy.lpacemakerdrugs'),
+        ),
+        migrations.AlterField(
+            model_name='cart',
+            name='ncap_drug',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.CASCADE, to='pharmacy.ncapdrugs'),
+        ),
+        migrations.AlterField(
+            model_name='cart',
+            name='oncology_drug',
+            field=models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.CASCADE, to='pharmacy.oncologypharmacy'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.7 on 2026-10-19 14:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacy', '0030_user_username_lower_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='form',
+            name='receipt_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='receiptdocument',
+            name='form_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.1.7 on 2026-10-19 14:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacy', '0031_receipt_versions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockJournal',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('action', models.CharField(choices=[('TAKE', 'Take for a cart line'), ('RELEASE', 'Release from cart lines')], max_length=10)),
+                ('drug_type', models.CharField(max_length=50)),
+                ('marker', models.BigIntegerField(blank=True, null=True)),
+                ('entries', models.JSONField(blank=True, default=list)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['created_at'],
+            },
+        ),
+        migrations.AlterField(
+            model_name='stockmovement',
+            name='kind',
+            field=models.CharField(choices=[('expiry', 'Expiry write-off'), ('journal', 'Cart change (journaled)')], max_length=20),
+        ),
+    ]
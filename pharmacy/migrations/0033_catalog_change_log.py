@@ -0,0 +1,53 @@
+# Generated by Django 5.1.7 on 2026-10-19 14:52
+
+from django.db import migrations, models
+
+
+def backfill_catalog_changes(apps, schema_editor):
+    """
+    Log past deletions and then every drug, oldest change first, so clients
+    whose old cursors no longer decode start over with a complete catalog
+    """
+    alias = schema_editor.connection.alias
+    CatalogChange = apps.get_model('pharmacy', 'CatalogChange')
+    CatalogTombstone = apps.get_model('pharmacy', 'CatalogTombstone')
+    changes = [
+        CatalogChange(drug_type=drug_type, drug_id=drug_id)
+        for drug_type, drug_id in CatalogTombstone.objects.using(alias).order_by('id').values_list('drug_type', 'drug_id')
+    ]
+    for drug_type, model_name in (('LPACEMAKER', 'LpacemakerDrugs'), ('NCAP', 'NcapDrugs'), ('ONCOLOGY', 'OncologyPharmacy')):
+        drugs = apps.get_model('pharmacy', model_name).objects.using(alias).order_by('updated_at', 'id')
+        changes += [CatalogChange(drug_type=drug_type, drug_id=drug_id) for drug_id in drugs.values_list('id', flat=True)]
+    CatalogChange.objects.using(alias).bulk_create(changes, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pharmacy', '0032_stock_journal'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CatalogChange',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('drug_type', models.CharField(max_length=50)),
+                ('drug_id', models.PositiveIntegerField()),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='catalogchange',
+            index=models.Index(fields=['drug_type', 'id'], name='catalogchange_type_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='catalogchange',
+            index=models.Index(fields=['drug_type', 'drug_id'], name='catalogchange_drug_idx'),
+        ),
+        # The triggers that keep the log are installed after migrate
+        # (pharmacy.db.install_catalog_triggers)
+        migrations.RunPython(backfill_catalog_changes, migrations.RunPython.noop),
+        migrations.DeleteModel(
+            name='CatalogTombstone',
+        ),
+    ]
@@ -1,12 +1,14 @@
-from django.db import models
+from django.db import DEFAULT_DB_ALIAS, models
 from django.dispatch import receiver
 from django.utils import timezone
 from django.utils.timezone import now
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
+from django.db.models.functions import Lower
+from django.core.cache import cache
 from django.contrib.auth.models import AbstractUser, Group, Permission
 from shortuuid.django_fields import ShortUUIDField
 from datetime import datetime
-from decimal import Decimal
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 from django.conf import settings
 import json
 from django.core.serializers.json import DjangoJSONEncoder
@@ -57,6 +59,9 @@ USER_TYPE = [
     ('Pharm-Tech', 'Pharm-Tech'),
 ]
 
+# Cached dashboard user statistics, dropped whenever users, profiles or groups change
+USER_STATS_CACHE_KEY = 'dashboard:user-stats'
+
 # Create your models here.
 class User(AbstractUser):
     groups = models.ManyToManyField(Group, related_name="pharmacy_user_groups", blank=True)
@@ -67,6 +72,13 @@ class User(AbstractUser):
     USERNAME_FIELD = 'mobile'
     REQUIRED_FIELDS = ['username']
 
+    class Meta(AbstractUser.Meta):
+        indexes = [
+            # Case-insensitive prefix search on the admin user list, queried
+            # as a range on LOWER(username); mobile is already unique
+            models.Index(Lower('username'), name='user_username_lower_idx'),
+        ]
+
     def __str__(self):
         return self.username if self.username else self.mobile
 
@@ -83,8 +95,15 @@ def create_user_profile(sender, instance, created, **kwargs):
         Profile.objects.create(user=instance)
 
 
+def _login_only(update_fields):
+    """True for the save that only records last_login, which every login makes"""
+    return update_fields is not None and set(update_fields) == {'last_login'}
+
+
 @receiver(post_save, sender=User)
-def save_user_profile(sender, instance, **kwargs):
+def save_user_profile(sender, instance, update_fields=None, **kwargs):
+    if _login_only(update_fields):
+        return
     instance.profile.save()
 
 
@@ -92,12 +111,24 @@ class Profile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     # image = models.ImageField(upload_to='uploads/images/', blank=True, null=True)
     full_name = models.CharField(max_length=200, blank=True, null=True)
-    user_type = models.CharField(max_length=200, choices=USER_TYPE, blank=True, null=True)
+    user_type = models.CharField(max_length=200, choices=USER_TYPE, blank=True, null=True, db_index=True)
 
     def __str__(self):
         return f'{self.user.username} {self.user_type}'
 
 
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+@receiver(post_save, sender=Profile)
+@receiver(post_delete, sender=Profile)
+@receiver(post_save, sender=Group)
+@receiver(post_delete, sender=Group)
+def invalidate_user_stats(sender, update_fields=None, **kwargs):
+    if sender is User and _login_only(update_fields):
+        return
+    cache.delete(USER_STATS_CACHE_KEY)
+
+
 MARKUP_CHOICES = [
     ('5', '5%'),
     ('10', '10%'),
@@ -121,6 +152,15 @@ MARKUP_CHOICES = [
 ]
 
 
+def markup_price(cost, markup):
+    """
+    Selling price for `cost` at `markup` percent, rounded half-up to kobo in
+    exact Decimal arithmetic. RepricingService computes the same value in SQL.
+    """
+    cost = Decimal(str(cost))
+    return (cost * (Decimal('100') + Decimal(str(markup))) / Decimal('100')).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+
+
 class LpacemakerDrugs(models.Model):
     name = models.CharField(max_length=200)
     dosage_form = models.CharField(max_length=200, choices=DOSAGE_FORM, blank=True, null=True)
@@ -133,21 +173,26 @@ class LpacemakerDrugs(models.Model):
     exp_date = models.DateField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True, null=True, blank=True)
     updated_at = models.DateTimeField(auto_now=True, null=True, blank=True)
+    # Bumped by StockLotService on every stock change; offline transactions
+    # carry the version they were queued against
+    version = models.PositiveIntegerField(default=1)
 
     class Meta:
         ordering = ('name',)
+        indexes = [
+            models.Index(fields=['exp_date'], name='lpacemaker_exp_date_idx'),
+            models.Index(fields=['updated_at', 'id'], name='lpacemaker_updated_idx'),
+        ]
 
     def save(self, *args, **kwargs):
-        # Check if item has expired and zero out stock if so
-        if self.exp_date and self.exp_date < timezone.now().date():
-            self.stock = 0
+        # Expired stock is zeroed by the scheduled ExpiryService job
+        # (manage.py check_expired_items), not on every save
         
         # Auto-calculate price if cost and markup are set
         if self.cost and self.markup:
             try:
-                markup_percent = float(self.markup)
-                self.price = self.cost * (1 + (markup_percent / 100))
-            except (ValueError, TypeError):
+                self.price = markup_price(self.cost, self.markup)
+            except (InvalidOperation, ValueError, TypeError):
                 pass
         super().save(*args, **kwargs)
 
@@ -186,24 +231,48 @@ class NcapDrugs(models.Model):
     exp_date = models.DateField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True, null=True, blank=True)
     updated_at = models.DateTimeField(auto_now=True, null=True, blank=True)
+    # Bumped by StockLotService on every stock change; offline transactions
+    # carry the version they were queued against
+    version = models.PositiveIntegerField(default=1)
 
     class Meta:
         ordering = ('name',)
+        indexes = [
+            models.Index(fields=['exp_date'], name='ncap_exp_date_idx'),
+            models.Index(fields=['updated_at', 'id'], name='ncap_updated_idx'),
+        ]
 
     def save(self, *args, **kwargs):
-        # Check if item has expired and zero out stock if so
-        if self.exp_date and self.exp_date < timezone.now().date():
-            self.stock = 0
+        # Expired stock is zeroed by the scheduled ExpiryService job
+        # (manage.py check_expired_items), not on every save
         
         # Auto-calculate price if cost and markup are set
         if self.cost and self.markup:
             try:
-                markup_percent = float(self.markup)
-                self.price = self.cost * (1 + (markup_percent / 100))
-            except (ValueError, TypeError):
+                self.price = markup_price(self.cost, self.markup)
+            except (InvalidOperation, ValueError, TypeError):
                 pass
         super().save(*args, **kwargs)
 
+    def is_expired(self):
+        """Check if the item has expired based on exp_date"""
+        if not self.exp_date:
+            return False
+        return self.exp_date < timezone.now().date()
+
+    def get_expiration_status(self):
+        """Return expiration status as a string"""
+        if not self.exp_date:
+            return "No expiry date"
+        
+        if self.is_expired():
+            return f"Expired on {self.exp_date}"
+        
+        days_remaining = (self.exp_date - timezone.now().date()).days
+        if days_remaining <= 7:
+            return f"Expires soon ({days_remaining} days)"
+        return f"Valid until {self.exp_date}"
+
     def __str__(self):
         return f'{self.name} {self.brand} {self.unit} {self.price} {self.stock} {self.exp_date}'
 
@@ -220,21 +289,26 @@ class OncologyPharmacy(models.Model):
     exp_date = models.DateField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True, null=True, blank=True)
     updated_at = models.DateTimeField(auto_now=True, null=True, blank=True)
+    # Bumped by StockLotService on every stock change; offline transactions
+    # carry the version they were queued against
+    version = models.PositiveIntegerField(default=1)
 
     class Meta:
         ordering = ('name',)
+        indexes = [
+            models.Index(fields=['exp_date'], name='oncology_exp_date_idx'),
+            models.Index(fields=['updated_at', 'id'], name='oncology_updated_idx'),
+        ]
 
     def save(self, *args, **kwargs):
-        # Check if item has expired and zero out stock if so
-        if self.exp_date and self.exp_date < timezone.now().date():
-            self.stock = 0
+        # Expired stock is zeroed by the scheduled ExpiryService job
+        # (manage.py check_expired_items), not on every save
         
         # Auto-calculate price if cost and markup are set
         if self.cost and self.markup:
             try:
-                markup_percent = float(self.markup)
-                self.price = self.cost * (1 + (markup_percent / 100))
-            except (ValueError, TypeError):
+                self.price = markup_price(self.cost, self.markup)
+            except (InvalidOperation, ValueError, TypeError):
                 pass
         super().save(*args, **kwargs)
 
@@ -261,12 +335,66 @@ class OncologyPharmacy(models.Model):
         return f'{self.name} {self.brand} {self.unit} {self.price} {self.stock} {self.exp_date}'
 
 
+class CatalogChange(models.Model):
+    """
+    One insert, update or delete of a drug, written by SQLite triggers on the
+    drug tables (pharmacy.db.install_catalog_triggers) in the same
+    transaction and file as the change. SQLite has one writer at a time, so
+    ids follow commit order and catalog delta sync pages by id. Entries
+    superseded by a later one for the same drug are compacted away.
+    """
+    drug_type = models.CharField(max_length=50)  # LPACEMAKER, NCAP, ONCOLOGY
+    drug_id = models.PositiveIntegerField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['drug_type', 'id'], name='catalogchange_type_idx'),
+            models.Index(fields=['drug_type', 'drug_id'], name='catalogchange_drug_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.drug_type} #{self.drug_id} change {self.id}"
+
+
+class StockLot(models.Model):
+    """
+    One delivery (lot/batch) of a drug with its own expiry. A drug's `stock`
+    is the sum of its lots' quantities and its `exp_date` the earliest expiry
+    among lots that still hold stock; StockLotService keeps both in step.
+    """
+    lpacemaker_drug = models.ForeignKey(LpacemakerDrugs, on_delete=models.CASCADE, null=True, blank=True, related_name='lots')
+    ncap_drug = models.ForeignKey(NcapDrugs, on_delete=models.CASCADE, null=True, blank=True, related_name='lots')
+    oncology_drug = models.ForeignKey(OncologyPharmacy, on_delete=models.CASCADE, null=True, blank=True, related_name='lots')
+    lot_number = models.CharField(max_length=100, blank=True, default='')
+    exp_date = models.DateField(null=True, blank=True)
+    quantity = models.PositiveIntegerField(default=0)
+    received_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ('exp_date', 'id')
+        indexes = [
+            models.Index(fields=['lpacemaker_drug', 'exp_date'], name='stocklot_lpacemaker_exp_idx'),
+            models.Index(fields=['ncap_drug', 'exp_date'], name='stocklot_ncap_exp_idx'),
+            models.Index(fields=['oncology_drug', 'exp_date'], name='stocklot_oncology_exp_idx'),
+            models.Index(fields=['exp_date'], name='stocklot_exp_date_idx'),
+        ]
+
+    @property
+    def get_item(self):
+        return self.lpacemaker_drug or self.ncap_drug or self.oncology_drug
+
+    def __str__(self):
+        return f'{self.lot_number or "Lot"} {self.quantity} {self.exp_date}'
+
+
 class Cart(models.Model):
     user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='cart_items')
     form = models.ForeignKey('Form', on_delete=models.CASCADE, null=True, blank=True, related_name='cart_items')
-    lpacemaker_drug = models.ForeignKey(LpacemakerDrugs, on_delete=models.CASCADE, null=True, blank=True)
-    ncap_drug = models.ForeignKey(NcapDrugs, on_delete=models.CASCADE, null=True, blank=True)
-    oncology_drug = models.ForeignKey(OncologyPharmacy, on_delete=models.CASCADE, null=True, blank=True)
+    # No database constraint: with settings.CATEGORY_DATABASES the drugs are
+    # in other database files (see delete_cart_lines_of_drug)
+    lpacemaker_drug = models.ForeignKey(LpacemakerDrugs, on_delete=models.CASCADE, null=True, blank=True, db_constraint=False)
+    ncap_drug = models.ForeignKey(NcapDrugs, on_delete=models.CASCADE, null=True, blank=True, db_constraint=False)
+    oncology_drug = models.ForeignKey(OncologyPharmacy, on_delete=models.CASCADE, null=True, blank=True, db_constraint=False)
     brand = models.CharField(max_length=200, blank=True, null=True)
     dosage_form = models.CharField(max_length=200, choices=DOSAGE_FORM, blank=True, null=True)
     unit = models.CharField(max_length=200, choices=UNIT, blank=True, null=True)
@@ -274,6 +402,8 @@ class Cart(models.Model):
     price = models.DecimalField(max_digits=12, decimal_places=2, default=0)
     subtotal = models.DecimalField(max_digits=12, decimal_places=2, default=0)
     total = models.DecimalField(max_digits=12, decimal_places=2, default=0)
+    # {lot id: quantity} taken from each StockLot for this line
+    lot_allocations = models.JSONField(default=dict, blank=True)
     cart_id = ShortUUIDField(unique=True, length=5, max_length=50, prefix='CID: ', alphabet='1234567890')
     created_at = models.DateTimeField(auto_now_add=True)
 
@@ -307,6 +437,17 @@ class Cart(models.Model):
         return None
 
 
+@receiver(post_delete, sender=LpacemakerDrugs)
+@receiver(post_delete, sender=NcapDrugs)
+@receiver(post_delete, sender=OncologyPharmacy)
+def delete_cart_lines_of_drug(sender, instance, using, **kwargs):
+    # A drug deleted from its category's own database file: the delete only
+    # cascaded within that file, so remove its cart lines from the main one
+    if using != DEFAULT_DB_ALIAS:
+        field = {LpacemakerDrugs: 'lpacemaker_drug', NcapDrugs: 'ncap_drug', OncologyPharmacy: 'oncology_drug'}[sender]
+        Cart.objects.filter(**{f'{field}_id': instance.pk}).delete()
+
+
 class Form(models.Model):
     form_id = ShortUUIDField(
         length=5,
@@ -319,11 +460,22 @@ class Form(models.Model):
     hospital_no = models.CharField(max_length=100, null=True, blank=True)
     ncap_no = models.CharField(max_length=100, null=True, blank=True)
     total_amount = models.DecimalField(max_digits=10, decimal_places=2)
+    # Per-category totals, maintained from FormItem by FormService.refresh_totals()
+    lpacemaker_total = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    ncap_total = models.DecimalField(max_digits=10, decimal_places=2, default=0)
+    oncology_total = models.DecimalField(max_digits=10, decimal_places=2, default=0)
     date = models.DateTimeField(auto_now_add=True)
     dispensed_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True)
+    # Bumped by ReceiptService.invalidate on every edit; stored receipts
+    # rendered at an older version are not served
+    receipt_version = models.PositiveIntegerField(default=0)
 
     class Meta:
         db_table = 'pharmacy_form'
+        indexes = [
+            # Keyset pagination and date-range filters on the forms list
+            models.Index(fields=['-date', '-id'], name='form_date_id_idx'),
+        ]
 
     def __str__(self):
         return f"Form {self.form_id} - {self.buyer_name}"
@@ -344,28 +496,260 @@ class FormItem(models.Model):
         return f"{self.drug_name} - {self.form.form_id}"
 
 
+class DailySalesRollup(models.Model):
+    """
+    Dispensing totals per (day, drug category, dispensing user), maintained
+    incrementally by SalesRollupService at checkout and on form item edits.
+    form_count counts forms with at least one line in the category, so a
+    form spanning two categories is counted once in each.
+    """
+    day = models.DateField()
+    drug_type = models.CharField(max_length=50)  # LPACEMAKER, NCAP, ONCOLOGY
+    dispensed_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True)
+    form_count = models.IntegerField(default=0)
+    line_count = models.IntegerField(default=0)
+    quantity = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        ordering = ['-day', 'drug_type']
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'drug_type', 'dispensed_by'], name='unique_daily_sales_rollup'),
+        ]
+
+    def __str__(self):
+        return f"{self.day} {self.drug_type} {self.dispensed_by}: {self.revenue}"
+
+
+class DailyDrugSalesRollup(models.Model):
+    """
+    Dispensed quantity and revenue per (day, drug category, drug name),
+    maintained alongside DailySalesRollup for top-selling drug reports.
+    """
+    day = models.DateField()
+    drug_type = models.CharField(max_length=50)
+    drug_name = models.CharField(max_length=255)
+    line_count = models.IntegerField(default=0)
+    quantity = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        ordering = ['-day', 'drug_type', 'drug_name']
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'drug_type', 'drug_name'], name='unique_daily_drug_sales_rollup'),
+        ]
+
+    def __str__(self):
+        return f"{self.day} {self.drug_type} {self.drug_name}: {self.quantity}"
+
+
+class ReceiptDocument(models.Model):
+    """
+    Receipt for a dispensed form, rendered once and served as stored bytes.
+    Only served while form_version matches the form's receipt_version, so an
+    edit makes it stale and the next view renders it again; content_hash
+    doubles as the HTTP ETag.
+    """
+    VARIANT_CHOICES = [
+        ('html', 'HTML'),
+        ('print', 'Print'),
+    ]
+
+    form = models.ForeignKey(Form, on_delete=models.CASCADE, related_name='receipt_documents')
+    variant = models.CharField(max_length=10, choices=VARIANT_CHOICES, default='html')
+    content_hash = models.CharField(max_length=64)
+    body = models.BinaryField()
+    form_version = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['form', 'variant'], name='unique_receipt_document'),
+        ]
+
+    def __str__(self):
+        return f"Receipt {self.form_id} ({self.variant})"
+
+
+class StockMovement(models.Model):
+    """
+    A batch of stock changes applied by a background job, e.g. expired stock
+    written off by the expiry engine. One row covers a whole batch; `details`
+    lists the affected drugs and their previous stock.
+    """
+    KIND_CHOICES = [
+        ('expiry', 'Expiry write-off'),
+        # Marks a StockJournal entry's stock change as committed
+        ('journal', 'Cart change (journaled)'),
+    ]
+
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    drug_type = models.CharField(max_length=50)  # LPACEMAKER, NCAP, ONCOLOGY
+    drug_count = models.IntegerField(default=0)
+    quantity = models.IntegerField(default=0)
+    window_start = models.DateField(null=True, blank=True)
+    window_end = models.DateField(null=True, blank=True)
+    details = models.JSONField(default=list, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f"{self.get_kind_display()} {self.drug_type}: {self.drug_count} item(s), {self.quantity} unit(s)"
+
+
+class StockJournal(models.Model):
+    """
+    A cart change in flight between the main database and a category
+    database (CATEGORY_DATABASES). Written in the main database before the
+    stock moves and deleted with the cart change that completes it; an entry
+    left behind by a crash is finished or rolled back by
+    StockJournalService.reconcile.
+    """
+    ACTION_CHOICES = (
+        ('TAKE', 'Take for a cart line'),
+        ('RELEASE', 'Release from cart lines'),
+    )
+
+    action = models.CharField(max_length=10, choices=ACTION_CHOICES)
+    drug_type = models.CharField(max_length=50)  # lpacemaker, ncap, oncology
+    # Takes: the StockMovement marking the stock taken, in the category database
+    marker = models.BigIntegerField(null=True, blank=True)
+    # Releases: [[drug id, quantity, {lot id: quantity}], ...]
+    entries = models.JSONField(default=list, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['created_at']
+
+    def __str__(self):
+        return f"{self.get_action_display()} {self.drug_type} #{self.pk}"
+
+
+class PriceChange(models.Model):
+    """
+    Price history: one row per drug whose markup or price was changed by a
+    repricing run. Rows from the same run share a `batch` id.
+    """
+    batch = models.CharField(max_length=32, db_index=True)
+    drug_type = models.CharField(max_length=50)  # LPACEMAKER, NCAP, ONCOLOGY
+    drug_id = models.PositiveIntegerField()
+    drug_name = models.CharField(max_length=200)
+    cost = models.DecimalField(max_digits=12, decimal_places=2)
+    old_markup = models.CharField(max_length=10)
+    new_markup = models.CharField(max_length=10)
+    old_price = models.DecimalField(max_digits=12, decimal_places=2)
+    new_price = models.DecimalField(max_digits=12, decimal_places=2)
+    changed_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['drug_type', 'drug_id'], name='pricechange_drug_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.drug_name} ({self.drug_type}): {self.old_price} -> {self.new_price}"
+
+
+class ProcessingWatermark(models.Model):
+    """Last date a scheduled job has fully processed, keyed by job name"""
+    name = models.CharField(max_length=100, unique=True)
+    value = models.DateField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name}: {self.value}"
+
+
 class OfflineTransaction(models.Model):
     TRANSACTION_TYPES = (
         ('ADD_TO_CART', 'Add to Cart'),
         ('REMOVE_FROM_CART', 'Remove from Cart'),
         ('CHECKOUT', 'Checkout'),
     )
+    # How a stale transaction was resolved on replay
+    CONFLICT_CHOICES = (
+        ('REJECTED', 'Rejected'),
+        ('CLAMPED', 'Clamped to stock'),
+        ('REVIEW', 'Held for review'),
+    )
 
     transaction_type = models.CharField(max_length=20, choices=TRANSACTION_TYPES)
     data = models.JSONField(encoder=DjangoJSONEncoder)
     created_at = models.DateTimeField(auto_now_add=True)
     synced = models.BooleanField(default=False)
     retry_count = models.IntegerField(default=0)
+    # Version of the drug this action was queued against (see OfflineReplayService)
     version = models.IntegerField(default=1)
+    # Uploading counter and its position in that counter's queue
+    client_id = models.CharField(max_length=64, null=True, blank=True)
+    sequence = models.PositiveBigIntegerField(null=True, blank=True)
+    # Replay state, written by OfflineReplayService
+    next_attempt_at = models.DateTimeField(null=True, blank=True)
+    quarantined = models.BooleanField(default=False)
+    last_error = models.TextField(blank=True, default='')
+    processed_at = models.DateTimeField(null=True, blank=True)
+    conflict = models.CharField(max_length=10, choices=CONFLICT_CHOICES, blank=True, default='')
+    # Worker currently replaying this transaction, until lease_expires
+    claimed_by = models.CharField(max_length=64, blank=True, default='')
+    lease_expires = models.DateTimeField(null=True, blank=True)
 
     class Meta:
         ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['synced', 'quarantined', 'created_at'], name='offline_pending_idx'),
+            models.Index(fields=['synced', 'lease_expires'], name='offline_lease_idx'),
+        ]
+        constraints = [
+            # Re-uploads of the same queued action are ignored
+            models.UniqueConstraint(fields=['client_id', 'sequence'], name='offline_client_sequence_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.get_transaction_type_display()} #{self.pk}"
 
     def process(self):
-        if self.transaction_type == 'ADD_TO_CART':
-            cart = Cart.objects.get(user=self.data['user_id'])
-            # Process add to cart logic
-            pass
-        elif self.transaction_type == 'CHECKOUT':
-            # Process checkout logic
-            pass
+        """Apply this transaction now, outside the batched replay"""
+        from .services import OfflineReplayService
+        OfflineReplayService.apply(self)
+
+
+class Job(models.Model):
+    """
+    Background work queued in the database and run by `manage.py run_worker`
+    (see JobQueueService). Jobs that fail `max_attempts` times are kept as
+    DEAD for inspection and retry from the admin.
+    """
+    STATUS_CHOICES = (
+        ('QUEUED', 'Queued'),
+        ('RUNNING', 'Running'),
+        ('DONE', 'Done'),
+        ('DEAD', 'Dead letter'),
+    )
+
+    name = models.CharField(max_length=100)
+    payload = models.JSONField(default=dict, blank=True, encoder=DjangoJSONEncoder)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='QUEUED')
+    run_at = models.DateTimeField(default=now)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=5)
+    # Scheduled runs are keyed by schedule entry and slot so that several
+    # workers enqueue each run once
+    unique_key = models.CharField(max_length=200, null=True, blank=True, unique=True)
+    claimed_by = models.CharField(max_length=64, blank=True, default='')
+    lease_expires = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['run_at', 'id']
+        indexes = [
+            models.Index(fields=['status', 'run_at'], name='job_due_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.name} #{self.pk} ({self.get_status_display()})"
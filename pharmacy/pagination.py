@@ -0,0 +1,87 @@
+"""
+Keyset (seek) pagination for NEOPHARM list views.
+A page is addressed by an opaque cursor holding the sort key of the last row
+shown, so the database seeks straight to the next page through the index
+instead of counting past OFFSET rows. Page 1000 costs the same as page 1.
+"""
+import base64
+import json
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+
+DEFAULT_PAGE_SIZE = 25
+
+
+def encode_cursor(*values):
+    """Pack sort key values into a URL-safe cursor string"""
+    raw = json.dumps([str(value) for value in values]).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Unpack a cursor; returns None for a missing or malformed cursor"""
+    if not cursor:
+        return None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(values, list):
+        return None
+    return values
+
+
+class KeysetPage:
+    """One page of a keyset-paginated queryset"""
+
+    def __init__(self, items, next_cursor):
+        self.items = items
+        self.next_cursor = next_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+def keyset_page(queryset, cursor=None, field='date', page_size=DEFAULT_PAGE_SIZE, descending=True):
+    """
+    Return a KeysetPage of `queryset` ordered by (field, id), newest first by
+    default. `id` breaks ties so rows sharing a timestamp are never skipped.
+    An invalid cursor is treated as the first page.
+    """
+    model_field = queryset.model._meta.get_field(field)
+    if descending:
+        queryset = queryset.order_by(f'-{field}', '-id')
+        after = 'lt'
+    else:
+        queryset = queryset.order_by(field, 'id')
+        after = 'gt'
+
+    values = decode_cursor(cursor)
+    if values and len(values) == 2:
+        try:
+            last_value = model_field.to_python(values[0])
+            last_id = int(values[1])
+        except (ValidationError, ValueError):
+            last_value = None
+        if last_value is not None:
+            queryset = queryset.filter(
+                Q(**{f'{field}__{after}': last_value}) |
+                Q(**{field: last_value, f'id__{after}': last_id})
+            )
+
+    rows = list(queryset[:page_size + 1])
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        last = rows[-1]
+        next_cursor = encode_cursor(getattr(last, model_field.attname), last.pk)
+    return KeysetPage(rows, next_cursor)
@@ -1,8 +1,61 @@
 from django.shortcuts import get_object_or_404
-from django.db import transaction
-from django.db.models import F
+from django.contrib.auth.models import Group
+from django.db import connection, transaction, IntegrityError
+from django.template.loader import render_to_string
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db.models import F, Q, Count, Sum, Max, Func, Exists, Subquery, OuterRef, IntegerField, CharField, DateField, DateTimeField, DecimalField, DurationField, Value, ExpressionWrapper, Case, When, Window
+from django.db.models.fields.json import KT
+from django.db.models.functions import Cast, Coalesce, Round, Trunc, TruncDate, Upper
 from django.utils import timezone
-from .models import LpacemakerDrugs, NcapDrugs, OncologyPharmacy, Cart
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal, InvalidOperation
+from collections import Counter
+from itertools import islice
+import csv
+import hashlib
+import io
+import os
+import socket
+import traceback
+import uuid
+import zlib
+import orjson
+from .pagination import keyset_page, encode_cursor, decode_cursor
+from .db import CATEGORY_DRUG_MODELS, categories_split, coordinated_write, reporting_queryset, stock_atomic, stock_database
+from . import exports
+from .models import (
+    LpacemakerDrugs,
+    NcapDrugs,
+    OncologyPharmacy,
+    Cart,
+    StockLot,
+    CatalogChange,
+    Form,
+    FormItem,
+    User,
+    DailySalesRollup,
+    DailyDrugSalesRollup,
+    ReceiptDocument,
+    StockMovement,
+    StockJournal,
+    ProcessingWatermark,
+    OfflineTransaction,
+    PriceChange,
+    Job,
+    DOSAGE_FORM,
+    UNIT,
+    MARKUP_CHOICES,
+    markup_price,
+    USER_STATS_CACHE_KEY,
+)
+
+
+def worker_name():
+    """Default owner recorded on claimed rows: this host and process"""
+    return f'{socket.gethostname()}:{os.getpid()}'[-64:]
+
 
 class DrugService:
     @staticmethod
@@ -41,15 +94,25 @@ class DrugService:
         Returns a tuple (success, message, status_code).
         """
         try:
-            with transaction.atomic():
-                drug_model = cls.get_drug_model(drug_type)
+            drug_model = cls.get_drug_model(drug_type)
+            drug_field = cls.get_drug_field_name(drug_type)
+            today = timezone.now().date()
+            taken = {}
+
+            def take_stock():
                 # Lock the row for update to prevent race conditions
-                drug = drug_model.objects.select_for_update().get(pk=pk)
-                
-                if drug.stock < quantity:
-                    return False, 'Insufficient stock', 400
+                taken['drug'] = drug_model.objects.select_for_update().get(pk=pk)
+                # Take the quantity from unexpired lots, earliest expiry first
+                taken['allocation'] = StockLotService.take(drug_type, pk, quantity, today)
+                return taken['allocation']
 
-                drug_field = cls.get_drug_field_name(drug_type)
+            def put_stock_back():
+                StockLotService.restore(drug_type, pk, taken['allocation'])
+
+            def add_line():
+                drug, allocation = taken['drug'], taken['allocation']
+                if allocation is None:
+                    return
                 
                 # Check for existing cart item
                 cart_filter = {
@@ -61,11 +124,9 @@ class DrugService:
                 cart_item = Cart.objects.filter(**cart_filter).first()
                 
                 if cart_item:
-                    new_quantity = cart_item.quantity + quantity
-                    if drug.stock < new_quantity:
-                        return False, 'Insufficient stock', 400
-                         
-                    cart_item.quantity = new_quantity
+                    cart_item.quantity += quantity
+                    for lot_id, taken_from_lot in allocation.items():
+                        cart_item.lot_allocations[str(lot_id)] = cart_item.lot_allocations.get(str(lot_id), 0) + taken_from_lot
                     cart_item.subtotal = cart_item.calculate_subtotal
                     cart_item.save()
                 else:
@@ -78,67 +139,2520 @@ class DrugService:
                         'unit': drug.unit,
                         'quantity': quantity,
                         'price': drug.price,
-                        'subtotal': drug.price * quantity
+                        'subtotal': drug.price * quantity,
+                        'lot_allocations': {str(lot_id): taken_from_lot for lot_id, taken_from_lot in allocation.items()},
                     }
                     Cart.objects.create(**cart_data)
-                
-                # Update stock safely using F expression
-                drug.stock = F('stock') - quantity
-                drug.save()
-                drug.refresh_from_db() # Reload to get actual value after F update
-                
-                return True, f'Added {quantity} {drug.name} to cart', 200
+
+            StockJournalService.take(drug_type, pk, take_stock, put_stock_back, add_line)
+            drug = taken['drug']
+            if taken['allocation'] is None:
+                # Expired lots may not have been written off by the expiry job yet
+                if drug.exp_date and drug.exp_date < today:
+                    return False, 'Item has expired', 400
+                return False, 'Insufficient stock', 400
+            return True, f'Added {quantity} {drug.name} to cart', 200
                 
         except (ValueError, drug_model.DoesNotExist):
              return False, 'Invalid item', 404
         except Exception as e:
             return False, str(e), 500
 
+    @classmethod
+    def remove_from_cart(cls, user, drug_type, pk):
+        """
+        Remove the user's open cart line for this drug, returning its stock to
+        the lots it came from. Returns the quantity put back (0 if there was
+        no line to remove).
+        """
+        drug_field = cls.get_drug_field_name(drug_type)
+        cart_items = cls.discard_cart_lines(
+            Cart.objects.filter(user=user, form__isnull=True, **{f'{drug_field}_id': pk})
+        )
+        return sum(item.quantity for item in cart_items)
+
+    @classmethod
+    def update_cart_quantity(cls, cart_item, quantity):
+        """
+        Set an open cart line's quantity, taking only the difference from the
+        lots (FEFO) or giving it back to the lots the line holds, latest
+        expiry first. A quantity of 0 or less removes the line.
+        Returns a tuple (success, message).
+        """
+        if quantity <= 0:
+            cls.discard_cart_lines([cart_item])
+            return True, 'Item removed from cart'
+        difference = quantity - cart_item.quantity
+        drug_type = cart_item.get_drug_type()
+        drug_id = getattr(cart_item, f'{cls.get_drug_field_name(drug_type)}_id')
+        if difference > 0:
+            # Merged into this line by add_to_cart
+            success, message, _ = cls.add_to_cart(cart_item.user, drug_type, drug_id, difference)
+            return success, 'Cart updated successfully' if success else message
+        if difference == 0:
+            return True, 'Cart updated successfully'
+
+        # Lines added before lot tracking give back to the lot at the drug's expiry
+        returned = {}
+        if cart_item.lot_allocations:
+            returned = StockLotService.choose_returns(drug_type, cart_item.lot_allocations, -difference)
+
+        def shrink_line():
+            allocations = {
+                lot_id: held - returned.get(lot_id, 0)
+                for lot_id, held in cart_item.lot_allocations.items()
+            }
+            cart_item.lot_allocations = {lot_id: held for lot_id, held in allocations.items() if held > 0}
+            cart_item.quantity = quantity
+            cart_item.subtotal = cart_item.calculate_subtotal
+            cart_item.save(update_fields=['quantity', 'subtotal', 'lot_allocations'])
+            return {drug_type: [[drug_id, -difference, returned]]}
+
+        StockJournalService.release(shrink_line)
+        return True, 'Cart updated successfully'
+
+    @classmethod
+    def discard_cart_lines(cls, cart_lines):
+        """
+        Delete cart lines and put their stock back into the lots it came from
+        (through StockJournalService.release). Returns the deleted lines.
+        """
+        cart_items = []
+
+        def delete_lines():
+            cart_items[:] = list(cart_lines)
+            Cart.objects.filter(pk__in=[item.pk for item in cart_items]).delete()
+            return StockLotService.cart_entries(cart_items)
+
+        StockJournalService.release(delete_lines)
+        return cart_items
+
+    @staticmethod
+    def with_drugs(cart_lines):
+        """Cart lines with their drugs loaded: joined, or one query per category file when categories are split"""
+        fields = ('lpacemaker_drug', 'ncap_drug', 'oncology_drug')
+        if categories_split():
+            return cart_lines.prefetch_related(*fields)
+        return cart_lines.select_related(*fields)
+
+    @classmethod
+    def checkout(cls, user, buyer_name, hospital_no=None, ncap_no=None):
+        """
+        Dispense the user's open cart: create the Form and its items, attach
+        the cart lines to it and update the totals and sales rollups.
+        Returns the Form; raises ValueError when the cart is empty.
+        """
+        cart_items = list(cls.with_drugs(Cart.objects.filter(user=user, form__isnull=True)))
+        if not cart_items:
+            raise ValueError('No items in cart to dispense!')
+
+        with transaction.atomic():
+            form_record = Form.objects.create(
+                buyer_name=buyer_name,
+                hospital_no=hospital_no,
+                ncap_no=ncap_no,
+                total_amount=sum(item.subtotal for item in cart_items),
+                dispensed_by=user
+            )
+            
+            # Move cart items to form items
+            for cart_item in cart_items:
+                drug = cart_item.get_item
+                
+                FormItem.objects.create(
+                    form=form_record,
+                    drug_name=drug.name,
+                    drug_brand=drug.brand if hasattr(drug, 'brand') else None,
+                    drug_type=cart_item.get_drug_type().upper(),
+                    dosage_form=drug.dosage_form if hasattr(drug, 'dosage_form') else None,
+                    unit=cart_item.unit,
+                    quantity=cart_item.quantity,
+                    price=cart_item.price,
+                    subtotal=cart_item.subtotal
+                )
+                
+                # Link cart item to form
+                cart_item.form = form_record
+                cart_item.save()
+            
+            FormService.refresh_totals(form_record)
+            # Not queued: the edit views apply snapshot differences on the
+            # assumption the form is already rolled up, and this is three
+            # statements committed with the form
+            SalesRollupService.apply_form(form_record)
+        return form_record
+
     @classmethod
     def return_item(cls, drug_type, pk, quantity):
         """
         Returns an item to stock.
         """
         try:
-            with transaction.atomic():
+            with stock_atomic(drug_type):
                 drug_model = cls.get_drug_model(drug_type)
                 drug = drug_model.objects.select_for_update().get(pk=pk)
                 
-                drug.stock = F('stock') + quantity
-                drug.save()
+                # Returned units go back into the earliest-expiring lot
+                StockLotService.receive(drug_type, pk, quantity, exp_date=drug.exp_date)
                 
                 return True, f'{drug.name} returned successfully!'
         except Exception as e:
             return False, str(e)
 
+
+class StockLotService:
+    """
+    Stock is held in lots (StockLot). Sales take from unexpired lots
+    first-expiry-first-out; deliveries and returns add to a lot. Each change
+    updates only the lots it touches plus the drug's aggregate `stock` (by the
+    same delta) and `exp_date` (the earliest expiry still in stock).
+    """
+
+    @staticmethod
+    def next_expiry(field):
+        """Earliest expiry among the outer drug's lots that still hold stock"""
+        lots = (
+            StockLot.objects.filter(**{field: OuterRef('pk')}, quantity__gt=0, exp_date__isnull=False)
+            .order_by('exp_date')
+            .values('exp_date')[:1]
+        )
+        return Coalesce(Subquery(lots), F('exp_date'))
+
     @classmethod
-    def check_expired_items(cls):
+    def adjust_drugs(cls, drug_type, deltas):
         """
-        Check all drug items and set stock to 0 for expired items.
-        Returns a tuple (expired_count, updated_items) with details of what was changed.
+        Add {drug id: delta} to the drugs' stock, refresh their next expiry and
+        bump their version, in one UPDATE
         """
-        expired_items = []
-        current_date = timezone.now().date()
-        
-        # Check each drug type
-        for drug_model in [LpacemakerDrugs, NcapDrugs, OncologyPharmacy]:
-            # Get items that have expired but still have stock
-            expired_with_stock = drug_model.objects.filter(
-                exp_date__isnull=False,
-                exp_date__lt=current_date,
-                stock__gt=0
+        model = DrugService.get_drug_model(drug_type)
+        field = DrugService.get_drug_field_name(drug_type)
+        stock = F('stock') + Case(
+            *[When(pk=drug_id, then=Value(delta)) for drug_id, delta in deltas.items()],
+            default=Value(0),
+        )
+        model.objects.filter(pk__in=list(deltas)).update(
+            stock=stock, exp_date=cls.next_expiry(field), updated_at=timezone.now(),
+            version=F('version') + 1,
+        )
+
+    @staticmethod
+    def lots(drug_type):
+        """StockLot manager on the database holding this category's stock"""
+        return StockLot.objects.using(stock_database(drug_type))
+
+    @classmethod
+    def _adjust_lots(cls, drug_type, deltas):
+        """Add {lot id: delta} to the lots' quantities in one UPDATE"""
+        if deltas:
+            cls.lots(drug_type).filter(pk__in=list(deltas)).update(
+                quantity=F('quantity') + Case(
+                    *[When(pk=lot_id, then=Value(delta)) for lot_id, delta in deltas.items()],
+                    default=Value(0),
+                )
             )
-            
-            for drug in expired_with_stock:
-                expired_items.append({
-                    'id': drug.id,
-                    'name': drug.name,
-                    'type': drug_model.__name__,
-                    'old_stock': drug.stock,
-                    'exp_date': drug.exp_date
+
+    @classmethod
+    def _apply(cls, drug_type, pk, deltas, adjust_stock=True):
+        """Add {lot id: delta} to the drug's lots, then the total to the drug"""
+        deltas = {int(lot_id): delta for lot_id, delta in deltas.items() if delta}
+        cls._adjust_lots(drug_type, deltas)
+        cls.adjust_drugs(drug_type, {pk: sum(deltas.values()) if adjust_stock else 0})
+
+    @classmethod
+    def allocate(cls, drug_type, pk, quantity, today=None):
+        """
+        Pick the lots to take `quantity` from, earliest expiry first, skipping
+        lots expired before `today` (unless it is None). A running total over
+        the drug's lots selects just the lots needed in one query.
+        Returns {lot id: quantity}, or None if the lots cannot cover `quantity`.
+        """
+        field = DrugService.get_drug_field_name(drug_type)
+        fefo = [F('exp_date').asc(nulls_last=True), F('id').asc()]
+        lots = cls.lots(drug_type).filter(**{field: pk}, quantity__gt=0)
+        if today is not None:
+            lots = lots.filter(Q(exp_date__isnull=True) | Q(exp_date__gte=today))
+        lots = (
+            lots.annotate(taken_before=Window(Sum('quantity'), order_by=fefo) - F('quantity'))
+            .filter(taken_before__lt=quantity)
+            .order_by(*fefo)
+            .values_list('id', 'quantity', 'taken_before')
+        )
+        allocation = {lot_id: min(available, quantity - taken_before) for lot_id, available, taken_before in lots}
+        if sum(allocation.values()) < quantity:
+            return None
+        return allocation
+
+    @classmethod
+    def take(cls, drug_type, pk, quantity, today=None):
+        """Sell `quantity` from unexpired lots (FEFO); returns the allocation or None"""
+        allocation = cls.allocate(drug_type, pk, quantity, today or timezone.now().date())
+        if allocation is not None:
+            cls._apply(drug_type, pk, {lot_id: -taken for lot_id, taken in allocation.items()})
+        return allocation
+
+    @classmethod
+    def restore(cls, drug_type, pk, allocation):
+        """Put an allocation returned by take() back into its lots"""
+        if allocation:
+            cls._apply(drug_type, pk, allocation)
+
+    @classmethod
+    def choose_returns(cls, drug_type, allocation, quantity):
+        """
+        Pick `quantity` units of an allocation to give back, latest expiry
+        first, so the units still held are the first to expire.
+        Returns {lot id: quantity}, keyed like the allocation.
+        """
+        fefo_reversed = [F('exp_date').desc(nulls_first=True), F('id').desc()]
+        lot_ids = cls.lots(drug_type).filter(pk__in=[int(lot_id) for lot_id in allocation]).order_by(*fefo_reversed)
+        returned = {}
+        for lot_id in lot_ids.values_list('id', flat=True):
+            if quantity <= 0:
+                break
+            given = min(allocation[str(lot_id)], quantity)
+            returned[str(lot_id)] = given
+            quantity -= given
+        return returned
+
+    @classmethod
+    def receive(cls, drug_type, pk, quantity, exp_date=None, lot_number=''):
+        """Add `quantity` to the drug's lot with this expiry and number, creating it if needed"""
+        field = DrugService.get_drug_field_name(drug_type)
+        lot = cls.lots(drug_type).filter(**{field: pk}, exp_date=exp_date, lot_number=lot_number).order_by('id').first()
+        if lot is None:
+            lot = cls.lots(drug_type).create(**{f'{field}_id': pk}, exp_date=exp_date, lot_number=lot_number)
+        cls._apply(drug_type, pk, {lot.pk: quantity})
+        ExpiryService.write_off_edited(drug_type, [pk])
+        return lot
+
+    @staticmethod
+    def cart_entries(cart_items):
+        """{drug type: [[drug id, quantity, {lot id: quantity}], ...]} of the stock cart lines hold"""
+        entries = {}
+        for cart_item in cart_items:
+            for drug_type in CATEGORY_DRUG_MODELS:
+                drug_id = getattr(cart_item, f'{DrugService.get_drug_field_name(drug_type)}_id')
+                if drug_id:
+                    entries.setdefault(drug_type, []).append([drug_id, cart_item.quantity, cart_item.lot_allocations])
+                    break
+        return entries
+
+    @classmethod
+    def release(cls, entries):
+        """
+        Put stock held by cart lines (cart_entries) back into the lots it was
+        taken from, with one UPDATE for the lots in each database and one per
+        drug type
+        """
+        lot_deltas = {}
+        drug_deltas = {}
+        for drug_type, rows in entries.items():
+            for drug_id, quantity, allocation in rows:
+                if not allocation:
+                    # Lines added before lot tracking
+                    drug = DrugService.get_drug_model(drug_type).objects.only('exp_date').get(pk=drug_id)
+                    cls.receive(drug_type, drug_id, quantity, exp_date=drug.exp_date)
+                    continue
+                drugs = drug_deltas.setdefault(drug_type, {})
+                # Lots sharing a database are updated together
+                lots = lot_deltas.setdefault(stock_database(drug_type), ({}, drug_type))[0]
+                for lot_id, taken in allocation.items():
+                    lots[int(lot_id)] = lots.get(int(lot_id), 0) + taken
+                    drugs[drug_id] = drugs.get(drug_id, 0) + taken
+
+        for lots, drug_type in lot_deltas.values():
+            cls._adjust_lots(drug_type, lots)
+        for drug_type, deltas in drug_deltas.items():
+            cls.adjust_drugs(drug_type, deltas)
+
+    @classmethod
+    def sync(cls, drug_type, drug, previous_exp_date=None):
+        """
+        Reconcile the lots after `drug.stock` or `drug.exp_date` was set
+        directly (item forms, stock counts): lots on the previous expiry date
+        move to the new one, added stock becomes a lot at the drug's expiry
+        and removed stock is taken from the earliest-expiring lots. Lots that
+        end up behind the expiry watermark are written off.
+        """
+        field = DrugService.get_drug_field_name(drug_type)
+        # Saved values, as the caller's instance may still hold raw form input
+        drug.refresh_from_db(fields=['stock', 'exp_date'])
+        lots = cls.lots(drug_type).filter(**{field: drug.pk})
+        if previous_exp_date and drug.exp_date and previous_exp_date != drug.exp_date:
+            lots.filter(exp_date=previous_exp_date).update(exp_date=drug.exp_date)
+
+        delta = (drug.stock or 0) - (lots.aggregate(total=Sum('quantity'))['total'] or 0)
+        deltas = {}
+        if delta > 0:
+            lot = lots.filter(exp_date=drug.exp_date, lot_number='').order_by('id').first()
+            if lot is None:
+                lot = cls.lots(drug_type).create(**{field: drug}, exp_date=drug.exp_date)
+            deltas = {lot.pk: delta}
+        elif delta < 0:
+            deltas = {lot_id: -taken for lot_id, taken in cls.allocate(drug_type, drug.pk, -delta).items()}
+        cls._apply(drug_type, drug.pk, deltas, adjust_stock=False)
+        ExpiryService.write_off_edited(drug_type, [drug.pk])
+        drug.refresh_from_db(fields=['stock', 'exp_date'])
+        return drug
+
+
+class StockJournalService:
+    """
+    With CATEGORY_DATABASES a cart change commits in two files, the stock
+    in its category's file and the cart line in the main one, so a crash
+    between the two commits must not lose or duplicate stock.
+
+    A take writes a 'journal' StockMovement marker in the category file with
+    the stock it took, and the cart line commits with a TAKE StockJournal
+    entry naming the marker. A release deletes or shrinks the lines and
+    records what they held as RELEASE entries in one main-file transaction,
+    then applies each entry in its category file together with a marker, so
+    it is applied once however often it is retried.
+
+    reconcile() (the job worker runs it every few minutes) finishes what a
+    crash left behind once it is STOCK_JOURNAL_GRACE_SECONDS old: takes
+    without a TAKE entry are put back, RELEASE entries are applied, and the
+    markers and entries of completed changes are deleted. With a single
+    database every change is one transaction and nothing is journaled.
+    """
+
+    @staticmethod
+    def grace_seconds():
+        return getattr(settings, 'STOCK_JOURNAL_GRACE_SECONDS', 600)
+
+    @staticmethod
+    def markers(drug_type):
+        return StockMovement.objects.using(stock_database(drug_type)).filter(kind='journal')
+
+    @staticmethod
+    def _mark(drug_type, quantity, details):
+        return StockMovement.objects.using(stock_database(drug_type)).create(
+            kind='journal', drug_type=drug_type.upper(), drug_count=1, quantity=quantity, details=details,
+        )
+
+    @classmethod
+    def take(cls, drug_type, drug_id, take_stock, put_stock_back, add_line):
+        """
+        Take stock for a cart line: take_stock() takes it and returns the
+        allocation (None if it could not), put_stock_back() undoes that and
+        add_line() records it on the cart
+        """
+        alias = stock_database(drug_type)
+        if alias is None:
+            return coordinated_write([(None, take_stock, put_stock_back), (None, add_line, None)])
+        marker = {}
+
+        def take_and_mark():
+            allocation = take_stock()
+            if allocation:
+                details = {'drug_id': drug_id, 'allocation': {str(lot_id): taken for lot_id, taken in allocation.items()}}
+                marker['id'] = cls._mark(drug_type, sum(allocation.values()), details).pk
+
+        def put_back_and_unmark():
+            put_stock_back()
+            cls.markers(drug_type).filter(pk=marker.get('id')).delete()
+
+        def add_line_and_record():
+            add_line()
+            if marker:
+                StockJournal.objects.create(action='TAKE', drug_type=drug_type, marker=marker['id'])
+
+        coordinated_write([(alias, take_and_mark, put_back_and_unmark), (None, add_line_and_record, None)])
+
+    @classmethod
+    def release(cls, change_lines):
+        """
+        Run change_lines(), which deletes or shrinks cart lines and returns
+        the stock they gave up as StockLotService.cart_entries does, and put
+        that stock back into its lots. With per-category files a category
+        whose release fails is left to reconcile() and the first error is
+        raised once the others are applied.
+        """
+        if not categories_split():
+            with transaction.atomic():
+                StockLotService.release(change_lines())
+            return
+        with transaction.atomic():
+            journals = [
+                StockJournal.objects.create(action='RELEASE', drug_type=drug_type, entries=rows)
+                for drug_type, rows in change_lines().items()
+            ]
+        errors = []
+        for journal in journals:
+            try:
+                cls._apply_release(journal)
+            except Exception as e:
+                errors.append(e)
+        if errors:
+            raise errors[0]
+
+    @classmethod
+    def _apply_release(cls, journal):
+        """Apply a RELEASE entry unless its marker shows it was, then delete it"""
+        with transaction.atomic(using=stock_database(journal.drug_type)):
+            if not cls.markers(journal.drug_type).filter(details__journal=journal.pk).exists():
+                StockLotService.release({journal.drug_type: journal.entries})
+                quantity = sum(quantity for _, quantity, _ in journal.entries)
+                cls._mark(journal.drug_type, quantity, {'journal': journal.pk})
+        journal.delete()
+
+    @classmethod
+    def reconcile(cls, now=None):
+        """
+        Finish or undo the cart changes a crash left half-committed. Returns
+        counts of the releases applied, the takes put back and the completed
+        changes cleared.
+        """
+        summary = {'released': 0, 'rolled_back': 0, 'completed': 0}
+        if not categories_split():
+            return summary
+        cutoff = (now or timezone.now()) - timedelta(seconds=cls.grace_seconds())
+        for drug_type in CATEGORY_DRUG_MODELS:
+            for journal in StockJournal.objects.filter(action='RELEASE', drug_type=drug_type, created_at__lt=cutoff):
+                cls._apply_release(journal)
+                summary['released'] += 1
+
+            # Read before the entries: a take's marker commits before its entry
+            markers = list(cls.markers(drug_type).values_list('id', 'created_at', 'details'))
+            takes = dict(
+                StockJournal.objects.filter(action='TAKE', drug_type=drug_type).values_list('marker', 'created_at')
+            )
+            releases = set(
+                StockJournal.objects.filter(action='RELEASE', drug_type=drug_type).values_list('id', flat=True)
+            )
+            finished = []
+            for marker_id, created_at, details in markers:
+                if 'journal' in details:
+                    if details['journal'] not in releases:
+                        finished.append(marker_id)
+                elif marker_id in takes:
+                    finished.append(marker_id)
+                    summary['completed'] += 1
+                elif created_at < cutoff:
+                    # The cart line never committed
+                    with transaction.atomic(using=stock_database(drug_type)):
+                        StockLotService.restore(drug_type, details['drug_id'], details['allocation'])
+                        cls.markers(drug_type).filter(pk=marker_id).delete()
+                    summary['rolled_back'] += 1
+            # Markers go before the entries naming them, so a crash in
+            # between never makes a completed take look unfinished; entries
+            # left by such a crash have no marker and are old enough that it
+            # would have been read above
+            cls.markers(drug_type).filter(pk__in=finished).delete()
+            marked = {marker_id for marker_id, _, _ in markers}
+            cleared = [
+                marker_id for marker_id, created_at in takes.items()
+                if marker_id in finished or (created_at < cutoff and marker_id not in marked)
+            ]
+            StockJournal.objects.filter(action='TAKE', drug_type=drug_type, marker__in=cleared).delete()
+        return summary
+
+
+class ExpiryService:
+    """
+    Incremental expiry engine, run on a schedule by
+    `manage.py check_expired_items`. A watermark records the last expiry date
+    already written off, so each run only visits lots whose exp_date falls in
+    (watermark, yesterday] through the exp_date index - a lot is expired
+    once its expiry date is in the past. Expired lots are zeroed in batches,
+    their drugs' stock reduced by the same amount, and each batch is recorded
+    as one StockMovement. Lots whose expiry an edit moves to or behind the
+    watermark are written off by the edit (write_off_edited), since no later
+    run visits those dates again.
+    """
+
+    WATERMARK = 'expiry'
+    BATCH_SIZE = 500
+
+    @classmethod
+    def watermark(cls):
+        return ProcessingWatermark.objects.filter(name=cls.WATERMARK).values_list('value', flat=True).first()
+
+    @classmethod
+    def run(cls, since=None, today=None, batch_size=None, dry_run=False):
+        """
+        Write off the lots that expired after `since` (the stored watermark
+        by default; everything when neither is set) and before `today`. Returns a summary dict; with dry_run=True nothing is written.
+        """
+        today = today or timezone.now().date()
+        batch_size = batch_size or cls.BATCH_SIZE
+        window_start = since if since is not None else cls.watermark()
+        window_end = today - timedelta(days=1)
+        summary = {
+            'window_start': window_start,
+            'window_end': window_end,
+            'drug_count': 0,
+            'quantity': 0,
+            'movements': 0,
+            'batches': [],
+        }
+
+        for drug_type in ('lpacemaker', 'ncap', 'oncology'):
+            field = DrugService.get_drug_field_name(drug_type)
+            window = StockLotService.lots(drug_type).filter(**{f'{field}__isnull': False}, exp_date__lt=today, quantity__gt=0)
+            if window_start:
+                window = window.filter(exp_date__gt=window_start)
+
+            last = None
+            while True:
+                batch = window.order_by('exp_date', 'id')
+                if last:
+                    batch = batch.filter(Q(exp_date__gt=last[0]) | Q(exp_date=last[0], id__gt=last[1]))
+                rows = list(cls._lot_rows(batch, field)[:batch_size])
+                if not rows:
+                    break
+                last = (rows[-1]['exp_date'], rows[-1]['id'])
+
+                written_off, details = cls._write_off(drug_type, rows, window_start, window_end, dry_run)
+                if not dry_run:
+                    summary['movements'] += 1
+                summary['drug_count'] += len(written_off)
+                summary['quantity'] += sum(row['quantity'] for row in rows)
+                summary['batches'].append({'drug_type': drug_type.upper(), 'items': details})
+
+        if not dry_run:
+            current = cls.watermark()
+            if current is None or current < window_end:
+                ProcessingWatermark.objects.update_or_create(
+                    name=cls.WATERMARK, defaults={'value': window_end}
+                )
+        return summary
+
+    @staticmethod
+    def _lot_rows(lots, field):
+        return lots.values('id', 'quantity', 'exp_date', drug_id=F(field), name=F(f'{field}__name'))
+
+    @classmethod
+    def _write_off(cls, drug_type, rows, window_start, window_end, dry_run=False):
+        """
+        Zero the lots in `rows`, take their quantities off their drugs' stock
+        and record one StockMovement. Returns ({drug id: delta}, details).
+        """
+        written_off = {}
+        for row in rows:
+            written_off[row['drug_id']] = written_off.get(row['drug_id'], 0) - row['quantity']
+        details = [
+            {
+                'id': row['drug_id'], 'lot': row['id'], 'name': row['name'],
+                'stock': row['quantity'], 'exp_date': row['exp_date'].isoformat(),
+            }
+            for row in rows
+        ]
+        if not dry_run:
+            with stock_atomic(drug_type):
+                StockLotService.lots(drug_type).filter(id__in=[row['id'] for row in rows]).update(quantity=0)
+                StockLotService.adjust_drugs(drug_type, written_off)
+                StockMovement.objects.using(stock_database(drug_type)).create(
+                    kind='expiry',
+                    drug_type=drug_type.upper(),
+                    drug_count=len(written_off),
+                    quantity=sum(row['quantity'] for row in rows),
+                    window_start=window_start,
+                    window_end=window_end,
+                    details=details,
+                )
+        return written_off, details
+
+    @classmethod
+    def write_off_edited(cls, drug_type, drug_ids, today=None):
+        """
+        Write off the drugs' lots still holding stock whose expiry is on or
+        before the watermark, after an edit moved them there; run() only
+        visits later dates. Returns the units written off.
+        """
+        watermark = cls.watermark()
+        if watermark is None:
+            return 0
+        today = today or timezone.now().date()
+        field = DrugService.get_drug_field_name(drug_type)
+        rows = list(cls._lot_rows(
+            StockLotService.lots(drug_type).filter(
+                **{f'{field}__in': drug_ids}, exp_date__lte=watermark, exp_date__lt=today, quantity__gt=0,
+            ).order_by('exp_date', 'id'),
+            field,
+        ))
+        if not rows:
+            return 0
+        cls._write_off(drug_type, rows, None, watermark)
+        return sum(row['quantity'] for row in rows)
+
+
+class ExpiryForecastService:
+    """
+    Lots that will expire within the configured windows (EXPIRY_FORECAST_WINDOWS,
+    7/30/90 days by default) across all three stores, with the stock value at
+    risk. Each store is read with one range query on the lot exp_date index
+    for the items and one conditional aggregate for the window totals, and
+    the report is cached for the rest of the day. annotate_status() buckets
+    drug lists the same way in their query.
+    """
+
+    CATEGORIES = ('lpacemaker', 'ncap', 'oncology')
+
+    @staticmethod
+    def windows():
+        return sorted(getattr(settings, 'EXPIRY_FORECAST_WINDOWS', (7, 30, 90)))
+
+    @staticmethod
+    def days_left(today):
+        """Days from `today` to the row's exp_date, computed by the database"""
+        return ExpressionWrapper(F('exp_date') - Value(today, output_field=DateField()), output_field=DurationField())
+
+    @classmethod
+    def annotate_status(cls, queryset, today=None):
+        """
+        Annotate drugs with expiry_status - 'none', 'expired', 'soon' (within
+        the first forecast window) or 'valid' - and days_left, in the query
+        """
+        today = today or timezone.now().date()
+        soon = today + timedelta(days=cls.windows()[0])
+        return queryset.annotate(
+            expiry_status=Case(
+                When(exp_date__isnull=True, then=Value('none')),
+                When(exp_date__lt=today, then=Value('expired')),
+                When(exp_date__lte=soon, then=Value('soon')),
+                default=Value('valid'),
+                output_field=CharField(),
+            ),
+            days_left=cls.days_left(today),
+        )
+
+    @classmethod
+    def report(cls, today=None):
+        today = today or timezone.now().date()
+        windows = cls.windows()
+        key = f"expiry-forecast:{today.isoformat()}:{'-'.join(map(str, windows))}"
+        report = cache.get(key)
+        if report is None:
+            report = cls._build_report(today, windows)
+            # Expire with the day the report describes
+            tomorrow = timezone.make_aware(datetime.combine(today + timedelta(days=1), datetime.min.time()))
+            cache.set(key, report, max(int((tomorrow - timezone.now()).total_seconds()), 60))
+        return report
+
+    @classmethod
+    def _build_report(cls, today, windows):
+        horizon = today + timedelta(days=windows[-1])
+        totals = {window: {'count': 0, 'quantity': 0, 'value': Decimal('0')} for window in windows}
+        categories = {}
+        items = []
+
+        for category in cls.CATEGORIES:
+            field = DrugService.get_drug_field_name(category)
+            value = ExpressionWrapper(
+                F(f'{field}__price') * F('quantity'), output_field=DecimalField(max_digits=14, decimal_places=2)
+            )
+            lots = StockLotService.lots(category).filter(
+                **{f'{field}__isnull': False}, exp_date__gte=today, exp_date__lte=horizon, quantity__gt=0,
+            )
+            rows = list(
+                lots.order_by('exp_date', 'id')
+                .values(
+                    'exp_date', 'lot_number',
+                    drug_id=F(field), name=F(f'{field}__name'), brand=F(f'{field}__brand'),
+                    unit=F(f'{field}__unit'), stock=F('quantity'), price=F(f'{field}__price'), stock_value=value,
+                    days_left=cls.days_left(today),
+                )
+            )
+            # Every window's totals in one aggregate over the same range
+            aggregates = {}
+            for window in windows:
+                within = Q(exp_date__lte=today + timedelta(days=window))
+                aggregates[f'count_{window}'] = Count('id', filter=within)
+                aggregates[f'quantity_{window}'] = Coalesce(Sum('quantity', filter=within), 0)
+                aggregates[f'value_{window}'] = Coalesce(
+                    Sum(value, filter=within), Value(Decimal('0')), output_field=DecimalField(max_digits=14, decimal_places=2),
+                )
+            figures = lots.aggregate(**aggregates)
+            category_totals = {}
+            for window in windows:
+                category_totals[window] = {
+                    'count': figures[f'count_{window}'],
+                    'quantity': figures[f'quantity_{window}'],
+                    'value': Decimal(figures[f'value_{window}']),
+                }
+                for key, amount in category_totals[window].items():
+                    totals[window][key] += amount
+            for row in rows:
+                row['id'] = row.pop('drug_id')
+                row['category'] = category
+                row['days_left'] = row['days_left'].days
+            categories[category] = category_totals
+            items.extend(rows)
+
+        items.sort(key=lambda row: (row['exp_date'], row['name']))
+        return {
+            'date': today,
+            'windows': windows,
+            'totals': totals,
+            'categories': categories,
+            'items': items,
+        }
+
+    @classmethod
+    def badge_counts(cls, window=None, today=None):
+        """{category: count} of items expiring within `window` days (the middle window by default)"""
+        report = cls.report(today)
+        windows = report['windows']
+        window = window if window in windows else windows[len(windows) // 2]
+        return window, {category: totals[window]['count'] for category, totals in report['categories'].items()}
+
+
+class FormService:
+    """Keeps a Form's denormalized totals in step with its items and filters the forms list"""
+
+    CATEGORY_TOTAL_FIELDS = {
+        'LPACEMAKER': 'lpacemaker_total',
+        'NCAP': 'ncap_total',
+        'ONCOLOGY': 'oncology_total',
+    }
+
+    @staticmethod
+    def _items_total(**filters):
+        """Correlated subquery summing the subtotals of the outer form's items"""
+        items = (
+            FormItem.objects.filter(form=OuterRef('pk'), **filters)
+            .order_by()
+            .values('form')
+            .annotate(total=Sum('subtotal'))
+            .values('total')
+        )
+        return Coalesce(Subquery(items), Value(Decimal('0')), output_field=DecimalField(max_digits=10, decimal_places=2))
+
+    @classmethod
+    def total_updates(cls):
+        """UPDATE expressions recomputing total_amount and the category totals"""
+        updates = {'total_amount': cls._items_total()}
+        for category, field in cls.CATEGORY_TOTAL_FIELDS.items():
+            updates[field] = cls._items_total(drug_type__iexact=category)
+        return updates
+
+    @classmethod
+    def refresh_totals(cls, form):
+        """
+        Recompute the form's totals from its items in a single UPDATE, so
+        concurrent item edits cannot overwrite each other's totals, then
+        reload them onto `form`.
+        """
+        fields = ['total_amount', *cls.CATEGORY_TOTAL_FIELDS.values()]
+        with transaction.atomic():
+            Form.objects.filter(pk=form.pk).update(**cls.total_updates())
+            form.refresh_from_db(fields=fields)
+        return form
+
+    @classmethod
+    def category_totals(cls, form):
+        return {category: getattr(form, field) for category, field in cls.CATEGORY_TOTAL_FIELDS.items()}
+
+    @staticmethod
+    def search(params):
+        """
+        Apply the forms list search (`q`) and date filter (`filter`) from
+        `params`. Returns (forms, search_query, filter_type, today_start, period_start).
+        """
+        search_query = params.get('q', '').strip()
+        filter_type = params.get('filter', 'all')
+
+        forms = Form.objects.all()
+        if search_query:
+            forms = forms.filter(
+                Q(form_id__icontains=search_query) |
+                Q(buyer_name__icontains=search_query) |
+                Q(hospital_no__icontains=search_query) |
+                Q(ncap_no__icontains=search_query)
+            )
+
+        # Date filters are ranges on the indexed date column
+        today_start = timezone.localtime().replace(hour=0, minute=0, second=0, microsecond=0)
+        period_start = {
+            'today': today_start,
+            'week': today_start - timedelta(days=7),
+            'month': today_start - timedelta(days=30),
+        }.get(filter_type)
+        if period_start:
+            forms = forms.filter(date__gte=period_start)
+
+        return forms, search_query, filter_type, today_start, period_start
+
+
+class SalesRollupService:
+    """
+    Maintains DailySalesRollup and DailyDrugSalesRollup rows so period
+    revenue and top-seller reports sum a few hundred rollup rows rather than
+    scanning every Form and FormItem.
+    Take snapshot(form) before changing a form's items and call
+    apply_form(form, snapshot) afterwards, inside the same transaction; a
+    new form needs only apply_form(form). The difference is written with one
+    INSERT ... ON CONFLICT DO UPDATE per rollup table.
+    """
+
+    @staticmethod
+    def _grouped_totals(items, *group_by):
+        """Line count, quantity and revenue of `items` grouped by category and `group_by`"""
+        return (
+            items.annotate(category=Upper('drug_type'))
+            .values('category', *group_by)
+            .annotate(line_count=Count('id'), quantity=Sum('quantity'), revenue=Sum('subtotal'))
+            .order_by()
+        )
+
+    @classmethod
+    def snapshot(cls, form):
+        """{(category, drug name): [line count, quantity, revenue]} of a form's items, in one query"""
+        return {
+            (row['category'], row['drug_name']): [row['line_count'], row['quantity'] or 0, row['revenue'] or Decimal('0')]
+            for row in cls._grouped_totals(FormItem.objects.filter(form=form), 'drug_name')
+        }
+
+    @staticmethod
+    def _upsert(model, unique_fields, rows):
+        """
+        Add each row's counters to the rollup row with the same key, creating
+        it when missing, in one statement. Rows with a NULL key part are
+        updated one by one, as NULLs never conflict in a unique constraint.
+        """
+        keyed = []
+        for row in rows:
+            if all(row[name] is not None for name in unique_fields):
+                keyed.append(row)
+                continue
+            keys = {name: row[name] for name in unique_fields}
+            counters = {name: value for name, value in row.items() if name not in unique_fields}
+            if not model.objects.filter(**keys).update(**{name: F(name) + value for name, value in counters.items()}):
+                model.objects.create(**row)
+        rows = keyed
+        if not rows:
+            return
+
+        quote = connection.ops.quote_name
+        table = quote(model._meta.db_table)
+        fields = [model._meta.get_field(name) for name in rows[0]]
+        columns = [quote(field.column) for field in fields]
+        counters = [quote(field.column) for field in fields if field.name not in unique_fields]
+        keys = [quote(field.column) for field in fields if field.name in unique_fields]
+        placeholders = '(' + ', '.join(['%s'] * len(fields)) + ')'
+        sql = (
+            f"INSERT INTO {table} ({', '.join(columns)}) VALUES {', '.join([placeholders] * len(rows))} "
+            f"ON CONFLICT ({', '.join(keys)}) DO UPDATE SET "
+            + ', '.join(f'{column} = {table}.{column} + excluded.{column}' for column in counters)
+        )
+        params = [field.get_db_prep_save(row[field.name], connection) for row in rows for field in fields]
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+
+    @classmethod
+    def apply_form(cls, form, previous=None):
+        """
+        Move a form's rollup rows from `previous` (its snapshot() before the
+        items changed; nothing for a new form) to its current items
+        """
+        previous = previous or {}
+        current = cls.snapshot(form)
+        day = timezone.localdate(form.date)
+
+        drug_rows = []
+        categories = {}
+        for key in previous.keys() | current.keys():
+            before = previous.get(key, [0, 0, Decimal('0')])
+            after = current.get(key, [0, 0, Decimal('0')])
+            totals = categories.setdefault(key[0], [[0, 0, Decimal('0')], [0, 0, Decimal('0')]])
+            for i in range(3):
+                totals[0][i] += before[i]
+                totals[1][i] += after[i]
+            if before != after:
+                drug_rows.append({
+                    'day': day, 'drug_type': key[0], 'drug_name': key[1],
+                    'line_count': after[0] - before[0],
+                    'quantity': after[1] - before[1],
+                    'revenue': after[2] - before[2],
                 })
-            
-            # Update all expired items to zero stock
-            expired_with_stock.update(stock=0)
-        
-        return len(expired_items), expired_items
+        sales_rows = [
+            {
+                'day': day, 'drug_type': category, 'dispensed_by': form.dispensed_by_id,
+                # Forms are counted once per category they have lines in
+                'form_count': (after[0] > 0) - (before[0] > 0),
+                'line_count': after[0] - before[0],
+                'quantity': after[1] - before[1],
+                'revenue': after[2] - before[2],
+            }
+            for category, (before, after) in categories.items()
+            if before != after
+        ]
+
+        with transaction.atomic(savepoint=False):
+            cls._upsert(DailySalesRollup, ('day', 'drug_type', 'dispensed_by'), sales_rows)
+            cls._upsert(DailyDrugSalesRollup, ('day', 'drug_type', 'drug_name'), drug_rows)
+            if any(row['line_count'] < 0 for row in sales_rows):
+                DailySalesRollup.objects.filter(
+                    day=day, dispensed_by_id=form.dispensed_by_id, line_count__lte=0
+                ).delete()
+            if any(row['line_count'] < 0 for row in drug_rows):
+                DailyDrugSalesRollup.objects.filter(day=day, line_count__lte=0).delete()
+
+    @classmethod
+    def rebuild(cls, start=None, end=None):
+        """
+        Recompute rollup rows from FormItem for days in [start, end] (all days
+        when omitted). Returns the number of DailySalesRollup rows written.
+        """
+        items = FormItem.objects.annotate(day=TruncDate('form__date'))
+        sales = DailySalesRollup.objects.all()
+        drug_sales = DailyDrugSalesRollup.objects.all()
+        if start:
+            items = items.filter(day__gte=start)
+            sales = sales.filter(day__gte=start)
+            drug_sales = drug_sales.filter(day__gte=start)
+        if end:
+            items = items.filter(day__lte=end)
+            sales = sales.filter(day__lte=end)
+            drug_sales = drug_sales.filter(day__lte=end)
+
+        new_sales = [
+            DailySalesRollup(
+                day=row['day'],
+                drug_type=row['category'],
+                dispensed_by_id=row['form__dispensed_by'],
+                form_count=row['form_count'],
+                line_count=row['line_count'],
+                quantity=row['quantity'] or 0,
+                revenue=row['revenue'] or Decimal('0'),
+            )
+            for row in cls._grouped_totals(items, 'day', 'form__dispensed_by')
+            .annotate(form_count=Count('form', distinct=True))
+            .iterator()
+        ]
+        new_drug_sales = [
+            DailyDrugSalesRollup(
+                day=row['day'],
+                drug_type=row['category'],
+                drug_name=row['drug_name'],
+                line_count=row['line_count'],
+                quantity=row['quantity'] or 0,
+                revenue=row['revenue'] or Decimal('0'),
+            )
+            for row in cls._grouped_totals(items, 'day', 'drug_name').iterator()
+        ]
+
+        with transaction.atomic():
+            sales.delete()
+            drug_sales.delete()
+            DailySalesRollup.objects.bulk_create(new_sales, batch_size=500)
+            DailyDrugSalesRollup.objects.bulk_create(new_drug_sales, batch_size=500)
+        return len(new_sales)
+
+    @staticmethod
+    def period_totals(start=None, end=None, **filters):
+        """
+        Sum rollup rows for days in [start, end]. Extra keyword filters
+        (e.g. drug_type='NCAP', dispensed_by=user) narrow the rows.
+        """
+        rollups = DailySalesRollup.objects.filter(**filters)
+        if start:
+            rollups = rollups.filter(day__gte=start)
+        if end:
+            rollups = rollups.filter(day__lte=end)
+        totals = rollups.aggregate(
+            line_count=Sum('line_count'),
+            quantity=Sum('quantity'),
+            revenue=Sum('revenue'),
+        )
+        return {
+            'line_count': totals['line_count'] or 0,
+            'quantity': totals['quantity'] or 0,
+            'revenue': totals['revenue'] or Decimal('0'),
+        }
+
+
+class SalesAnalyticsService:
+    """
+    Time-bucketed sales reports read from the rollup tables. Each report is
+    cached per (bucket, window start) so repeat visits skip the database.
+    """
+
+    # bucket -> (number of periods shown, Trunc kind)
+    BUCKETS = {
+        'day': (30, 'day'),
+        'week': (12, 'week'),
+        'month': (12, 'month'),
+    }
+    CATEGORIES = ['LPACEMAKER', 'NCAP', 'ONCOLOGY']
+    CACHE_PREFIX = 'sales-analytics'
+
+    @classmethod
+    def periods(cls, bucket, today=None):
+        """Return the list of period start dates for a bucket, oldest first"""
+        count, _ = cls.BUCKETS[bucket]
+        today = today or timezone.localdate()
+        if bucket == 'day':
+            return [today - timedelta(days=i) for i in range(count - 1, -1, -1)]
+        if bucket == 'week':
+            this_week = today - timedelta(days=today.weekday())
+            return [this_week - timedelta(weeks=i) for i in range(count - 1, -1, -1)]
+        periods = []
+        year, month = today.year, today.month
+        for _ in range(count):
+            periods.append(date(year, month, 1))
+            year, month = (year, month - 1) if month > 1 else (year - 1, 12)
+        return list(reversed(periods))
+
+    @classmethod
+    def report(cls, bucket='day', top_n=10):
+        if bucket not in cls.BUCKETS:
+            raise ValueError(f"Invalid bucket: {bucket}")
+        periods = cls.periods(bucket)
+        start = periods[0]
+        cache_key = f'{cls.CACHE_PREFIX}:{bucket}:{start.isoformat()}:{top_n}'
+        report = cache.get(cache_key)
+        if report is None:
+            report = cls._build_report(bucket, periods, top_n)
+            cache.set(cache_key, report, getattr(settings, 'SALES_ANALYTICS_CACHE_TIMEOUT', 300))
+        return report
+
+    @classmethod
+    def _build_report(cls, bucket, periods, top_n):
+        _, kind = cls.BUCKETS[bucket]
+        start = periods[0]
+        sales = DailySalesRollup.objects.filter(day__gte=start)
+
+        # Revenue per category per period
+        period_expr = F('day') if kind == 'day' else Trunc('day', kind, output_field=DateField())
+        revenue = {category: {period: Decimal('0') for period in periods} for category in cls.CATEGORIES}
+        rows = (
+            sales.annotate(period=period_expr)
+            .values('period', 'drug_type')
+            .annotate(revenue=Sum('revenue'))
+            .order_by()
+        )
+        for row in rows:
+            series = revenue.setdefault(row['drug_type'], {period: Decimal('0') for period in periods})
+            if row['period'] in series:
+                series[row['period']] += row['revenue'] or Decimal('0')
+
+        # Per-pharmacist throughput over the whole window
+        pharmacists = list(
+            sales.values('dispensed_by', 'dispensed_by__username', 'dispensed_by__mobile')
+            .annotate(line_count=Sum('line_count'), quantity=Sum('quantity'), revenue=Sum('revenue'))
+            .order_by('-revenue')
+        )
+
+        # Top-selling drugs over the whole window
+        top_drugs = list(
+            DailyDrugSalesRollup.objects.filter(day__gte=start)
+            .values('drug_type', 'drug_name')
+            .annotate(quantity=Sum('quantity'), revenue=Sum('revenue'))
+            .order_by('-quantity', '-revenue')[:top_n]
+        )
+
+        return {
+            'bucket': bucket,
+            'periods': periods,
+            'revenue_by_category': {
+                category: [series[period] for period in periods] for category, series in revenue.items()
+            },
+            'total_revenue': sum((sum(series.values()) for series in revenue.values()), Decimal('0')),
+            'pharmacists': pharmacists,
+            'top_drugs': top_drugs,
+        }
+
+
+class ReceiptService:
+    """
+    Renders receipts once and keeps the bytes in ReceiptDocument, so reprints
+    never touch Form/FormItem or the template engine. Call invalidate(form)
+    whenever a form or its items change; it bumps Form.receipt_version, and
+    a document is only served while it was rendered at the current version,
+    so a render that raced with an edit is stored but never served.
+    """
+
+    VARIANTS = [value for value, _ in ReceiptDocument.VARIANT_CHOICES]
+
+    @staticmethod
+    def context(form, items):
+        """Template context shared by the receipt document and the form detail page"""
+        return {
+            'form': form,
+            'items': items,
+            'category_totals': FormService.category_totals(form),
+            'total_amount': form.total_amount,
+        }
+
+    @classmethod
+    def render(cls, form, variant='html'):
+        """Render one variant of a form's receipt to bytes"""
+        context = cls.context(form, form.items.all())
+        context['variant'] = variant
+        return render_to_string('store/receipt_document.html', context).encode()
+
+    @classmethod
+    def store(cls, form, variants=None):
+        """
+        Render and save the given variants (all by default) at the version
+        `form` was read at; returns {variant: document}
+        """
+        documents = {}
+        for variant in variants or cls.VARIANTS:
+            body = cls.render(form, variant)
+            documents[variant] = ReceiptDocument(
+                form=form, variant=variant, body=body,
+                content_hash=hashlib.sha256(body).hexdigest(), form_version=form.receipt_version,
+            )
+        # One upsert; a concurrent render of the same form replaces the row
+        # instead of failing on the unique constraint
+        ReceiptDocument.objects.bulk_create(
+            documents.values(),
+            update_conflicts=True,
+            unique_fields=['form', 'variant'],
+            update_fields=['body', 'content_hash', 'form_version'],
+        )
+        return documents
+
+    @classmethod
+    def get_document(cls, form_id, variant='html'):
+        """
+        Stored receipt for `form_id`, rendering it on first use after checkout
+        or an edit. Returns None if the form does not exist.
+        """
+        if variant not in cls.VARIANTS:
+            variant = 'html'
+        document = ReceiptDocument.objects.filter(
+            form__form_id=form_id, variant=variant, form_version=F('form__receipt_version'),
+        ).first()
+        if document is None:
+            form = Form.objects.select_related('dispensed_by').filter(form_id=form_id).first()
+            if form is None:
+                return None
+            document = cls.store(form, [variant])[variant]
+        return document
+
+    @staticmethod
+    def invalidate(form):
+        Form.objects.filter(pk=form.pk).update(receipt_version=F('receipt_version') + 1)
+
+
+class DashboardService:
+    """
+    Dashboard figures in as few queries as possible: one row of catalog and
+    cart counts, the recent forms, and (for staff) user statistics that are
+    cached and dropped by the User/Profile/Group signal handlers in models.py.
+    """
+
+    @staticmethod
+    def _count(queryset):
+        """Scalar subquery counting the rows of `queryset`"""
+        return Subquery(
+            queryset.order_by().annotate(row_count=Func(F('pk'), function='COUNT')).values('row_count'),
+            output_field=IntegerField(),
+        )
+
+    @classmethod
+    def counts(cls, user):
+        """Catalog sizes and the user's cart size in a single query"""
+        if categories_split():
+            # Catalogs in other database files cannot be subqueries here
+            counts = User.objects.filter(pk=user.pk).values(
+                cart_count=cls._count(Cart.objects.filter(user=OuterRef('pk'))),
+            ).get()
+            counts.update(
+                lpacemaker_count=LpacemakerDrugs.objects.count(),
+                ncap_count=NcapDrugs.objects.count(),
+                oncology_count=OncologyPharmacy.objects.count(),
+            )
+            return counts
+        return User.objects.filter(pk=user.pk).values(
+            lpacemaker_count=cls._count(LpacemakerDrugs.objects.all()),
+            ncap_count=cls._count(NcapDrugs.objects.all()),
+            oncology_count=cls._count(OncologyPharmacy.objects.all()),
+            cart_count=cls._count(Cart.objects.filter(user=OuterRef('pk'))),
+        ).get()
+
+    @staticmethod
+    def recent_forms(limit=5):
+        return list(Form.objects.order_by('-date')[:limit])
+
+    @classmethod
+    def user_stats(cls):
+        """User counts by category plus the group count, cached briefly"""
+        stats = cache.get(USER_STATS_CACHE_KEY)
+        if stats is None:
+            stats = User.objects.aggregate(
+                admin_users=Count('pk', filter=Q(profile__user_type='Admin')),
+                pharmacist_users=Count('pk', filter=Q(profile__user_type='Pharmacist')),
+                tech_users=Count('pk', filter=Q(profile__user_type='Pharm-Tech')),
+                total_users=Count('pk'),
+                active_staff=Count('pk', filter=Q(is_staff=True, is_active=True)),
+                # Uncorrelated subquery; Max() only lets it ride along in the aggregate
+                total_groups=Max(cls._count(Group.objects.all())),
+            )
+            stats['total_groups'] = stats['total_groups'] or 0
+            cache.set(
+                USER_STATS_CACHE_KEY, stats,
+                getattr(settings, 'DASHBOARD_USER_STATS_CACHE_TIMEOUT', 60),
+            )
+        return stats
+
+
+class InventoryImportError(ValueError):
+    """Raised when an import file cannot be read at all (e.g. missing columns)"""
+
+
+class InventoryImportService:
+    """
+    Bulk stock intake from CSV. Rows are read in chunks; each chunk is
+    validated, matched against existing drugs by (category, name, brand, unit)
+    through a lookup dict built once per import, and written with one
+    bulk_create and one bulk_update inside a transaction.
+    The price rule from the drug models' save() is applied here, since bulk
+    writes bypass save(). Deliveries are recorded as new StockLots and added
+    to `stock` as deltas, so sales made while the import runs are kept; stock
+    counts (replace_stock) are reconciled lot by lot through StockLotService.
+    """
+
+    CHUNK_SIZE = 500
+    REQUIRED_COLUMNS = ('category', 'name', 'cost')
+    # `stock` is only written back for stock counts; deliveries add to it
+    UPDATE_FIELDS = ['dosage_form', 'cost', 'markup', 'price', 'exp_date']
+
+    # Header spellings accepted for each column, including the inventory export's
+    COLUMN_ALIASES = {
+        'category': 'category',
+        'store': 'category',
+        'store_type': 'category',
+        'name': 'name',
+        'drug': 'name',
+        'drug_name': 'name',
+        'brand': 'brand',
+        'dosage_form': 'dosage_form',
+        'unit': 'unit',
+        'cost': 'cost',
+        'markup': 'markup',
+        'price': 'price',
+        'stock': 'stock',
+        'quantity': 'stock',
+        'exp_date': 'exp_date',
+        'expiry_date': 'exp_date',
+    }
+
+    _UNITS = {value.lower(): value for value, _ in UNIT}
+    _DOSAGE_FORMS = {value.lower(): value for value, _ in DOSAGE_FORM}
+    _MARKUPS = {value for value, _ in MARKUP_CHOICES}
+
+    @staticmethod
+    def compute_price(cost, markup):
+        """Selling price for `cost` at `markup` percent, rounded to kobo"""
+        return markup_price(cost, markup)
+
+    @staticmethod
+    def match_key(category, name, brand, unit):
+        return (category, name.strip().lower(), (brand or '').strip().lower(), (unit or '').strip().lower())
+
+    @classmethod
+    def _normalise_header(cls, header):
+        columns = []
+        for column in header:
+            key = (column or '').strip().lower().replace(' ', '_').replace('-', '_')
+            columns.append(cls.COLUMN_ALIASES.get(key))
+        missing = [column for column in cls.REQUIRED_COLUMNS if column not in columns]
+        if missing:
+            raise InventoryImportError(f"Missing required column(s): {', '.join(missing)}")
+        return columns
+
+    @classmethod
+    def _clean_row(cls, values, today):
+        """Validate one parsed row; returns the cleaned dict or raises ValueError"""
+        category = values.get('category', '').lower()
+        if category not in ('lpacemaker', 'ncap', 'oncology'):
+            raise ValueError(f"unknown category '{values.get('category', '')}'")
+
+        name = values.get('name', '')
+        if not name:
+            raise ValueError('name is required')
+
+        unit = values.get('unit') or None
+        if unit:
+            unit = cls._UNITS.get(unit.lower())
+            if unit is None:
+                raise ValueError(f"unknown unit '{values['unit']}'")
+
+        dosage_form = values.get('dosage_form') or None
+        if dosage_form:
+            dosage_form = cls._DOSAGE_FORMS.get(dosage_form.lower())
+            if dosage_form is None:
+                raise ValueError(f"unknown dosage form '{values['dosage_form']}'")
+
+        try:
+            cost = Decimal(values.get('cost') or '0')
+        except InvalidOperation:
+            raise ValueError(f"invalid cost '{values.get('cost')}'")
+        if cost < 0:
+            raise ValueError('cost cannot be negative')
+
+        markup = (values.get('markup') or '10').rstrip('%').strip()
+        if markup not in cls._MARKUPS:
+            raise ValueError(f"invalid markup '{values.get('markup')}'")
+
+        price = None
+        if values.get('price'):
+            try:
+                price = Decimal(values['price'])
+            except InvalidOperation:
+                raise ValueError(f"invalid price '{values['price']}'")
+        if cost:
+            price = cls.compute_price(cost, markup)
+
+        try:
+            stock = int(values.get('stock') or 0)
+        except ValueError:
+            raise ValueError(f"invalid stock '{values.get('stock')}'")
+        if stock < 0:
+            raise ValueError('stock cannot be negative')
+
+        exp_date = None
+        if values.get('exp_date'):
+            try:
+                exp_date = date.fromisoformat(values['exp_date'][:10])
+            except ValueError:
+                raise ValueError(f"invalid expiry date '{values['exp_date']}' (use YYYY-MM-DD)")
+
+        return {
+            'category': category,
+            'name': name,
+            'brand': values.get('brand') or None,
+            'dosage_form': dosage_form,
+            'unit': unit,
+            'cost': cost,
+            'markup': markup,
+            'price': price,
+            'stock': stock,
+            'exp_date': exp_date,
+            'expired': exp_date is not None and exp_date < today,
+        }
+
+    @classmethod
+    def _build_lookup(cls):
+        """Map match keys to existing drug instances for every category"""
+        lookup = {}
+        for category in ('lpacemaker', 'ncap', 'oncology'):
+            model = DrugService.get_drug_model(category)
+            for drug in model.objects.order_by('id'):
+                lookup.setdefault(cls.match_key(category, drug.name, drug.brand, drug.unit), drug)
+        return lookup
+
+    @classmethod
+    def _write_chunk(cls, rows, lookup, replace_stock):
+        """Upsert one chunk of cleaned rows; returns (created, updated)"""
+        to_create = {}
+        to_update = {}
+        deliveries = []
+        counted = {}
+        for row in rows:
+            key = cls.match_key(row['category'], row['name'], row['brand'], row['unit'])
+            drug = lookup.get(key) or to_create.get(key)
+            if drug is None:
+                model = DrugService.get_drug_model(row['category'])
+                drug = model(name=row['name'], brand=row['brand'], unit=row['unit'], stock=0, price=0)
+                to_create[key] = drug
+            elif drug.pk:
+                to_update.setdefault(row['category'], {})[drug.pk] = drug
+
+            if replace_stock:
+                # A stock count; expired stock is never sellable
+                drug.stock = 0 if row['expired'] else row['stock']
+                counted[key] = (row['category'], drug)
+            elif not row['expired'] and row['stock']:
+                # A delivery becomes a new lot; existing drugs get it added in the UPDATE below
+                if not drug.pk:
+                    drug.stock = (drug.stock or 0) + row['stock']
+                deliveries.append((row['category'], drug, row['exp_date'], row['stock']))
+            drug.cost = row['cost']
+            drug.markup = row['markup']
+            if row['price'] is not None:
+                drug.price = row['price']
+            if row['dosage_form']:
+                drug.dosage_form = row['dosage_form']
+            if row['exp_date'] and (replace_stock or not drug.pk):
+                drug.exp_date = row['exp_date']
+
+        now = timezone.now()
+        update_fields = cls.UPDATE_FIELDS + (['stock'] if replace_stock else []) + ['updated_at']
+        with stock_atomic(*{row['category'] for row in rows}):
+            by_model = {}
+            for drug in to_create.values():
+                by_model.setdefault(type(drug), []).append(drug)
+            for model, drugs in by_model.items():
+                for drug in drugs:
+                    drug.created_at = drug.updated_at = now
+                model.objects.bulk_create(drugs, batch_size=cls.CHUNK_SIZE)
+            for category, drugs in to_update.items():
+                for drug in drugs.values():
+                    drug.updated_at = now
+                DrugService.get_drug_model(category).objects.bulk_update(
+                    list(drugs.values()), update_fields, batch_size=cls.CHUNK_SIZE
+                )
+
+            # Deliveries: one new lot per row, added to the stock of drugs that already existed
+            lots = {}
+            delivered = {}
+            for category, drug, exp_date, quantity in deliveries:
+                lots.setdefault(stock_database(category), []).append(
+                    StockLot(**{DrugService.get_drug_field_name(category): drug}, exp_date=exp_date, quantity=quantity)
+                )
+                if drug.pk in to_update.get(category, {}):
+                    drugs = delivered.setdefault(category, {})
+                    drugs[drug.pk] = drugs.get(drug.pk, 0) + quantity
+            for alias, category_lots in lots.items():
+                StockLot.objects.using(alias).bulk_create(category_lots, batch_size=cls.CHUNK_SIZE)
+            for category, deltas in delivered.items():
+                StockLotService.adjust_drugs(category, deltas)
+            # Then refresh the next expiry of every other drug touched
+            by_category = {category: set(drugs) for category, drugs in to_update.items()}
+            for category, drug, _, _ in deliveries:
+                by_category.setdefault(category, set()).add(drug.pk)
+            for category, ids in by_category.items():
+                ids -= set(delivered.get(category, ()))
+                if not ids:
+                    continue
+                field = DrugService.get_drug_field_name(category)
+                DrugService.get_drug_model(category).objects.filter(pk__in=ids).update(
+                    exp_date=StockLotService.next_expiry(field)
+                )
+            # Stock counts: reconcile each counted drug's lots
+            for category, drug in counted.values():
+                StockLotService.sync(category, drug)
+
+        # Later chunks must see the drugs created by this one
+        lookup.update(to_create)
+        return len(to_create), sum(len(drugs) for drugs in to_update.values())
+
+    @classmethod
+    def import_csv(cls, lines, replace_stock=False, chunk_size=None, progress=None):
+        """
+        Import inventory rows from an iterable of CSV text lines.
+        By default stock is added to the existing level (a delivery); pass
+        replace_stock=True to overwrite it (a stock count). `progress` is called
+        after every chunk with the running summary dict.
+        Returns {'processed', 'created', 'updated', 'errors'}, where errors is a
+        list of (line_number, message) for rows that were skipped.
+        """
+        chunk_size = chunk_size or cls.CHUNK_SIZE
+        reader = csv.reader(lines)
+        try:
+            columns = cls._normalise_header(next(reader))
+        except StopIteration:
+            raise InventoryImportError('The file is empty')
+
+        today = timezone.now().date()
+        lookup = cls._build_lookup()
+        summary = {'processed': 0, 'created': 0, 'updated': 0, 'errors': []}
+
+        while True:
+            chunk = list(islice(reader, chunk_size))
+            if not chunk:
+                break
+            rows = []
+            for raw in chunk:
+                summary['processed'] += 1
+                if not any(value.strip() for value in raw):
+                    continue
+                values = {
+                    column: value.strip()
+                    for column, value in zip(columns, raw)
+                    if column is not None
+                }
+                try:
+                    rows.append(cls._clean_row(values, today))
+                except ValueError as e:
+                    summary['errors'].append((summary['processed'] + 1, str(e)))
+            created, updated = cls._write_chunk(rows, lookup, replace_stock)
+            summary['created'] += created
+            summary['updated'] += updated
+            if progress:
+                progress(summary)
+
+        return summary
+
+
+class RepricingError(ValueError):
+    """Raised for markup tiers that are not in MARKUP_CHOICES"""
+
+
+class RepricingService:
+    """
+    Applies markup changes to a whole store with a single UPDATE. The new
+    markup and price are Case/When expressions with one branch per markup
+    tier. Prices are computed in integer kobo, ROUND(cost * 100) scaled by
+    (100 + markup) and rounded half-up by integer division, so the database
+    arrives at exactly the Decimal value markup_price() gives. Rows without a
+    cost keep their manual price, as in the drug models' save(). Every
+    changed row gets a PriceChange record, written with bulk_create.
+    """
+
+    HISTORY_BATCH_SIZE = 500
+    _MARKUPS = {value for value, _ in MARKUP_CHOICES}
+
+    @classmethod
+    def clean_tiers(cls, tiers=None):
+        """{old markup: new markup}; None reprices every tier at its current markup"""
+        if tiers is None:
+            return {value: value for value, _ in MARKUP_CHOICES}
+        cleaned = {}
+        for old, new in tiers.items():
+            old, new = str(old).strip(), str(new).strip()
+            for markup in (old, new):
+                if markup not in cls._MARKUPS:
+                    raise RepricingError(f"Invalid markup tier '{markup}'")
+            cleaned[old] = new
+        return cleaned
+
+    @staticmethod
+    def _price_expression(markup):
+        """Price of the row's cost at `markup` percent, exact to the kobo"""
+        cost_kobo = Cast(Round(F('cost') * Value(100)), IntegerField())
+        price_kobo = (cost_kobo * Value(100 + int(markup)) + Value(50)) / Value(100)
+        return ExpressionWrapper(price_kobo / Value(100.0), output_field=DecimalField(max_digits=12, decimal_places=2))
+
+    @classmethod
+    def _expressions(cls, tiers):
+        new_markup = Case(
+            *[When(markup=old, then=Value(new)) for old, new in tiers.items()],
+            output_field=CharField(),
+        )
+        new_price = Case(
+            *[When(markup=old, cost__gt=0, then=cls._price_expression(new)) for old, new in tiers.items()],
+            default=F('price'),
+            output_field=DecimalField(max_digits=12, decimal_places=2),
+        )
+        return new_markup, new_price
+
+    @classmethod
+    def reprice(cls, category, tiers=None, ids=None, dry_run=False, user=None):
+        """
+        Move drugs in `category` from each old markup tier to its new one and
+        recompute their prices; `ids` limits the run to those drugs. Returns
+        the diff of changed rows; with `dry_run` nothing is written.
+        """
+        model = DrugService.get_drug_model(category)
+        tiers = cls.clean_tiers(tiers)
+        new_markup, new_price = cls._expressions(tiers)
+
+        queryset = model.objects.filter(markup__in=list(tiers))
+        if ids is not None:
+            queryset = queryset.filter(pk__in=ids)
+        # Only rows whose markup or price actually changes
+        queryset = queryset.annotate(new_markup=new_markup, new_price=new_price).exclude(
+            markup=F('new_markup'), price=F('new_price'),
+        )
+
+        summary = {
+            'category': category.lower(),
+            'tiers': tiers,
+            'changes': [],
+            'changed': 0,
+            'batch': None,
+            'dry_run': dry_run,
+        }
+        # The price history is in the main database; with per-category files
+        # that one is locked first, in the same order as offline replay
+        with transaction.atomic(), stock_atomic(category):
+            changes = list(
+                queryset.select_for_update()
+                .order_by('name', 'id')
+                .values('id', 'name', 'brand', 'cost', 'markup', 'price', 'new_markup', 'new_price')
+            )
+            for change in changes:
+                # Computed columns come back unscaled on some backends
+                change['new_price'] = change['new_price'].quantize(Decimal('0.01'))
+                change['difference'] = change['new_price'] - change['price']
+            summary['changes'] = changes
+            summary['changed'] = len(changes)
+            if dry_run or not changes:
+                return summary
+
+            queryset.update(markup=new_markup, price=new_price, updated_at=timezone.now())
+
+            batch = uuid.uuid4().hex
+            drug_type = category.upper()
+            PriceChange.objects.bulk_create(
+                [
+                    PriceChange(
+                        batch=batch,
+                        drug_type=drug_type,
+                        drug_id=change['id'],
+                        drug_name=change['name'],
+                        cost=change['cost'],
+                        old_markup=change['markup'],
+                        new_markup=change['new_markup'],
+                        old_price=change['price'],
+                        new_price=change['new_price'],
+                        changed_by=user,
+                    )
+                    for change in changes
+                ],
+                batch_size=cls.HISTORY_BATCH_SIZE,
+            )
+            summary['batch'] = batch
+        return summary
+
+
+class OfflineReplayError(ValueError):
+    """An offline transaction that could not be applied"""
+
+
+class OfflineReplayService:
+    """
+    Replays OfflineTransactions queued by disconnected counters. Pending
+    transactions are claimed in chunks ordered by (created_at, id) and
+    partitioned by user, so each counter's actions apply in order. Each
+    transaction runs in its own savepoint through DrugService, and the
+    results for a chunk are written back with one UPDATE. A failure is
+    retried with exponential backoff on retry_count and quarantined after
+    OFFLINE_REPLAY_MAX_RETRIES attempts; the same user's later transactions
+    in the chunk wait behind it instead of applying out of order.
+
+    Every stock change bumps the drug's version, and an add to cart carries
+    the version the counter last saw. An add queued against an older version
+    than the drug now has, beyond the bumps made by that counter's own
+    earlier adds and removes queued against the same version, is a conflict
+    (another counter or the store changed the stock meanwhile), resolved by
+    OFFLINE_REPLAY_CONFLICT_POLICY:
+    'reject' quarantines it, 'clamp' applies it with the quantity cut to the
+    stock left (rejecting it when none is), and 'review' (the default)
+    quarantines it for a person to apply or discard from the admin.
+
+    Several workers can drain the queue at once. A worker claims its chunk by
+    leasing the rows (claimed_by, lease_expires) and skips rows leased by
+    others, as well as every transaction of a user whose earlier ones another
+    worker holds, so each counter is still replayed in order by one worker
+    at a time. A crashed worker's lease runs out after
+    OFFLINE_REPLAY_LEASE_SECONDS and its rows are claimed again.
+    """
+
+    CHUNK_SIZE = 200
+    RETRY_DELAY = 60  # seconds before the first retry, doubled for each one after
+    CONFLICT_POLICIES = ('reject', 'clamp', 'review')
+    # Note on a replayed remove whose line was already gone (no version bump)
+    NOTHING_TO_REMOVE = 'Nothing to remove'
+
+    @staticmethod
+    def max_retries():
+        return getattr(settings, 'OFFLINE_REPLAY_MAX_RETRIES', 5)
+
+    @staticmethod
+    def lease_seconds():
+        return getattr(settings, 'OFFLINE_REPLAY_LEASE_SECONDS', 300)
+
+    @classmethod
+    def conflict_policy(cls):
+        policy = getattr(settings, 'OFFLINE_REPLAY_CONFLICT_POLICY', 'review')
+        if policy not in cls.CONFLICT_POLICIES:
+            raise OfflineReplayError(
+                f"OFFLINE_REPLAY_CONFLICT_POLICY must be one of {', '.join(cls.CONFLICT_POLICIES)}, not {policy!r}"
+            )
+        return policy
+
+    @staticmethod
+    def pending(now=None):
+        """Transactions due for replay and not leased by a worker"""
+        now = now or timezone.now()
+        return OfflineTransaction.objects.filter(synced=False, quarantined=False).filter(
+            Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=now),
+            Q(lease_expires__isnull=True) | Q(lease_expires__lte=now),
+        )
+
+    @classmethod
+    def claim(cls, worker, size, now=None):
+        """
+        Lease up to `size` due transactions to `worker` and return them in
+        replay order. Uses SELECT ... FOR UPDATE SKIP LOCKED where the
+        database supports it; elsewhere (SQLite) one conditional UPDATE takes
+        the rows, which is atomic as SQLite runs one writer at a time.
+        """
+        now = now or timezone.now()
+        lease_expires = now + timedelta(seconds=cls.lease_seconds())
+        held_by_others = (
+            OfflineTransaction.objects.alias(partition=KT('data__user_id'))
+            .filter(synced=False, lease_expires__gt=now, partition=OuterRef('partition'))
+            .exclude(claimed_by=worker)
+        )
+        candidates = (
+            cls.pending(now)
+            .alias(partition=KT('data__user_id'))
+            .exclude(Exists(held_by_others))
+            .order_by('created_at', 'id')
+        )
+        if connection.features.has_select_for_update_skip_locked:
+            with transaction.atomic():
+                ids = list(candidates.select_for_update(skip_locked=True).values_list('id', flat=True)[:size])
+                OfflineTransaction.objects.filter(pk__in=ids).update(claimed_by=worker, lease_expires=lease_expires)
+        else:
+            OfflineTransaction.objects.filter(pk__in=Subquery(candidates.values('id')[:size])).update(
+                claimed_by=worker, lease_expires=lease_expires,
+            )
+        return list(
+            OfflineTransaction.objects.filter(claimed_by=worker, lease_expires=lease_expires, synced=False)
+            .order_by('created_at', 'id')
+        )
+
+    @staticmethod
+    def apply(txn, user=None, quantity=None):
+        """
+        Apply one transaction through DrugService, adding `quantity` instead of
+        the queued quantity if given. Returns the change to the drug's stock;
+        raises OfflineReplayError if it cannot be applied.
+        """
+        data = txn.data if isinstance(txn.data, dict) else {}
+        if user is None:
+            user = User.objects.filter(pk=data.get('user_id')).first()
+        if user is None:
+            raise OfflineReplayError(f"Unknown user {data.get('user_id')!r}")
+
+        if txn.transaction_type == 'ADD_TO_CART':
+            if quantity is None:
+                try:
+                    quantity = int(data.get('quantity', 1))
+                except (TypeError, ValueError):
+                    raise OfflineReplayError(f"Invalid quantity {data.get('quantity')!r}")
+            success, message, _ = DrugService.add_to_cart(user, str(data.get('drug_type', '')), data.get('drug_id'), quantity)
+            if not success:
+                raise OfflineReplayError(message)
+            return -quantity
+        elif txn.transaction_type == 'REMOVE_FROM_CART':
+            # Removing a line that is already gone is not an error on replay
+            return DrugService.remove_from_cart(user, str(data.get('drug_type', '')), data.get('drug_id'))
+        elif txn.transaction_type == 'CHECKOUT':
+            form_record = DrugService.checkout(
+                user, data.get('buyer_name'), data.get('hospital_no'), data.get('ncap_no'),
+            )
+            ReceiptService.store(form_record)
+            return 0
+        else:
+            raise OfflineReplayError(f"Unknown transaction type {txn.transaction_type!r}")
+
+    @staticmethod
+    def _drug_key(txn):
+        """(drug type, drug id) whose stock an add or remove changes, or None"""
+        if txn.transaction_type not in ('ADD_TO_CART', 'REMOVE_FROM_CART') or not isinstance(txn.data, dict):
+            return None
+        drug_type = str(txn.data.get('drug_type', '')).lower()
+        try:
+            drug_id = int(txn.data.get('drug_id'))
+        except (TypeError, ValueError):
+            return None
+        if drug_type not in ('lpacemaker', 'ncap', 'oncology'):
+            return None
+        return drug_type, drug_id
+
+    @classmethod
+    def _drug_state(cls, chunk):
+        """{(drug type, drug id): [version, stock]} for the drugs a chunk touches, in one query"""
+        ids = {}
+        for txn in chunk:
+            key = cls._drug_key(txn)
+            if key:
+                ids.setdefault(key[0], set()).add(key[1])
+        queries = [
+            DrugService.get_drug_model(drug_type).objects.filter(pk__in=drug_ids)
+            .annotate(drug_type=Value(drug_type, output_field=CharField()))
+            .order_by()
+            .values_list('drug_type', 'id', 'version', 'stock')
+            for drug_type, drug_ids in ids.items()
+        ]
+        if not queries:
+            return {}
+        if categories_split():
+            # Tables in different database files cannot be combined in a UNION
+            rows = [row for query in queries for row in query]
+        else:
+            rows = queries[0].union(*queries[1:], all=True) if len(queries) > 1 else queries[0]
+        return {(drug_type, drug_id): [version, stock or 0] for drug_type, drug_id, version, stock in rows}
+
+    @classmethod
+    def _own_key(cls, txn):
+        """(client id, user, drug key, version queued against) an add or remove counts under"""
+        partition = txn.data.get('user_id') if isinstance(txn.data, dict) else None
+        return txn.client_id, partition, cls._drug_key(txn), txn.version
+
+    @classmethod
+    def _own_bumps(cls, chunk):
+        """
+        Counter of the version bumps made by the chunk's counters' already
+        replayed adds and removes, by _own_key, for the versions the chunk's
+        adds were queued against, in one query
+        """
+        bumps = Counter()
+        clients = {txn.client_id for txn in chunk if txn.client_id}
+        versions = {txn.version for txn in chunk if txn.transaction_type == 'ADD_TO_CART'}
+        if not clients or not versions:
+            return bumps
+        replayed = (
+            OfflineTransaction.objects.filter(
+                synced=True, client_id__in=clients, version__in=versions,
+                transaction_type__in=('ADD_TO_CART', 'REMOVE_FROM_CART'),
+            )
+            .exclude(last_error=cls.NOTHING_TO_REMOVE)
+            .only('client_id', 'transaction_type', 'version', 'data')
+        )
+        for txn in replayed:
+            bumps[cls._own_key(txn)] += 1
+        return bumps
+
+    @classmethod
+    def _replay_chunk(cls, chunk):
+        """
+        Apply a chunk in order; returns {pk: (outcome, error, pk of the failure it waits for)}.
+        Drug versions are looked up once and advanced in memory as the chunk
+        applies, so a later add in the same chunk sees the earlier ones; the
+        counter's own bumps are tracked alongside and not held against it.
+        """
+        policy = cls.conflict_policy()
+        user_ids = {txn.data.get('user_id') for txn in chunk if isinstance(txn.data, dict)}
+        users = User.objects.in_bulk([user_id for user_id in user_ids if isinstance(user_id, int)])
+        drugs = cls._drug_state(chunk)
+        own_bumps = cls._own_bumps(chunk)
+        blocked = {}
+        results = {}
+        for txn in chunk:
+            partition = txn.data.get('user_id') if isinstance(txn.data, dict) else None
+            if partition in blocked:
+                results[txn.pk] = ('deferred', f'Waiting for transaction #{blocked[partition]}', blocked[partition])
+                continue
+
+            state = drugs.get(cls._drug_key(txn))
+            own_key = cls._own_key(txn)
+            outcome, note, quantity = 'synced', '', None
+            if state and txn.transaction_type == 'ADD_TO_CART' and txn.version + own_bumps[own_key] < state[0]:
+                conflict = f'Queued against version {txn.version}, drug is at version {state[0]}'
+                if own_bumps[own_key]:
+                    conflict += f' ({own_bumps[own_key]} change(s) by this counter)'
+                if policy == 'review':
+                    results[txn.pk] = ('review', conflict, None)
+                    continue
+                if policy == 'clamp':
+                    try:
+                        requested = int(txn.data.get('quantity', 1))
+                    except (TypeError, ValueError):
+                        requested = None
+                    if requested is not None and requested > state[1]:
+                        quantity = max(state[1], 0)
+                        outcome, note = 'clamped', f'{conflict}; quantity cut from {requested} to {quantity}'
+                if policy == 'reject' or quantity == 0:
+                    results[txn.pk] = ('rejected', conflict, None)
+                    continue
+
+            try:
+                with transaction.atomic():
+                    delta = cls.apply(txn, users.get(partition), quantity)
+            except Exception as e:
+                results[txn.pk] = ('failed', str(e) or type(e).__name__, None)
+                blocked[partition] = txn.pk
+            else:
+                if state and delta:
+                    state[0] += 1
+                    state[1] += delta
+                    own_bumps[own_key] += 1
+                elif txn.transaction_type == 'REMOVE_FROM_CART':
+                    note = cls.NOTHING_TO_REMOVE
+                results[txn.pk] = (outcome, note, None)
+        return results
+
+    @classmethod
+    def _write_results(cls, chunk, results, now, worker):
+        """Record a chunk's outcomes and release its lease with a single UPDATE"""
+        by_pk = {txn.pk: txn for txn in chunk}
+        next_attempts = {}
+        quarantined = [pk for pk, (outcome, _, _) in results.items() if outcome in ('rejected', 'review')]
+        for pk, (outcome, _, _) in results.items():
+            if outcome == 'failed':
+                retries = by_pk[pk].retry_count + 1
+                if retries >= cls.max_retries():
+                    quarantined.append(pk)
+                else:
+                    next_attempts[pk] = now + timedelta(seconds=cls.RETRY_DELAY * 2 ** (retries - 1))
+        # Deferred transactions become due together with the one they wait for
+        for pk, (outcome, _, blocker) in results.items():
+            if outcome == 'deferred':
+                next_attempts[pk] = next_attempts.get(blocker, now + timedelta(seconds=cls.RETRY_DELAY))
+
+        synced = [pk for pk, (outcome, _, _) in results.items() if outcome in ('synced', 'clamped')]
+        failed = [pk for pk, (outcome, _, _) in results.items() if outcome == 'failed']
+        conflicts = {'clamped': 'CLAMPED', 'rejected': 'REJECTED', 'review': 'REVIEW'}
+        OfflineTransaction.objects.filter(pk__in=list(results), claimed_by=worker).update(
+            claimed_by='',
+            lease_expires=None,
+            synced=Case(When(pk__in=synced, then=Value(True)), default=F('synced')),
+            processed_at=Case(When(pk__in=synced, then=Value(now)), default=F('processed_at')),
+            retry_count=F('retry_count') + Case(When(pk__in=failed, then=Value(1)), default=Value(0)),
+            quarantined=Case(When(pk__in=quarantined, then=Value(True)), default=F('quarantined')),
+            next_attempt_at=Case(
+                *[When(pk=pk, then=Value(at)) for pk, at in next_attempts.items()],
+                default=Value(None),
+                output_field=DateTimeField(),
+            ),
+            last_error=Case(
+                *[When(pk=pk, then=Value(error)) for pk, (_, error, _) in results.items() if error],
+                default=Value(''),
+            ),
+            conflict=Case(
+                *[When(pk=pk, then=Value(conflicts[outcome])) for pk, (outcome, _, _) in results.items() if outcome in conflicts],
+                default=Value(''),
+            ),
+        )
+
+    @classmethod
+    def run(cls, chunk_size=None, limit=None, progress=None, worker=None):
+        """
+        Replay every transaction due now, `chunk_size` at a time, stopping
+        after `limit` transactions if given. `worker` names the claim owner
+        (host and process by default). Returns a summary of outcomes.
+        """
+        chunk_size = chunk_size or cls.CHUNK_SIZE
+        worker = worker or worker_name()
+        summary = {
+            'chunks': 0, 'synced': 0, 'failed': 0, 'deferred': 0, 'quarantined': 0,
+            'clamped': 0, 'rejected': 0, 'review': 0,
+        }
+        processed = 0
+        while limit is None or processed < limit:
+            size = chunk_size if limit is None else min(chunk_size, limit - processed)
+            chunk = cls.claim(worker, size)
+            if not chunk:
+                break
+            # Applying the chunk and recording it commit together, so a
+            # crashed worker leaves its chunk to be claimed again unapplied.
+            # With per-category database files the stock side is held open
+            # too and commits first.
+            drug_types = {key[0] for key in map(cls._drug_key, chunk) if key}
+            with transaction.atomic(), stock_atomic(*drug_types):
+                results = cls._replay_chunk(chunk)
+                cls._write_results(chunk, results, timezone.now(), worker)
+
+            processed += len(chunk)
+            summary['chunks'] += 1
+            for outcome, _, _ in results.values():
+                summary[outcome] += 1
+            summary['quarantined'] += sum(
+                1 for txn in chunk
+                if results[txn.pk][0] == 'failed' and txn.retry_count + 1 >= cls.max_retries()
+            )
+            if progress:
+                progress(summary)
+        return summary
+
+
+class OfflineIngestError(ValueError):
+    """An upload body that cannot be read as a list of transactions"""
+
+
+class OfflineIngestService:
+    """
+    Bulk upload of actions queued by disconnected counters. The body is a
+    (optionally gzip-compressed) JSON array; every item carries the counter's
+    client id and its sequence number in that counter's queue. Re-uploaded
+    items are dropped by the (client_id, sequence) unique constraint through
+    bulk_create(ignore_conflicts=True), so a counter can safely resend its
+    whole queue after a broken connection.
+    """
+
+    BATCH_SIZE = 500
+    _TYPES = {value for value, _ in OfflineTransaction.TRANSACTION_TYPES}
+    VERSIONED_TYPES = ('ADD_TO_CART', 'REMOVE_FROM_CART')
+
+    @staticmethod
+    def max_bytes():
+        return getattr(settings, 'OFFLINE_SYNC_MAX_BYTES', 20 * 1024 * 1024)
+
+    @classmethod
+    def parse(cls, body, content_encoding=''):
+        """Decode the request body into a list; raises OfflineIngestError when it is not one"""
+        if content_encoding.strip().lower() == 'gzip' or body[:2] == b'\x1f\x8b':
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            try:
+                body = decompressor.decompress(body, cls.max_bytes())
+            except zlib.error as e:
+                raise OfflineIngestError(f'Invalid gzip body: {e}')
+            if decompressor.unconsumed_tail:
+                raise OfflineIngestError(f'Decompressed body exceeds {cls.max_bytes()} bytes')
+        try:
+            items = orjson.loads(body)
+        except orjson.JSONDecodeError as e:
+            raise OfflineIngestError(f'Invalid JSON: {e}')
+        if not isinstance(items, list):
+            raise OfflineIngestError('Expected a JSON array of transactions')
+        return items
+
+    @classmethod
+    def _clean_item(cls, item, user, default_client):
+        if not isinstance(item, dict):
+            raise ValueError('not an object')
+        client_id = item.get('client_id') or default_client
+        if not isinstance(client_id, str) or not 0 < len(client_id) <= 64:
+            raise ValueError('client_id must be a string of 1-64 characters')
+        sequence = item.get('sequence')
+        if not isinstance(sequence, int) or isinstance(sequence, bool) or sequence < 0:
+            raise ValueError('sequence must be a non-negative integer')
+        transaction_type = item.get('type')
+        if transaction_type not in cls._TYPES:
+            raise ValueError(f'unknown type {transaction_type!r}')
+        # Adds and removes are checked against the drug version the counter saw
+        version = item.get('version', None if transaction_type in cls.VERSIONED_TYPES else 1)
+        if version is None:
+            raise ValueError(f'version is required for {transaction_type}')
+        if not isinstance(version, int) or isinstance(version, bool):
+            raise ValueError('version must be an integer')
+        data = item.get('data') or {}
+        if not isinstance(data, dict):
+            raise ValueError('data must be an object')
+        # Staff may upload on behalf of other counter users
+        if not (user.is_staff and isinstance(data.get('user_id'), int)):
+            data = dict(data, user_id=user.pk)
+        return OfflineTransaction(
+            client_id=client_id, sequence=sequence, transaction_type=transaction_type,
+            version=version, data=data,
+        )
+
+    @classmethod
+    def ingest(cls, items, user, default_client=None):
+        """
+        Validate and store uploaded items. Returns counts of received,
+        inserted and duplicate items, per-item errors and, per client, the
+        highest sequence now stored (the client may drop its queue up to it).
+        """
+        rows = []
+        errors = []
+        for index, item in enumerate(items):
+            try:
+                rows.append(cls._clean_item(item, user, default_client))
+            except ValueError as e:
+                errors.append({'index': index, 'error': str(e)})
+        # Replay follows insertion order, so store each queue in sequence order
+        rows.sort(key=lambda row: (row.client_id, row.sequence))
+
+        by_client = {}
+        for row in rows:
+            by_client.setdefault(row.client_id, []).append(row.sequence)
+        existing = 0
+        for client_id, sequences in by_client.items():
+            stored = set(
+                OfflineTransaction.objects.filter(
+                    client_id=client_id, sequence__gte=min(sequences), sequence__lte=max(sequences),
+                ).values_list('sequence', flat=True)
+            )
+            existing += sum(1 for sequence in set(sequences) if sequence in stored)
+
+        with transaction.atomic():
+            OfflineTransaction.objects.bulk_create(rows, batch_size=cls.BATCH_SIZE, ignore_conflicts=True)
+
+        acknowledged = dict(
+            OfflineTransaction.objects.filter(client_id__in=list(by_client))
+            .values('client_id')
+            .annotate(last=Max('sequence'))
+            .values_list('client_id', 'last')
+        )
+        unique = sum(len(set(sequences)) for sequences in by_client.values())
+        return {
+            'received': len(items),
+            'inserted': unique - existing,
+            'duplicates': len(rows) - (unique - existing),
+            'errors': errors,
+            'acknowledged': acknowledged,
+        }
+
+
+class CatalogSyncService:
+    """
+    Delta sync of one store's catalog for offline and thin clients. A client
+    sends back the cursor from its previous response and receives only the
+    drugs changed since, plus the ids of drugs deleted since. Changes come
+    from the CatalogChange log, whose ids follow commit order, so a change
+    that commits after a client's poll always has a later id than the
+    cursor, however long its transaction ran. Each page lists the drugs
+    whose latest change is next in the log; the cursor holds the id of the
+    last change delivered.
+    """
+
+    PAGE_SIZE = 500
+    MAX_PAGE_SIZE = 2000
+    FIELDS = ('id', 'name', 'brand', 'dosage_form', 'unit', 'price', 'stock', 'exp_date', 'version', 'updated_at')
+
+    @staticmethod
+    def log(category):
+        """CatalogChange rows of a store, on the database holding its drugs"""
+        return CatalogChange.objects.using(stock_database(category)).filter(drug_type=category.upper())
+
+    @classmethod
+    def changes(cls, category, cursor=None, page_size=None):
+        model = DrugService.get_drug_model(category)
+        page_size = min(page_size or cls.PAGE_SIZE, cls.MAX_PAGE_SIZE)
+
+        values = decode_cursor(cursor) or []
+        try:
+            last_change = int(values[0])
+        except (IndexError, TypeError, ValueError):
+            last_change = 0
+
+        # Latest change per drug; a drug changed again later is delivered again then
+        latest = list(
+            cls.log(category).filter(id__gt=last_change)
+            .values('drug_id')
+            .annotate(change=Max('id'))
+            .order_by('change')
+            .values_list('drug_id', 'change')[:page_size + 1]
+        )
+        has_more = len(latest) > page_size
+        latest = latest[:page_size]
+        drugs = model.objects.only(*cls.FIELDS).in_bulk([drug_id for drug_id, _ in latest])
+        items = []
+        deleted = []
+        for drug_id, _ in latest:
+            drug = drugs.get(drug_id)
+            if drug is None:
+                deleted.append(drug_id)
+            else:
+                items.append({field: getattr(drug, field) for field in cls.FIELDS})
+        if latest:
+            last_change = latest[-1][1]
+
+        return {
+            'category': category.lower(),
+            'items': items,
+            'deleted': deleted,
+            'cursor': encode_cursor(last_change),
+            'has_more': has_more,
+        }
+
+    @classmethod
+    def compact(cls):
+        """
+        Delete log entries superseded by a later change of the same drug; a
+        client's next page is the same with or without them. Returns the
+        number of entries deleted.
+        """
+        deleted = 0
+        for category in CATEGORY_DRUG_MODELS:
+            latest = cls.log(category).values('drug_id').annotate(change=Max('id')).values('change')
+            deleted += cls.log(category).exclude(id__in=Subquery(latest)).delete()[0]
+        return deleted
+
+
+class ExportService:
+    """
+    CSV and XLSX exports of the forms list and the inventory, built by the
+    job worker instead of the request. enqueue() queues an 'export' job that
+    names the file it will write under EXPORT_DIR; the export page polls the
+    job and offers the file for download once it is DONE. Rows are read from
+    the reporting snapshot while it is fresh and written as they arrive.
+    """
+
+    FORM_FIELDS = [
+        ('Form ID', 'form_id'),
+        ('Date', 'date'),
+        ('Patient', 'buyer_name'),
+        ('Hospital No', 'hospital_no'),
+        ('NCAP No', 'ncap_no'),
+        ('Total Amount', 'total_amount'),
+        ('Dispensed By', 'dispensed_by__username'),
+    ]
+    FORM_ITEM_FIELDS = [
+        ('Form ID', 'form__form_id'),
+        ('Date', 'form__date'),
+        ('Category', 'drug_type'),
+        ('Drug', 'drug_name'),
+        ('Brand', 'drug_brand'),
+        ('Dosage Form', 'dosage_form'),
+        ('Unit', 'unit'),
+        ('Quantity', 'quantity'),
+        ('Price', 'price'),
+        ('Subtotal', 'subtotal'),
+    ]
+    INVENTORY_FIELDS = [
+        ('Name', 'name'),
+        ('Brand', 'brand'),
+        ('Dosage Form', 'dosage_form'),
+        ('Unit', 'unit'),
+        ('Cost', 'cost'),
+        ('Markup', 'markup'),
+        ('Price', 'price'),
+        ('Stock', 'stock'),
+        ('Expiry Date', 'exp_date'),
+    ]
+    # Export -> (file name prefix, title of the export page and sheet)
+    EXPORTS = {
+        'forms': ('forms', 'Forms'),
+        'form_items': ('form-items', 'Form items'),
+        'inventory': ('inventory', 'Inventory'),
+    }
+    FORMATS = ('csv', 'xlsx')
+
+    @staticmethod
+    def directory():
+        return str(getattr(settings, 'EXPORT_DIR', os.path.join(settings.BASE_DIR, 'exports')))
+
+    @classmethod
+    def rows(cls, export, params):
+        """(header, rows) of an export, with the forms list filters in `params` applied"""
+        if export == 'inventory':
+            fields = [field for _, field in cls.INVENTORY_FIELDS]
+            querysets = [
+                (category, reporting_queryset(model.objects.order_by('name', 'id')))
+                for category, model in (('Lpacemaker', LpacemakerDrugs), ('NCAP', NcapDrugs), ('Oncology', OncologyPharmacy))
+            ]
+
+            def rows():
+                for category, queryset in querysets:
+                    for row in exports.iter_rows(queryset, fields):
+                        yield (category,) + row
+
+            return ['Category'] + [label for label, _ in cls.INVENTORY_FIELDS], rows()
+
+        forms = FormService.search(params)[0]
+        if export == 'forms':
+            columns, queryset = cls.FORM_FIELDS, forms.order_by('-date', '-id')
+        else:
+            columns = cls.FORM_ITEM_FIELDS
+            queryset = FormItem.objects.filter(form__in=forms.values('id')).order_by('form_id', 'id')
+        rows = exports.iter_rows(reporting_queryset(queryset), [field for _, field in columns])
+        return [label for label, _ in columns], rows
+
+    @classmethod
+    def enqueue(cls, export, export_format, params, user):
+        """Queue an export for `user`; returns the Job. Raises JobError for an unknown export or format"""
+        if export not in cls.EXPORTS or export_format not in cls.FORMATS:
+            raise JobError(f'Unknown export {export!r} ({export_format})')
+        filename = f'{cls.EXPORTS[export][0]}-{timezone.localdate():%Y%m%d}.{export_format}'
+        return JobQueueService.enqueue('export', {
+            'export': export,
+            'format': export_format,
+            'params': {'q': params.get('q', ''), 'filter': params.get('filter', 'all')},
+            'filename': filename,
+            # Stored under a name of its own, so exports never overwrite each other
+            'file': f'{uuid.uuid4().hex}.{export_format}',
+            'user_id': user.pk,
+        })
+
+    @classmethod
+    def file_path(cls, payload):
+        return os.path.join(cls.directory(), os.path.basename(payload['file']))
+
+    @classmethod
+    def write(cls, payload):
+        """Write the export a job describes to its file, under a temporary name until it is complete"""
+        header, rows = cls.rows(payload['export'], payload.get('params', {}))
+        path = cls.file_path(payload)
+        partial = f'{path}.part'
+        os.makedirs(cls.directory(), exist_ok=True)
+        try:
+            exports.write_export(payload['format'], partial, cls.EXPORTS[payload['export']][1], header, rows)
+            os.replace(partial, path)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+
+    @classmethod
+    def download(cls, job):
+        """Path of a finished export's file, or None while it is pending, after it failed or once it was purged"""
+        if job.name != 'export' or job.status != 'DONE':
+            return None
+        path = cls.file_path(job.payload)
+        return path if os.path.exists(path) else None
+
+    @classmethod
+    def remove_files(cls, jobs):
+        """Delete the files written by export `jobs`"""
+        for payload in jobs.filter(name='export').values_list('payload', flat=True):
+            try:
+                os.remove(cls.file_path(payload))
+            except (FileNotFoundError, KeyError):
+                pass
+
+
+class JobError(ValueError):
+    """A job that cannot be queued"""
+
+
+class JobQueueService:
+    """
+    Background jobs stored in the database, so the project needs no broker.
+    enqueue() adds a Job; workers (`manage.py run_worker`) claim due jobs one
+    at a time with a lease, the same way as OfflineReplayService.claim, and
+    run the handler registered for the job name. A failed job is retried with
+    exponential backoff and becomes DEAD (the dead letter) after
+    max_attempts. A job whose worker died is claimed again once its lease
+    runs out.
+
+    Workers also enqueue the periodic jobs in JOB_SCHEDULE. Each entry runs
+    every `every` seconds, `offset` seconds past the UTC epoch boundary (so
+    every=86400, offset=900 is 00:15 UTC daily); a run is keyed by entry and
+    slot, so any number of workers enqueue it once.
+    """
+
+    MAX_ATTEMPTS = 5
+    RETRY_DELAY = 60  # seconds before the first retry, doubled for each one after
+    HANDLERS = {
+        'command': '_run_command',
+        'render_receipt': '_render_receipt',
+        'purge_jobs': '_purge_jobs',
+        'compact_catalog': '_compact_catalog',
+        'export': '_export',
+        'rebuild_rollup': '_rebuild_rollup',
+    }
+    SCHEDULE = {
+        'replay-offline': {
+            'job': 'command', 'payload': {'command': 'replay_offline_transactions'},
+            'every': 60, 'max_attempts': 1,
+        },
+        'expire-stock': {
+            'job': 'command', 'payload': {'command': 'check_expired_items'},
+            'every': 86400, 'offset': 15 * 60,
+        },
+        'expiry-digest': {
+            'job': 'command', 'payload': {'command': 'expiry_digest'},
+            'every': 86400, 'offset': 30 * 60,
+        },
+        'purge-jobs': {'job': 'purge_jobs', 'every': 86400, 'offset': 45 * 60},
+        'compact-catalog': {'job': 'compact_catalog', 'every': 86400, 'offset': 50 * 60},
+        'refresh-reporting': {
+            'job': 'command', 'payload': {'command': 'refresh_reporting_db'},
+            'every': 300, 'max_attempts': 1,
+        },
+        'backup-db': {
+            'job': 'command', 'payload': {'command': 'backup_db'},
+            'every': 86400, 'offset': 60 * 60,
+        },
+        'reconcile-stock': {
+            'job': 'command', 'payload': {'command': 'reconcile_stock_journal'},
+            'every': 300, 'max_attempts': 1,
+        },
+    }
+
+    @staticmethod
+    def lease_seconds():
+        return getattr(settings, 'JOB_LEASE_SECONDS', 600)
+
+    @classmethod
+    def schedule(cls):
+        return getattr(settings, 'JOB_SCHEDULE', cls.SCHEDULE)
+
+    @classmethod
+    def handler(cls, name):
+        method = cls.HANDLERS.get(name)
+        return getattr(cls, method) if method else None
+
+    @staticmethod
+    def _run_command(payload):
+        """Run a management command: {'command': name, 'args': [...], 'options': {...}}"""
+        call_command(
+            payload['command'], *payload.get('args', []), stdout=io.StringIO(), **payload.get('options', {}),
+        )
+
+    @staticmethod
+    def _render_receipt(payload):
+        form = Form.objects.select_related('dispensed_by').filter(pk=payload.get('form_id')).first()
+        if form is not None:
+            ReceiptService.store(form)
+
+    @staticmethod
+    def _purge_jobs(payload):
+        """Delete finished jobs older than JOB_RETENTION_DAYS, and the files of exports among them; dead letters are kept"""
+        days = payload.get('days', getattr(settings, 'JOB_RETENTION_DAYS', 7))
+        finished = Job.objects.filter(status='DONE', finished_at__lt=timezone.now() - timedelta(days=days))
+        ExportService.remove_files(finished)
+        finished.delete()
+
+    @staticmethod
+    def _compact_catalog(payload):
+        CatalogSyncService.compact()
+
+    @staticmethod
+    def _export(payload):
+        ExportService.write(payload)
+
+    @staticmethod
+    def _rebuild_rollup(payload):
+        """Rebuild the sales rollup for {'start': 'YYYY-MM-DD', 'end': 'YYYY-MM-DD'} (either may be omitted)"""
+        start, end = (date.fromisoformat(payload[key]) if payload.get(key) else None for key in ('start', 'end'))
+        SalesRollupService.rebuild(start=start, end=end)
+
+    @classmethod
+    def enqueue(cls, name, payload=None, run_at=None, max_attempts=None):
+        """Queue a job to run at `run_at` (now by default); raises JobError for an unknown name"""
+        if cls.handler(name) is None:
+            raise JobError(f'Unknown job {name!r}')
+        return Job.objects.create(
+            name=name,
+            payload=payload or {},
+            run_at=run_at or timezone.now(),
+            max_attempts=max_attempts or cls.MAX_ATTEMPTS,
+        )
+
+    @classmethod
+    def enqueue_due(cls, now=None):
+        """Queue the current run of every schedule entry that is not queued yet, in one INSERT"""
+        now = now or timezone.now()
+        jobs = []
+        for key, entry in cls.schedule().items():
+            every, offset = entry['every'], entry.get('offset', 0)
+            slot = int((now.timestamp() - offset) // every)
+            jobs.append(Job(
+                name=entry['job'],
+                payload=entry.get('payload', {}),
+                run_at=datetime.fromtimestamp(slot * every + offset, tz=dt_timezone.utc),
+                max_attempts=entry.get('max_attempts', cls.MAX_ATTEMPTS),
+                unique_key=f'{key}:{slot}',
+            ))
+        Job.objects.bulk_create(jobs, ignore_conflicts=True)
+
+    @classmethod
+    def claim(cls, worker, now=None):
+        """Lease the next due job to `worker`; returns it, or None when nothing is due"""
+        now = now or timezone.now()
+        lease_expires = now + timedelta(seconds=cls.lease_seconds())
+        due = Job.objects.filter(
+            Q(status='QUEUED', run_at__lte=now) | Q(status='RUNNING', lease_expires__lte=now)
+        ).order_by('run_at', 'id')
+        claim = {'status': 'RUNNING', 'claimed_by': worker, 'lease_expires': lease_expires, 'attempts': F('attempts') + 1}
+        if connection.features.has_select_for_update_skip_locked:
+            with transaction.atomic():
+                ids = list(due.select_for_update(skip_locked=True).values_list('id', flat=True)[:1])
+                Job.objects.filter(pk__in=ids).update(**claim)
+        else:
+            Job.objects.filter(pk__in=Subquery(due.values('id')[:1])).update(**claim)
+        return Job.objects.filter(status='RUNNING', claimed_by=worker, lease_expires=lease_expires).first()
+
+    @classmethod
+    def run_job(cls, job, worker):
+        """Run a claimed job and record the outcome: 'done', 'retry' or 'dead'"""
+        handler = cls.handler(job.name)
+        try:
+            if handler is None:
+                raise JobError(f'Unknown job {job.name!r}')
+            handler(job.payload or {})
+        except Exception:
+            now = timezone.now()
+            if job.attempts >= job.max_attempts:
+                outcome, changes = 'dead', {'status': 'DEAD', 'finished_at': now}
+            else:
+                retry_at = now + timedelta(seconds=cls.RETRY_DELAY * 2 ** (job.attempts - 1))
+                outcome, changes = 'retry', {'status': 'QUEUED', 'run_at': retry_at}
+            changes['last_error'] = traceback.format_exc()
+        else:
+            outcome, changes = 'done', {'status': 'DONE', 'finished_at': timezone.now(), 'last_error': ''}
+        Job.objects.filter(pk=job.pk, claimed_by=worker).update(claimed_by='', lease_expires=None, **changes)
+        return outcome
+
+    @classmethod
+    def run_pending(cls, worker=None, limit=None, progress=None):
+        """
+        Run due jobs until none is left (or `limit` have run). Calls
+        progress(job, outcome, seconds) after each. Returns counts by outcome.
+        """
+        worker = worker or worker_name()
+        summary = {'done': 0, 'retry': 0, 'dead': 0}
+        while limit is None or sum(summary.values()) < limit:
+            job = cls.claim(worker)
+            if job is None:
+                break
+            started = timezone.now()
+            outcome = cls.run_job(job, worker)
+            summary[outcome] += 1
+            if progress:
+                progress(job, outcome, (timezone.now() - started).total_seconds())
+        return summary
@@ -0,0 +1,89 @@
+"""
+Query budget helpers for the test suite.
+Counts the SQL issued inside a block and flags N+1 patterns, i.e. the same
+statement shape repeated once per row with only the literals changing.
+"""
+import re
+from collections import Counter
+from functools import wraps
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+# A shape repeated at least this many times within one request is treated as
+# an N+1. Keep it below the number of rows seeded per relation in the tests.
+N_PLUS_ONE_THRESHOLD = 5
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+_IN_LIST = re.compile(r"\bIN \((?:\s*\?\s*,?)+\)", re.IGNORECASE)
+_WHITESPACE = re.compile(r"\s+")
+
+
+def sql_shape(sql):
+    """Normalise a SQL string so queries differing only by literals compare equal"""
+    shape = _STRING_LITERAL.sub('?', sql)
+    shape = _NUMBER_LITERAL.sub('?', shape)
+    shape = _IN_LIST.sub('IN (...)', shape)
+    return _WHITESPACE.sub(' ', shape).strip()
+
+
+def find_repeated_queries(queries, threshold=N_PLUS_ONE_THRESHOLD):
+    """
+    Return a list of (shape, count) for statement shapes executed at least
+    `threshold` times. `queries` is the list captured by CaptureQueriesContext.
+    """
+    counts = Counter(sql_shape(query['sql']) for query in queries)
+    return [(shape, count) for shape, count in counts.most_common() if count >= threshold]
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+class QueryBudget(CaptureQueriesContext):
+    """
+    Context manager asserting that the enclosed block runs at most
+    `max_queries` queries and, unless `allow_repeats` is set, contains no
+    repeated statement shapes (N+1).
+
+        with QueryBudget(5, label='cart'):
+            client.get('/cart/')
+    """
+
+    def __init__(self, max_queries, label=None, allow_repeats=False,
+                 threshold=N_PLUS_ONE_THRESHOLD, using=None):
+        super().__init__(using or connection)
+        self.max_queries = max_queries
+        self.label = label or 'block'
+        self.allow_repeats = allow_repeats
+        self.threshold = threshold
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        super().__exit__(exc_type, exc_value, traceback)
+        if exc_type is not None:
+            return
+        self.check()
+
+    def check(self):
+        problems = []
+        executed = len(self)
+        if executed > self.max_queries:
+            problems.append(f'{self.label}: {executed} queries executed, budget is {self.max_queries}')
+        if not self.allow_repeats:
+            for shape, count in find_repeated_queries(self.captured_queries, self.threshold):
+                problems.append(f'{self.label}: possible N+1, {count}x {shape}')
+        if problems:
+            listing = '\n'.join(f'  {i}. {q["sql"]}' for i, q in enumerate(self.captured_queries, 1))
+            raise QueryBudgetExceeded('\n'.join(problems) + '\nQueries:\n' + listing)
+
+
+def query_budget(max_queries, label=None, **kwargs):
+    """Decorator form of QueryBudget for test methods"""
+    def decorator(test_func):
+        @wraps(test_func)
+        def wrapped(*args, **inner_kwargs):
+            with QueryBudget(max_queries, label=label or test_func.__name__, **kwargs):
+                return test_func(*args, **inner_kwargs)
+        return wrapped
+    return decorator
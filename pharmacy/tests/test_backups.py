@@ -0,0 +1,85 @@
+"""
+Online backups: a snapshot of a scratch database file round-trips through
+take_backup and restore_backup, and a snapshot that was tampered with or
+taken with other databases configured is refused before anything is
+overwritten.
+"""
+import gzip
+import json
+import shutil
+import tempfile
+import unittest
+from contextlib import ExitStack
+from pathlib import Path
+
+from django.db import connection
+from django.test import TransactionTestCase
+
+from pharmacy.db import (
+    BACKUP_MANIFEST, BackupError, _sha256, backup_aliases, categories_split, list_backups,
+    read_backup_manifest, restore_backup, scratch_sqlite_database, take_backup,
+)
+from pharmacy.models import User
+
+
+@unittest.skipIf(categories_split(), 'the category files of a split run are in-memory test databases')
+class BackupTests(TransactionTestCase):
+    def setUp(self):
+        # The backup API copies files, so work on a migrated scratch file
+        # rather than the in-memory test database
+        stack = ExitStack()
+        self.addCleanup(stack.close)
+        stack.enter_context(scratch_sqlite_database(connection))
+        self.directory = Path(tempfile.mkdtemp(prefix='neopharm-backups-'))
+        stack.callback(shutil.rmtree, self.directory, True)
+        for number in range(3):
+            User.objects.create_user(mobile=f'0800000000{number}', username=f'user{number}', password='pass')
+
+    def snapshot(self):
+        return take_backup(self.directory, pages=1, sleep=0)['path']
+
+    def test_snapshot_round_trips(self):
+        result = self.snapshot()
+        self.assertEqual(list_backups(self.directory), [result])
+        manifest = read_backup_manifest(result)
+        self.assertEqual(set(manifest['databases']), set(backup_aliases()))
+        for figures in manifest['databases'].values():
+            archive = result / figures['file']
+            self.assertEqual(_sha256(archive), figures['sha256'])
+            with gzip.open(archive, 'rb') as compressed:
+                self.assertEqual(len(compressed.read()), figures['bytes'])
+
+        User.objects.filter(username='user0').delete()
+        User.objects.create_user(mobile='08000000009', username='late', password='pass')
+        restored = restore_backup(result)
+
+        self.assertEqual(set(restored), set(backup_aliases()))
+        self.assertEqual(
+            sorted(User.objects.values_list('username', flat=True)), ['user0', 'user1', 'user2'],
+        )
+
+    def test_tampered_archive_is_refused(self):
+        result = self.snapshot()
+        figures = read_backup_manifest(result)['databases']['default']
+        with gzip.open(result / figures['file'], 'wb') as compressed:
+            compressed.write(b'not a database')
+        User.objects.create_user(mobile='08000000009', username='late', password='pass')
+
+        with self.assertRaisesMessage(BackupError, 'does not match its checksum'):
+            restore_backup(result)
+        self.assertEqual(User.objects.count(), 4)
+
+    def test_snapshot_of_other_databases_is_refused(self):
+        result = self.snapshot()
+        manifest = read_backup_manifest(result)
+        manifest['databases']['ncap'] = dict(manifest['databases']['default'])
+        (result / BACKUP_MANIFEST).write_text(json.dumps(manifest))
+        User.objects.create_user(mobile='08000000009', username='late', password='pass')
+
+        with self.assertRaisesMessage(BackupError, 'check CATEGORY_DATABASES'):
+            restore_backup(result)
+        self.assertEqual(User.objects.count(), 4)
+
+    def test_unreadable_snapshot_is_refused(self):
+        with self.assertRaises(BackupError):
+            restore_backup(self.directory / 'missing')
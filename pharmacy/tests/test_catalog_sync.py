@@ -0,0 +1,133 @@
+"""
+Catalog delta sync: cursor paging through the change log, deletions,
+changes made by bulk and queryset updates, changes that commit after a poll
+with an older updated_at, and compaction of superseded log entries.
+"""
+from datetime import timedelta
+from decimal import Decimal
+
+from django.test import TestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from pharmacy.models import CatalogChange, NcapDrugs, User
+from pharmacy.pagination import encode_cursor
+from pharmacy.services import CatalogSyncService, StockLotService
+
+
+class CatalogSyncTests(TestCase):
+    def setUp(self):
+        self.drugs = [self.make_drug(f'Drug {number}') for number in range(5)]
+
+    def make_drug(self, name):
+        return NcapDrugs.objects.create(
+            name=name, unit='Tab', dosage_form='Tablet', cost=Decimal('10.00'), markup='10', stock=5,
+        )
+
+    def sync(self, cursor=None, page_size=None):
+        """Follow the cursor until has_more is false; returns (ids, deleted ids, cursor)"""
+        ids, deleted = [], []
+        while True:
+            page = CatalogSyncService.changes('ncap', cursor, page_size)
+            ids += [item['id'] for item in page['items']]
+            deleted += page['deleted']
+            cursor = page['cursor']
+            if not page['has_more']:
+                return ids, deleted, cursor
+
+    def test_pages_follow_the_cursor(self):
+        first = CatalogSyncService.changes('ncap', page_size=2)
+        self.assertEqual([item['id'] for item in first['items']], [drug.pk for drug in self.drugs[:2]])
+        self.assertTrue(first['has_more'])
+        self.assertEqual(first['items'][0]['name'], 'Drug 0')
+
+        ids, deleted, cursor = self.sync(first['cursor'], page_size=2)
+        self.assertEqual((ids, deleted), ([drug.pk for drug in self.drugs[2:]], []))
+
+        # Nothing changed since: an empty page with the same cursor
+        page = CatalogSyncService.changes('ncap', cursor)
+        self.assertEqual((page['items'], page['deleted'], page['has_more'], page['cursor']), ([], [], False, cursor))
+
+    def test_changed_drugs_are_sent_once_with_their_latest_state(self):
+        _, _, cursor = self.sync()
+        drug = self.drugs[3]
+        drug.name = 'Renamed'
+        drug.save()
+        # Queryset and bulk updates bypass save() but are logged all the same
+        StockLotService.adjust_drugs('ncap', {drug.pk: 2, self.drugs[1].pk: -1})
+        NcapDrugs.objects.bulk_update([NcapDrugs(pk=self.drugs[0].pk, markup='20')], ['markup'])
+
+        page = CatalogSyncService.changes('ncap', cursor)
+
+        # In the order of each drug's latest change; the UPDATE logs its rows in id order
+        self.assertEqual(
+            [(item['id'], item['stock']) for item in page['items']],
+            [(self.drugs[1].pk, 4), (self.drugs[3].pk, 7), (self.drugs[0].pk, 5)],
+        )
+        self.assertEqual(page['items'][1]['name'], 'Renamed')
+
+    def test_change_committed_after_a_poll_is_not_skipped(self):
+        _, _, cursor = self.sync()
+        # A transaction that stamped updated_at before the poll and
+        # committed after it
+        stamped = timezone.now() - timedelta(minutes=5)
+        NcapDrugs.objects.filter(pk=self.drugs[2].pk).update(stock=1, updated_at=stamped)
+
+        ids, _, _ = self.sync(cursor)
+
+        self.assertEqual(ids, [self.drugs[2].pk])
+
+    def test_deleted_drugs_are_reported(self):
+        _, _, cursor = self.sync()
+        removed = self.drugs[1].pk
+        self.drugs[1].delete()
+        added = self.make_drug('New')
+
+        ids, deleted, cursor = self.sync(cursor)
+
+        self.assertEqual((ids, deleted), ([added.pk], [removed]))
+        # A drug changed and then deleted is only reported as deleted
+        removed = self.drugs[4].pk
+        self.drugs[4].save()
+        self.drugs[4].delete()
+        self.assertEqual(self.sync(cursor)[:2], ([], [removed]))
+
+    def test_compaction_keeps_every_client_in_step(self):
+        _, _, old_cursor = self.sync(page_size=2)
+        midway = CatalogSyncService.changes('ncap', page_size=2)['cursor']
+        for drug in self.drugs:
+            drug.save()
+        self.drugs[0].delete()
+        before = [self.sync(cursor, page_size=2) for cursor in (None, midway, old_cursor)]
+
+        deleted = CatalogSyncService.compact()
+
+        # Every drug's first two entries; the deleted one had three
+        self.assertEqual(deleted, 6)
+        self.assertEqual(CatalogChange.objects.filter(drug_type='NCAP').count(), 5)
+        self.assertEqual([self.sync(cursor, page_size=2) for cursor in (None, midway, old_cursor)], before)
+
+    def test_unreadable_cursor_starts_over(self):
+        old_format = encode_cursor(timezone.now().isoformat(), self.drugs[2].pk, 0)
+        ids, _, _ = self.sync(old_format)
+        self.assertEqual(ids, [drug.pk for drug in self.drugs])
+
+    def test_view_pages_and_answers_unchanged_polls_with_304(self):
+        self.client.force_login(User.objects.create_user(mobile='08000000001', username='counter', password='pass'))
+        url = reverse('store:catalog_changes', args=['ncap'])
+
+        response = self.client.get(url, {'limit': 3})
+        body = response.json()
+        self.assertEqual(len(body['items']), 3)
+        self.assertTrue(body['has_more'])
+
+        response = self.client.get(url, {'cursor': body['cursor']})
+        body = response.json()
+        self.assertEqual([item['id'] for item in body['items']], [drug.pk for drug in self.drugs[3:]])
+
+        # Polling again with nothing changed
+        empty = self.client.get(url, {'cursor': body['cursor']})
+        self.assertEqual(empty.json()['items'], [])
+        again = self.client.get(url, {'cursor': body['cursor']}, HTTP_IF_NONE_MATCH=empty['ETag'])
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(self.client.get(reverse('store:catalog_changes', args=['nope'])).status_code, 404)
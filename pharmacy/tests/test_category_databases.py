@@ -0,0 +1,139 @@
+"""
+Per-category database files (CATEGORY_DATABASES): cart changes that commit
+in two files survive a crash between the commits, and the stock admin reads
+the category files. The databases are set up when settings load, so run
+these with CATEGORY_DATABASES=True in the environment.
+"""
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock, skipUnless
+
+from django.contrib import admin
+from django.http import QueryDict
+from django.test import RequestFactory, TestCase
+from django.utils.http import urlencode
+from django.utils import timezone
+
+from pharmacy.admin import StockLotAdmin
+from pharmacy.db import CATEGORY_DRUG_MODELS, categories_split
+from pharmacy.models import User, NcapDrugs, OncologyPharmacy, Cart, StockLot, StockJournal
+from pharmacy.services import DrugService, StockJournalService, StockLotService
+
+
+class Crash(BaseException):
+    """Stands in for the process dying: not caught by the undo handlers"""
+
+
+@skipUnless(categories_split(), 'needs CATEGORY_DATABASES=True')
+class CategoryDatabaseTests(TestCase):
+    # Not '__all__': the reporting mirror shares the default in-memory database
+    databases = {'default', *(CATEGORY_DRUG_MODELS if categories_split() else ())}
+
+    def setUp(self):
+        self.user = User.objects.create_user(mobile='08000000001', username='counter', password='pass')
+        exp_date = timezone.now().date() + timedelta(days=90)
+        self.drugs = {}
+        for drug_type, model in (('ncap', NcapDrugs), ('oncology', OncologyPharmacy)):
+            drug = model.objects.create(
+                name=f'{drug_type} drug', brand='brand', unit='Tab', dosage_form='Tablet',
+                cost=Decimal('10.00'), markup='10', stock=0,
+            )
+            StockLotService.receive(drug_type, drug.pk, 10, exp_date=exp_date)
+            self.drugs[drug_type] = drug
+
+    def stock(self, drug_type):
+        drug = self.drugs[drug_type]
+        lots = StockLotService.lots(drug_type).filter(**{DrugService.get_drug_field_name(drug_type): drug.pk})
+        return type(drug).objects.get(pk=drug.pk).stock, sum(lots.values_list('quantity', flat=True))
+
+    def reconcile_later(self):
+        later = timezone.now() + timedelta(seconds=StockJournalService.grace_seconds() + 1)
+        return StockJournalService.reconcile(later)
+
+    def markers(self, drug_type):
+        return StockJournalService.markers(drug_type).count()
+
+    def test_stock_lives_in_the_category_files(self):
+        self.assertEqual(StockLot.objects.using('ncap').count(), 1)
+        self.assertEqual(StockLot.objects.using('default').count(), 0)
+
+    def test_completed_takes_are_cleared(self):
+        self.assertTrue(DrugService.add_to_cart(self.user, 'ncap', self.drugs['ncap'].pk, 3)[0])
+        self.assertEqual((self.markers('ncap'), StockJournal.objects.filter(action='TAKE').count()), (1, 1))
+        # Not yet old enough to judge, but a completed take is cleared at once
+        self.assertEqual(StockJournalService.reconcile(), {'released': 0, 'rolled_back': 0, 'completed': 1})
+        self.assertEqual((self.markers('ncap'), StockJournal.objects.count()), (0, 0))
+        self.assertEqual(self.stock('ncap'), (7, 7))
+        self.assertEqual(Cart.objects.get().quantity, 3)
+
+    def test_take_without_a_cart_line_is_put_back(self):
+        with mock.patch.object(Cart.objects, 'create', side_effect=Crash), self.assertRaises(Crash):
+            DrugService.add_to_cart(self.user, 'ncap', self.drugs['ncap'].pk, 3)
+        self.assertEqual((self.stock('ncap'), Cart.objects.count()), ((7, 7), 0))
+
+        # A request may still be finishing it
+        self.assertEqual(StockJournalService.reconcile()['rolled_back'], 0)
+        self.assertEqual(self.reconcile_later(), {'released': 0, 'rolled_back': 1, 'completed': 0})
+        self.assertEqual((self.stock('ncap'), self.markers('ncap')), ((10, 10), 0))
+        self.assertEqual(self.reconcile_later()['rolled_back'], 0)
+
+    def test_failed_cart_line_undoes_the_take(self):
+        with mock.patch.object(Cart.objects, 'create', side_effect=RuntimeError('disk full')):
+            success, message, _ = DrugService.add_to_cart(self.user, 'ncap', self.drugs['ncap'].pk, 3)
+        self.assertEqual((success, message), (False, 'disk full'))
+        self.assertEqual((self.stock('ncap'), self.markers('ncap')), ((10, 10), 0))
+
+    def test_release_failing_in_one_category_is_applied_once(self):
+        for drug_type in ('ncap', 'oncology'):
+            DrugService.add_to_cart(self.user, drug_type, self.drugs[drug_type].pk, 4)
+        release = StockLotService.release
+
+        def oncology_fails(entries):
+            if 'oncology' in entries:
+                raise RuntimeError('database is locked')
+            release(entries)
+
+        with mock.patch.object(StockLotService, 'release', side_effect=oncology_fails), self.assertRaises(RuntimeError):
+            DrugService.discard_cart_lines(Cart.objects.filter(user=self.user))
+        self.assertFalse(Cart.objects.exists())
+        self.assertEqual((self.stock('ncap'), self.stock('oncology')), ((10, 10), (6, 6)))
+        self.assertEqual(list(StockJournal.objects.filter(action='RELEASE').values_list('drug_type', flat=True)), ['oncology'])
+
+        self.assertEqual(self.reconcile_later()['released'], 1)
+        self.reconcile_later()
+        self.assertEqual((self.stock('ncap'), self.stock('oncology')), ((10, 10), (10, 10)))
+        self.assertEqual((StockJournal.objects.count(), self.markers('ncap'), self.markers('oncology')), (0, 0, 0))
+
+    def test_release_applied_before_a_crash_is_not_repeated(self):
+        DrugService.add_to_cart(self.user, 'ncap', self.drugs['ncap'].pk, 4)
+        with mock.patch.object(StockJournal, 'delete', side_effect=Crash), self.assertRaises(Crash):
+            DrugService.remove_from_cart(self.user, 'ncap', self.drugs['ncap'].pk)
+        self.assertEqual(self.stock('ncap'), (10, 10))
+        self.assertEqual(self.reconcile_later()['released'], 1)
+        self.assertEqual(self.stock('ncap'), (10, 10))
+        self.assertEqual(StockJournal.objects.count(), 0)
+
+    def test_cart_quantity_decrease_is_journaled(self):
+        DrugService.add_to_cart(self.user, 'ncap', self.drugs['ncap'].pk, 6)
+        line = Cart.objects.get()
+        self.assertEqual(DrugService.update_cart_quantity(line, 2), (True, 'Cart updated successfully'))
+        line.refresh_from_db()
+        self.assertEqual((line.quantity, sum(line.lot_allocations.values())), (2, 2))
+        self.assertEqual(self.stock('ncap'), (8, 8))
+        self.assertFalse(StockJournal.objects.filter(action='RELEASE').exists())
+
+    def test_admin_reads_the_selected_categorys_file(self):
+        model_admin = StockLotAdmin(StockLot, admin.site)
+        request = RequestFactory().get('/', {'category': 'ncap'})
+        request.user = User.objects.create_superuser(mobile='08000000009', username='admin', password='pass')
+        changelist = model_admin.get_changelist_instance(request)
+        self.assertEqual([lot.get_item.name for lot in changelist.result_list], ['ncap drug'])
+
+        # The first category is selected when none is
+        request.GET = QueryDict()
+        self.assertEqual(model_admin.get_changelist_instance(request).result_count, 0)
+
+        # Change pages get it from the list they were opened from
+        lot = StockLot.objects.using('oncology').get()
+        request.GET = QueryDict(urlencode({'_changelist_filters': 'category=oncology'}))
+        self.assertEqual(model_admin.get_object(request, str(lot.pk)).quantity, 10)
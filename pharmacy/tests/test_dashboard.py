@@ -0,0 +1,168 @@
+"""
+Dashboard figures against a hand-built fixture: the sales analytics report
+per day, week and month read from the rollups, and the catalog, cart and
+staff counts of DashboardService.
+"""
+from datetime import date, datetime, timezone as dt_timezone
+from decimal import Decimal
+from unittest import mock
+
+from django.contrib.auth.models import Group
+from django.core.cache import cache
+from django.test import TestCase
+
+from pharmacy.models import USER_STATS_CACHE_KEY, Cart, Form, FormItem, LpacemakerDrugs, NcapDrugs, User
+from pharmacy.services import DashboardService, SalesAnalyticsService, SalesRollupService
+
+# A Wednesday; the current week starts on Monday 16 March
+NOW = datetime(2026, 3, 18, 10, 0, tzinfo=dt_timezone.utc)
+
+# (day, dispenser, [(category, drug, quantity, price)])
+SALES = [
+    (date(2026, 3, 18), 'ada', [('NCAP', 'Paracetamol', 4, '1.50'), ('ONCOLOGY', 'Cisplatin', 1, '50.00')]),
+    (date(2026, 3, 16), 'bola', [('NCAP', 'Paracetamol', 2, '1.50'), ('LPACEMAKER', 'Lead', 1, '200.00')]),
+    (date(2026, 3, 10), 'ada', [('NCAP', 'Ibuprofen', 10, '0.50')]),
+    (date(2026, 2, 20), 'bola', [('NCAP', 'Paracetamol', 1, '1.50')]),
+    # Only in the monthly window
+    (date(2025, 12, 1), 'ada', [('ONCOLOGY', 'Cisplatin', 2, '50.00')]),
+    # Outside every window
+    (date(2024, 12, 1), 'ada', [('NCAP', 'Paracetamol', 100, '1.50')]),
+]
+
+
+class SalesAnalyticsTests(TestCase):
+    def setUp(self):
+        patcher = mock.patch('django.utils.timezone.now', return_value=NOW)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.users = {
+            username: User.objects.create_user(mobile=f'0800000000{number}', username=username, password='pass')
+            for number, username in enumerate(('ada', 'bola'))
+        }
+        for day, username, lines in SALES:
+            form = Form.objects.create(buyer_name='patient', total_amount=0, dispensed_by=self.users[username])
+            Form.objects.filter(pk=form.pk).update(date=datetime.combine(day, NOW.timetz()))
+            for category, drug, quantity, price in lines:
+                FormItem.objects.create(
+                    form=form, drug_name=drug, drug_type=category, unit='Tab',
+                    quantity=quantity, price=Decimal(price), subtotal=quantity * Decimal(price),
+                )
+        SalesRollupService.rebuild()
+
+    def revenue(self, report, category):
+        """{period: revenue} of the periods with sales"""
+        return {
+            period: value
+            for period, value in zip(report['periods'], report['revenue_by_category'][category])
+            if value
+        }
+
+    def test_daily_report(self):
+        report = SalesAnalyticsService.report('day')
+
+        self.assertEqual(
+            (report['periods'][0], report['periods'][-1], len(report['periods'])), (date(2026, 2, 17), date(2026, 3, 18), 30),
+        )
+        self.assertEqual(self.revenue(report, 'NCAP'), {
+            date(2026, 2, 20): Decimal('1.50'), date(2026, 3, 10): Decimal('5.00'),
+            date(2026, 3, 16): Decimal('3.00'), date(2026, 3, 18): Decimal('6.00'),
+        })
+        self.assertEqual(self.revenue(report, 'ONCOLOGY'), {date(2026, 3, 18): Decimal('50.00')})
+        self.assertEqual(self.revenue(report, 'LPACEMAKER'), {date(2026, 3, 16): Decimal('200.00')})
+        self.assertEqual(report['total_revenue'], Decimal('265.50'))
+        self.assertEqual(
+            [(row['drug_name'], row['quantity'], row['revenue']) for row in report['top_drugs']],
+            [
+                ('Ibuprofen', 10, Decimal('5.00')), ('Paracetamol', 7, Decimal('10.50')),
+                ('Lead', 1, Decimal('200.00')), ('Cisplatin', 1, Decimal('50.00')),
+            ],
+        )
+        self.assertEqual(
+            [
+                (row['dispensed_by__username'], row['line_count'], row['quantity'], row['revenue'])
+                for row in report['pharmacists']
+            ],
+            [('bola', 3, 4, Decimal('204.50')), ('ada', 3, 15, Decimal('61.00'))],
+        )
+
+    def test_weekly_report(self):
+        report = SalesAnalyticsService.report('week')
+
+        self.assertEqual((report['periods'][0], report['periods'][-1]), (date(2025, 12, 29), date(2026, 3, 16)))
+        self.assertEqual(self.revenue(report, 'NCAP'), {
+            date(2026, 2, 16): Decimal('1.50'), date(2026, 3, 9): Decimal('5.00'), date(2026, 3, 16): Decimal('9.00'),
+        })
+        self.assertEqual(self.revenue(report, 'ONCOLOGY'), {date(2026, 3, 16): Decimal('50.00')})
+        self.assertEqual(report['total_revenue'], Decimal('265.50'))
+
+    def test_monthly_report(self):
+        report = SalesAnalyticsService.report('month', top_n=3)
+
+        self.assertEqual((report['periods'][0], report['periods'][-1]), (date(2025, 4, 1), date(2026, 3, 1)))
+        self.assertEqual(self.revenue(report, 'NCAP'), {date(2026, 2, 1): Decimal('1.50'), date(2026, 3, 1): Decimal('14.00')})
+        self.assertEqual(
+            self.revenue(report, 'ONCOLOGY'), {date(2025, 12, 1): Decimal('100.00'), date(2026, 3, 1): Decimal('50.00')},
+        )
+        self.assertEqual(self.revenue(report, 'LPACEMAKER'), {date(2026, 3, 1): Decimal('200.00')})
+        self.assertEqual(report['total_revenue'], Decimal('365.50'))
+        self.assertEqual(
+            [(row['drug_name'], row['quantity']) for row in report['top_drugs']],
+            [('Ibuprofen', 10), ('Paracetamol', 7), ('Cisplatin', 3)],
+        )
+
+    def test_report_is_cached_per_bucket(self):
+        SalesAnalyticsService.report('day')
+        with self.assertNumQueries(0):
+            SalesAnalyticsService.report('day')
+        with self.assertNumQueries(3):
+            SalesAnalyticsService.report('week')
+
+
+class DashboardTotalsTests(TestCase):
+    def setUp(self):
+        cache.delete(USER_STATS_CACHE_KEY)
+        self.addCleanup(cache.delete, USER_STATS_CACHE_KEY)
+        self.users = []
+        for number, (user_type, is_staff, is_active) in enumerate((
+            ('Admin', True, True), ('Pharmacist', True, True), ('Pharmacist', False, True),
+            ('Pharm-Tech', True, False), (None, False, True),
+        )):
+            user = User.objects.create_user(
+                mobile=f'0800000000{number}', username=f'user{number}', password='pass',
+                is_staff=is_staff, is_active=is_active,
+            )
+            user.profile.user_type = user_type
+            user.profile.save()
+            self.users.append(user)
+        Group.objects.create(name='Counter')
+        Group.objects.create(name='Store')
+
+    def test_counts(self):
+        drugs = [
+            LpacemakerDrugs.objects.create(name=f'Lead {number}', unit='Tab', cost=Decimal('1.00'), stock=1)
+            for number in range(2)
+        ]
+        drug = NcapDrugs.objects.create(name='Paracetamol', unit='Tab', cost=Decimal('1.00'), stock=1)
+        carts = (
+            (self.users[0], {'lpacemaker_drug': drugs[0]}),
+            (self.users[0], {'ncap_drug': drug}),
+            (self.users[1], {'lpacemaker_drug': drugs[1]}),
+        )
+        for user, kwargs in carts:
+            Cart.objects.create(user=user, quantity=1, price=Decimal('1.10'), unit='Tab', **kwargs)
+
+        with self.assertNumQueries(1):
+            counts = DashboardService.counts(self.users[0])
+
+        self.assertEqual(counts, {'lpacemaker_count': 2, 'ncap_count': 1, 'oncology_count': 0, 'cart_count': 2})
+
+    def test_user_stats(self):
+        with self.assertNumQueries(1):
+            stats = DashboardService.user_stats()
+
+        self.assertEqual(stats, {
+            'admin_users': 1, 'pharmacist_users': 2, 'tech_users': 1, 'total_users': 5,
+            'active_staff': 2, 'total_groups': 2,
+        })
@@ -0,0 +1,147 @@
+"""
+Incremental expiry write-off: the watermark advances with each run, lots
+are written off in batches with one movement each, --since re-scans older
+dates, a second run finds nothing and lots an edit moves behind the
+watermark are written off by the edit.
+"""
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+
+from django.contrib import admin
+from django.core.management import call_command
+from django.test import RequestFactory, TestCase
+from django.utils import timezone
+
+from pharmacy.admin import StockLotAdmin
+from pharmacy.models import NcapDrugs, StockLot, StockMovement, User
+from pharmacy.services import ExpiryService, StockLotService
+
+
+class ExpiryTests(TestCase):
+    def setUp(self):
+        self.today = timezone.now().date()
+        self.drug = self.make_drug('Paracetamol')
+
+    def make_drug(self, name):
+        return NcapDrugs.objects.create(
+            name=name, unit='Tab', dosage_form='Tablet', cost=Decimal('10.00'), markup='10', stock=0,
+        )
+
+    def add_lot(self, days, quantity, drug=None):
+        drug = drug or self.drug
+        return StockLotService.receive('ncap', drug.pk, quantity, exp_date=self.today + timedelta(days=days))
+
+    def quantities(self, *lots):
+        return [StockLot.objects.get(pk=lot.pk).quantity for lot in lots]
+
+    def stock(self, drug=None):
+        return NcapDrugs.objects.get(pk=(drug or self.drug).pk).stock
+
+    def test_run_writes_off_expired_lots_and_advances_the_watermark(self):
+        old, recent, today, later = self.add_lot(-30, 4), self.add_lot(-1, 3), self.add_lot(0, 2), self.add_lot(10, 1)
+
+        summary = ExpiryService.run()
+
+        self.assertEqual((summary['window_start'], summary['window_end']), (None, self.today - timedelta(days=1)))
+        self.assertEqual((summary['drug_count'], summary['quantity'], summary['movements']), (1, 7, 1))
+        # A lot expiring today is still sellable today
+        self.assertEqual(self.quantities(old, recent, today, later), [0, 0, 2, 1])
+        self.assertEqual(self.stock(), 3)
+        self.assertEqual(NcapDrugs.objects.get(pk=self.drug.pk).exp_date, today.exp_date)
+        self.assertEqual(ExpiryService.watermark(), self.today - timedelta(days=1))
+
+    def test_lots_are_written_off_in_batches(self):
+        other = self.make_drug('Ibuprofen')
+        lots = [self.add_lot(-days, 1, drug) for days in (5, 4, 3) for drug in (self.drug, other)]
+
+        summary = ExpiryService.run(batch_size=4)
+
+        self.assertEqual((summary['quantity'], summary['movements']), (6, 2))
+        movements = list(StockMovement.objects.filter(kind='expiry').order_by('id'))
+        self.assertEqual([(movement.drug_count, movement.quantity) for movement in movements], [(2, 4), (2, 2)])
+        self.assertEqual(
+            [item['lot'] for movement in movements for item in movement.details], [lot.pk for lot in lots],
+        )
+        self.assertEqual((self.stock(), self.stock(other)), (0, 0))
+
+    def test_second_run_is_a_no_op(self):
+        self.add_lot(-2, 5)
+        ExpiryService.run()
+
+        summary = ExpiryService.run()
+
+        self.assertEqual(summary['window_start'], self.today - timedelta(days=1))
+        self.assertEqual((summary['drug_count'], summary['quantity'], summary['movements']), (0, 0, 0))
+        self.assertEqual(StockMovement.objects.filter(kind='expiry').count(), 1)
+
+    def test_since_rescans_dates_behind_the_watermark(self):
+        lot = self.add_lot(-5, 5)
+        ExpiryService.run()
+        # Stock put back behind the watermark outside the services
+        StockLot.objects.filter(pk=lot.pk).update(quantity=2)
+        NcapDrugs.objects.filter(pk=self.drug.pk).update(stock=2)
+
+        call_command('check_expired_items', stdout=StringIO())
+        self.assertEqual(self.quantities(lot), [2])
+
+        since = (self.today - timedelta(days=10)).isoformat()
+        output = StringIO()
+        call_command('check_expired_items', since=since, stdout=output)
+        self.assertIn(f'Window: after {since}', output.getvalue())
+        self.assertEqual(self.quantities(lot), [0])
+        self.assertEqual(self.stock(), 0)
+
+    def test_dry_run_writes_nothing(self):
+        lot = self.add_lot(-1, 5)
+
+        summary = ExpiryService.run(dry_run=True)
+
+        self.assertEqual((summary['quantity'], summary['movements']), (5, 0))
+        self.assertEqual(self.quantities(lot), [5])
+        self.assertIsNone(ExpiryService.watermark())
+
+    def test_edit_behind_the_watermark_is_written_off(self):
+        self.add_lot(-1, 1)
+        ExpiryService.run()
+        lot = self.add_lot(30, 6)
+        self.assertEqual(self.stock(), 6)
+
+        # The expiry is corrected to a date the job has already passed
+        NcapDrugs.objects.filter(pk=self.drug.pk).update(exp_date=self.today - timedelta(days=3))
+        StockLotService.sync('ncap', self.drug, previous_exp_date=lot.exp_date)
+
+        self.assertEqual(self.quantities(lot), [0])
+        self.assertEqual(self.stock(), 0)
+        movement = StockMovement.objects.filter(kind='expiry').latest('id')
+        self.assertEqual((movement.quantity, movement.window_end), (6, ExpiryService.watermark()))
+
+    def test_edit_ahead_of_the_watermark_is_left_to_the_job(self):
+        ExpiryService.run(today=self.today - timedelta(days=5))
+        lot = self.add_lot(30, 6)
+
+        NcapDrugs.objects.filter(pk=self.drug.pk).update(exp_date=self.today - timedelta(days=2))
+        StockLotService.sync('ncap', self.drug, previous_exp_date=lot.exp_date)
+        self.assertEqual(self.quantities(lot), [6])
+
+        ExpiryService.run()
+        self.assertEqual(self.quantities(lot), [0])
+
+    def test_lot_edited_in_the_admin_behind_the_watermark_is_written_off(self):
+        self.add_lot(-1, 1)
+        ExpiryService.run()
+        early, late = self.add_lot(30, 6), self.add_lot(60, 4)
+
+        model_admin = StockLotAdmin(StockLot, admin.site)
+        request = RequestFactory().post('/')
+        request.user = User.objects.create_superuser(mobile='08000000009', username='admin', password='pass')
+        lot = StockLot.objects.get(pk=late.pk)
+        form = model_admin.get_form(request, lot, change=True)(
+            {'lot_number': '', 'exp_date': self.today - timedelta(days=3)}, instance=lot,
+        )
+        self.assertTrue(form.is_valid(), form.errors)
+        model_admin.save_model(request, model_admin.save_form(request, form, change=True), form, change=True)
+
+        self.assertEqual(self.quantities(early, late), [6, 0])
+        self.assertEqual(self.stock(), 6)
+        self.assertEqual(NcapDrugs.objects.get(pk=self.drug.pk).exp_date, early.exp_date)
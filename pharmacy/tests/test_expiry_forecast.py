@@ -0,0 +1,101 @@
+"""
+Expiry forecast: lots are bucketed into the forecast windows per store with
+counts, quantities and values at risk, and drug lists carry an expiry
+status worked out in their query.
+"""
+from datetime import timedelta
+from decimal import Decimal
+
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from pharmacy.models import LpacemakerDrugs, NcapDrugs, StockLot
+from pharmacy.services import ExpiryForecastService, StockLotService
+
+
+@override_settings(EXPIRY_FORECAST_WINDOWS=(7, 30, 90))
+class ExpiryForecastTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.today = timezone.now().date()
+        # Prices of 11.00 and 22.00 at a 10% markup
+        self.ncap = NcapDrugs.objects.create(
+            name='Paracetamol', unit='Tab', dosage_form='Tablet', cost=Decimal('10.00'), markup='10', stock=0,
+        )
+        self.lpacemaker = LpacemakerDrugs.objects.create(
+            name='Amoxicillin', unit='Cap', dosage_form='Capsule', cost=Decimal('20.00'), markup='10', stock=0,
+        )
+
+    def add_lot(self, category, drug, days, quantity):
+        return StockLotService.receive(category, drug.pk, quantity, exp_date=self.today + timedelta(days=days))
+
+    def test_lots_are_bucketed_into_the_windows(self):
+        self.add_lot('ncap', self.ncap, -1, 9)      # expired: not forecast
+        self.add_lot('ncap', self.ncap, 0, 2)       # today
+        self.add_lot('ncap', self.ncap, 7, 3)       # last day of the 7-day window
+        self.add_lot('ncap', self.ncap, 8, 4)
+        self.add_lot('ncap', self.ncap, 90, 5)
+        self.add_lot('ncap', self.ncap, 91, 6)      # beyond the horizon
+        self.add_lot('lpacemaker', self.lpacemaker, 30, 1)
+        # Sold out lots carry no risk
+        empty = self.add_lot('lpacemaker', self.lpacemaker, 3, 1)
+        StockLot.objects.filter(pk=empty.pk).update(quantity=0)
+
+        report = ExpiryForecastService.report(self.today)
+
+        self.assertEqual(report['windows'], [7, 30, 90])
+        ncap, lpacemaker = report['categories']['ncap'], report['categories']['lpacemaker']
+        self.assertEqual(
+            [(ncap[window]['count'], ncap[window]['quantity'], ncap[window]['value']) for window in (7, 30, 90)],
+            [(2, 5, Decimal('55.00')), (3, 9, Decimal('99.00')), (4, 14, Decimal('154.00'))],
+        )
+        self.assertEqual(
+            [(lpacemaker[window]['count'], lpacemaker[window]['value']) for window in (7, 30, 90)],
+            [(0, Decimal('0')), (1, Decimal('22.00')), (1, Decimal('22.00'))],
+        )
+        self.assertEqual(report['categories']['oncology'][90], {'count': 0, 'quantity': 0, 'value': Decimal('0')})
+        self.assertEqual(report['totals'][30], {'count': 4, 'quantity': 10, 'value': Decimal('121.00')})
+        self.assertEqual(report['totals'][90], {'count': 5, 'quantity': 15, 'value': Decimal('176.00')})
+
+        self.assertEqual(
+            [(item['category'], item['id'], item['stock'], item['days_left']) for item in report['items']],
+            [
+                ('ncap', self.ncap.pk, 2, 0), ('ncap', self.ncap.pk, 3, 7), ('ncap', self.ncap.pk, 4, 8),
+                ('lpacemaker', self.lpacemaker.pk, 1, 30), ('ncap', self.ncap.pk, 5, 90),
+            ],
+        )
+        self.assertEqual(report['items'][0]['stock_value'], Decimal('22.00'))
+
+        self.assertEqual(
+            ExpiryForecastService.badge_counts(today=self.today),
+            (30, {'lpacemaker': 1, 'ncap': 3, 'oncology': 0}),
+        )
+
+    def test_report_is_cached_for_the_day(self):
+        self.add_lot('ncap', self.ncap, 5, 2)
+        ExpiryForecastService.report(self.today)
+
+        self.add_lot('ncap', self.ncap, 6, 3)
+        with self.assertNumQueries(0):
+            report = ExpiryForecastService.report(self.today)
+
+        self.assertEqual(report['totals'][7]['quantity'], 2)
+
+    def test_drugs_are_annotated_with_their_status(self):
+        expected = {}
+        for name, days, status in (
+            ('None', None, 'none'), ('Expired', -1, 'expired'), ('Today', 0, 'soon'),
+            ('Week', 7, 'soon'), ('Later', 8, 'valid'),
+        ):
+            exp_date = self.today + timedelta(days=days) if days is not None else None
+            drug = NcapDrugs.objects.create(name=name, unit='Tab', cost=Decimal('1.00'), stock=0, exp_date=exp_date)
+            expected[drug.pk] = (status, days)
+
+        drugs = ExpiryForecastService.annotate_status(NcapDrugs.objects.filter(pk__in=expected), self.today)
+
+        self.assertEqual(
+            {drug.pk: (drug.expiry_status, drug.days_left.days if drug.days_left is not None else None) for drug in drugs},
+            expected,
+        )
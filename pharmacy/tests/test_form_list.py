@@ -0,0 +1,110 @@
+"""
+Forms list against a hand-built fixture: the card statistics read from the
+daily rollup without a text search and from Form with one, the date filters
+and the search fields, and keyset paging through the list.
+"""
+from datetime import datetime, timezone as dt_timezone
+from decimal import Decimal
+from unittest import mock
+
+from django.test import TestCase
+from django.urls import reverse
+
+from pharmacy.models import Form, FormItem, User
+from pharmacy.services import SalesRollupService
+
+NOW = datetime(2026, 3, 18, 10, 0, tzinfo=dt_timezone.utc)
+
+# (buyer, hospital no, NCAP no, dispensed at, total)
+FORMS = [
+    ('Ada Obi', 'H1', '', datetime(2026, 3, 18, 9, 0), '10.00'),
+    ('Bola', 'H2', '', datetime(2026, 3, 18, 8, 0), '20.00'),
+    ('Ada Eze', 'H3', '', datetime(2026, 3, 14, 12, 0), '30.00'),
+    ('Chidi', 'H4', '', datetime(2026, 3, 1, 12, 0), '40.00'),
+    ('Ada', 'H5', '', datetime(2026, 2, 25, 12, 0), '50.00'),
+    ('Dayo', 'H6', 'ADA-7', datetime(2026, 1, 10, 12, 0), '60.00'),
+]
+
+
+class FormListTests(TestCase):
+    def setUp(self):
+        patcher = mock.patch('django.utils.timezone.now', return_value=NOW)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        user = User.objects.create_user(mobile='08000000001', username='counter', password='pass')
+        self.client.force_login(user)
+        self.forms = {}
+        for buyer, hospital_no, ncap_no, dispensed_at, total in FORMS:
+            form = Form.objects.create(
+                buyer_name=buyer, hospital_no=hospital_no, ncap_no=ncap_no,
+                total_amount=Decimal(total), dispensed_by=user,
+            )
+            Form.objects.filter(pk=form.pk).update(date=dispensed_at.replace(tzinfo=dt_timezone.utc))
+            FormItem.objects.create(
+                form=form, drug_name='Paracetamol', drug_type='NCAP', unit='Tab',
+                quantity=1, price=Decimal(total), subtotal=Decimal(total),
+            )
+            self.forms[buyer] = form
+        SalesRollupService.rebuild()
+
+    def form_list(self, **params):
+        """(buyers listed, card statistics)"""
+        context = self.client.get(reverse('store:forms'), params).context
+        stats = {
+            key: context[key] for key in ('total_forms', 'total_revenue', 'today_forms_count', 'monthly_total')
+        }
+        return [form.buyer_name for form in context['page']], stats
+
+    def stats(self, total_forms, total_revenue, today_forms_count, monthly_total):
+        return {
+            'total_forms': total_forms,
+            'total_revenue': Decimal(total_revenue),
+            'today_forms_count': today_forms_count,
+            'monthly_total': Decimal(monthly_total),
+        }
+
+    def test_statistics_come_from_the_rollup_without_a_search(self):
+        self.assertEqual(self.form_list(), (
+            ['Ada Obi', 'Bola', 'Ada Eze', 'Chidi', 'Ada', 'Dayo'], self.stats(6, '210.00', 2, '100.00'),
+        ))
+        self.assertEqual(self.form_list(filter='today'), (['Ada Obi', 'Bola'], self.stats(2, '30.00', 2, '30.00')))
+        self.assertEqual(
+            self.form_list(filter='week'), (['Ada Obi', 'Bola', 'Ada Eze'], self.stats(3, '60.00', 2, '60.00')),
+        )
+        # The last 30 days reach into February; the monthly card stays on March
+        self.assertEqual(
+            self.form_list(filter='month'),
+            (['Ada Obi', 'Bola', 'Ada Eze', 'Chidi', 'Ada'], self.stats(5, '150.00', 2, '100.00')),
+        )
+
+    def test_rollup_revenue_follows_item_edits(self):
+        form = self.forms['Bola']
+        rollup = SalesRollupService.snapshot(form)
+        FormItem.objects.filter(form=form).update(quantity=2, subtotal=Decimal('40.00'))
+        SalesRollupService.apply_form(form, rollup)
+
+        self.assertEqual(self.form_list(filter='today')[1], self.stats(2, '50.00', 2, '50.00'))
+
+    def test_statistics_come_from_the_forms_with_a_search(self):
+        # Buyer names and the NCAP number match case-insensitively
+        self.assertEqual(
+            self.form_list(q='ada'),
+            (['Ada Obi', 'Ada Eze', 'Ada', 'Dayo'], self.stats(4, '150.00', 1, '40.00')),
+        )
+        self.assertEqual(self.form_list(q='ada', filter='week'), (['Ada Obi', 'Ada Eze'], self.stats(2, '40.00', 1, '40.00')))
+        self.assertEqual(self.form_list(q=' h2 '), (['Bola'], self.stats(1, '20.00', 1, '20.00')))
+        form_id = self.forms['Chidi'].form_id
+        self.assertEqual(self.form_list(q=form_id), (['Chidi'], self.stats(1, '40.00', 0, '40.00')))
+        self.assertEqual(self.form_list(q='nobody'), ([], {
+            'total_forms': 0, 'total_revenue': 0, 'today_forms_count': 0, 'monthly_total': 0,
+        }))
+
+    def test_pages_follow_the_cursor(self):
+        with mock.patch('pharmacy.views.FORMS_PAGE_SIZE', 4):
+            first = self.client.get(reverse('store:forms')).context['page']
+            self.assertEqual([form.buyer_name for form in first], ['Ada Obi', 'Bola', 'Ada Eze', 'Chidi'])
+            response = self.client.get(reverse('store:forms'), {'cursor': first.next_cursor}, HTTP_HX_REQUEST='true')
+
+        self.assertTemplateUsed(response, 'partials/form_rows.html')
+        self.assertEqual([form.buyer_name for form in response.context['page']], ['Ada', 'Dayo'])
+        self.assertFalse(response.context['page'].has_next)
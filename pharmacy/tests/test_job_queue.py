@@ -0,0 +1,186 @@
+"""
+Database job queue: scheduled runs keyed by slot, retry backoff, dead
+letters after max_attempts and leases that run out; exports and rollup
+rebuilds run as jobs.
+"""
+import csv
+import io
+import shutil
+import tempfile
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from pathlib import Path
+
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from pharmacy.models import DailySalesRollup, Form, FormItem, Job, User
+from pharmacy.services import JobError, JobQueueService
+
+SCHEDULE = {
+    'hourly': {'job': 'purge_jobs', 'every': 3600, 'offset': 15 * 60},
+    'daily': {'job': 'command', 'payload': {'command': 'check'}, 'every': 86400, 'max_attempts': 1},
+}
+
+
+def failing_job(**kwargs):
+    return JobQueueService.enqueue('command', {'command': 'no_such_command'}, **kwargs)
+
+
+class JobQueueTests(TestCase):
+    def fetch(self, job):
+        return Job.objects.get(pk=job.pk)
+
+    @override_settings(JOB_SCHEDULE=SCHEDULE)
+    def test_each_scheduled_slot_is_queued_once(self):
+        now = datetime(2026, 1, 1, 10, 20, tzinfo=dt_timezone.utc)
+        # Several workers enqueue the same slots
+        for _ in range(3):
+            JobQueueService.enqueue_due(now)
+        JobQueueService.enqueue_due(now + timedelta(minutes=30))
+        self.assertEqual(
+            sorted(Job.objects.values_list('unique_key', 'run_at', 'max_attempts')),
+            sorted([
+                (f'hourly:{int((now.timestamp() - 900) // 3600)}', now.replace(minute=15), 5),
+                (f'daily:{int(now.timestamp() // 86400)}', now.replace(hour=0, minute=0), 1),
+            ]),
+        )
+        JobQueueService.enqueue_due(now + timedelta(hours=1))
+        self.assertEqual(Job.objects.filter(name='purge_jobs').count(), 2)
+
+    def test_unknown_jobs_are_refused(self):
+        with self.assertRaises(JobError):
+            JobQueueService.enqueue('no_such_job')
+
+    def test_failures_back_off_then_become_dead_letters(self):
+        job = failing_job(max_attempts=3)
+        for attempt, delay in ((1, 60), (2, 120)):
+            before = timezone.now()
+            self.assertEqual(JobQueueService.run_pending(worker='worker-a'), {'done': 0, 'retry': 1, 'dead': 0})
+            job = self.fetch(job)
+            self.assertEqual((job.status, job.attempts, job.claimed_by), ('QUEUED', attempt, ''))
+            self.assertTrue(before + timedelta(seconds=delay) <= job.run_at <= timezone.now() + timedelta(seconds=delay))
+            self.assertIn('no_such_command', job.last_error)
+            # Not due again until the retry time
+            self.assertIsNone(JobQueueService.claim('worker-a'))
+            Job.objects.filter(pk=job.pk).update(run_at=timezone.now())
+
+        self.assertEqual(JobQueueService.run_pending(worker='worker-a')['dead'], 1)
+        job = self.fetch(job)
+        self.assertEqual((job.status, job.attempts), ('DEAD', 3))
+        self.assertIsNotNone(job.finished_at)
+        self.assertIsNone(JobQueueService.claim('worker-a', timezone.now() + timedelta(days=1)))
+
+    def test_successful_jobs_are_done(self):
+        job = JobQueueService.enqueue('purge_jobs')
+        self.assertEqual(JobQueueService.run_pending(worker='worker-a')['done'], 1)
+        job = self.fetch(job)
+        self.assertEqual((job.status, job.attempts, job.last_error), ('DONE', 1, ''))
+
+    def test_expired_leases_are_claimed_again(self):
+        job = JobQueueService.enqueue('purge_jobs')
+        now = timezone.now()
+        stalled = JobQueueService.claim('worker-a', now)
+        self.assertEqual(stalled.pk, job.pk)
+        self.assertIsNone(JobQueueService.claim('worker-b', now))
+
+        later = now + timedelta(seconds=JobQueueService.lease_seconds() + 1)
+        taken_over = JobQueueService.claim('worker-b', later)
+        self.assertEqual((taken_over.pk, taken_over.attempts, taken_over.claimed_by), (job.pk, 2, 'worker-b'))
+
+        # The stalled worker finishing late does not overwrite the new claim
+        JobQueueService.run_job(stalled, 'worker-a')
+        job = self.fetch(job)
+        self.assertEqual((job.status, job.claimed_by), ('RUNNING', 'worker-b'))
+        self.assertEqual(JobQueueService.run_job(taken_over, 'worker-b'), 'done')
+        self.assertEqual(self.fetch(job).status, 'DONE')
+
+
+class BackgroundJobTests(TestCase):
+    def setUp(self):
+        self.directory = Path(tempfile.mkdtemp(prefix='neopharm-exports-'))
+        self.addCleanup(shutil.rmtree, self.directory, True)
+        settings = override_settings(EXPORT_DIR=self.directory)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.user = User.objects.create_user(mobile='08000000001', username='counter', password='pass')
+        self.client.force_login(self.user)
+        for buyer in ('Ada', 'Bola', 'Ada Eze'):
+            form = Form.objects.create(buyer_name=buyer, total_amount=Decimal('3.00'), dispensed_by=self.user)
+            FormItem.objects.create(
+                form=form, drug_name='Paracetamol', drug_type='NCAP', unit='Tab',
+                quantity=2, price=Decimal('1.50'), subtotal=Decimal('3.00'),
+            )
+
+    def test_export_is_written_by_the_worker_and_downloaded(self):
+        response = self.client.get(reverse('store:export_forms'), {'q': 'Ada', 'filter': 'today'})
+
+        job = Job.objects.get(name='export')
+        status_url = reverse('store:export_status', args=[job.pk])
+        self.assertRedirects(response, status_url)
+        download_url = reverse('store:export_download', args=[job.pk])
+        # Nothing is built in the request
+        self.assertEqual(list(self.directory.iterdir()), [])
+        self.assertContains(self.client.get(status_url), 'Preparing your export')
+        self.assertEqual(self.client.get(download_url).status_code, 404)
+
+        self.assertEqual(JobQueueService.run_pending(worker='worker-a')['done'], 1)
+
+        polled = self.client.get(status_url, HTTP_HX_REQUEST='true')
+        self.assertTemplateUsed(polled, 'partials/export_status.html')
+        self.assertContains(polled, download_url)
+        response = self.client.get(download_url)
+        self.assertEqual(
+            response['Content-Disposition'], f'attachment; filename="forms-{timezone.localdate():%Y%m%d}.csv"',
+        )
+        rows = list(csv.reader(io.StringIO(b''.join(response.streaming_content).decode())))
+        self.assertEqual(rows[0][:3], ['Form ID', 'Date', 'Patient'])
+        self.assertEqual(sorted(row[2] for row in rows[1:]), ['Ada', 'Ada Eze'])
+
+        # Other users cannot see the export
+        self.client.force_login(User.objects.create_user(mobile='08000000002', username='other', password='pass'))
+        self.assertEqual(self.client.get(status_url).status_code, 404)
+        self.assertEqual(self.client.get(download_url).status_code, 404)
+
+    def test_xlsx_export(self):
+        try:
+            from openpyxl import load_workbook
+        except ImportError:
+            self.skipTest('openpyxl is not installed')
+        self.client.get(reverse('store:export_form_items'), {'format': 'xlsx'})
+        JobQueueService.run_pending(worker='worker-a')
+
+        job = Job.objects.get(name='export')
+        response = self.client.get(reverse('store:export_download', args=[job.pk]))
+        sheet = load_workbook(io.BytesIO(b''.join(response.streaming_content))).active
+        rows = list(sheet.values)
+        self.assertEqual((sheet.title, len(rows)), ('Form items', 4))
+        self.assertEqual(rows[1][3:], ('Paracetamol', None, None, 'Tab', 2, 1.5, 3))
+
+    def test_purging_an_export_job_removes_its_file(self):
+        self.client.get(reverse('store:export_inventory'))
+        JobQueueService.run_pending(worker='worker-a')
+        job = Job.objects.get(name='export')
+        self.assertEqual(len(list(self.directory.iterdir())), 1)
+
+        Job.objects.filter(pk=job.pk).update(finished_at=timezone.now() - timedelta(days=8))
+        JobQueueService.enqueue('purge_jobs')
+        JobQueueService.run_pending(worker='worker-a')
+
+        self.assertFalse(Job.objects.filter(pk=job.pk).exists())
+        self.assertEqual(list(self.directory.iterdir()), [])
+
+    def test_rollup_rebuild_runs_as_a_job(self):
+        DailySalesRollup.objects.all().delete()
+        output = io.StringIO()
+
+        call_command('rebuild_sales_rollup', background=True, start=timezone.now().date().isoformat(), stdout=output)
+
+        job = Job.objects.get(name='rebuild_rollup')
+        self.assertIn(f'job #{job.pk}', output.getvalue())
+        self.assertFalse(DailySalesRollup.objects.exists())
+        self.assertEqual(JobQueueService.run_pending(worker='worker-a')['done'], 1)
+        rollup = DailySalesRollup.objects.get()
+        self.assertEqual((rollup.form_count, rollup.quantity, rollup.revenue), (3, 6, Decimal('9.00')))
@@ -0,0 +1,259 @@
+"""
+Offline replay: per-counter ordering, deferral behind a failure, retry
+backoff and quarantine, the single UPDATE that records a chunk, and the
+version conflict policies.
+"""
+from datetime import timedelta
+from decimal import Decimal
+
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from pharmacy.models import User, NcapDrugs, Cart, OfflineTransaction
+from pharmacy.services import DrugService, OfflineReplayService, StockLotService
+
+
+class OfflineReplayTestCase(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user(mobile='08000000001', username='alice', password='pass')
+        self.bob = User.objects.create_user(mobile='08000000002', username='bob', password='pass')
+        self.drug = NcapDrugs.objects.create(
+            name='Paracetamol', brand='brand', unit='Tab', dosage_form='Tablet',
+            cost=Decimal('10.00'), markup='10', stock=0,
+        )
+        StockLotService.receive('ncap', self.drug.pk, 10, exp_date=timezone.now().date() + timedelta(days=90))
+
+    def drug_version(self):
+        return NcapDrugs.objects.values_list('version', flat=True).get(pk=self.drug.pk)
+
+    def queue(self, user, transaction_type='ADD_TO_CART', quantity=1, version=None):
+        data = {'user_id': user.pk, 'drug_type': 'ncap', 'drug_id': self.drug.pk}
+        if transaction_type == 'ADD_TO_CART':
+            data['quantity'] = quantity
+        client_id = f'till-{user.pk}'
+        sequence = OfflineTransaction.objects.filter(client_id=client_id).count() + 1
+        return OfflineTransaction.objects.create(
+            transaction_type=transaction_type, data=data, client_id=client_id, sequence=sequence,
+            # Queued against the version the counter last saw
+            version=self.drug_version() if version is None else version,
+        )
+
+    def fetch(self, *txns):
+        return [OfflineTransaction.objects.get(pk=txn.pk) for txn in txns]
+
+    def make_due(self):
+        OfflineTransaction.objects.update(next_attempt_at=timezone.now() - timedelta(seconds=1))
+
+    def line_quantity(self, user):
+        line = Cart.objects.filter(user=user, form__isnull=True).first()
+        return line.quantity if line else 0
+
+
+class OfflineReplayTests(OfflineReplayTestCase):
+    @override_settings(OFFLINE_REPLAY_CONFLICT_POLICY='clamp')
+    def test_each_counter_replays_in_its_own_order(self):
+        # All queued before the first replay; with stock to spare 'clamp' applies them as sent
+        self.queue(self.alice, quantity=3)
+        self.queue(self.bob, quantity=2)
+        self.queue(self.alice, 'REMOVE_FROM_CART')
+        self.queue(self.alice, quantity=1)
+        summary = OfflineReplayService.run(chunk_size=2)
+        self.assertEqual((summary['synced'], summary['chunks']), (4, 2))
+        self.assertEqual((self.line_quantity(self.alice), self.line_quantity(self.bob)), (1, 2))
+        self.drug.refresh_from_db()
+        self.assertEqual(self.drug.stock, 7)
+
+    def test_failure_defers_the_same_counters_later_transactions(self):
+        failing = self.queue(self.alice, quantity=50)
+        waiting = self.queue(self.alice, quantity=1)
+        other = self.queue(self.bob, quantity=1)
+        before = timezone.now()
+        summary = OfflineReplayService.run()
+        self.assertEqual((summary['failed'], summary['deferred'], summary['synced']), (1, 1, 1))
+
+        failing, waiting, other = self.fetch(failing, waiting, other)
+        self.assertEqual((failing.retry_count, failing.last_error), (1, 'Insufficient stock'))
+        self.assertGreaterEqual(failing.next_attempt_at, before + timedelta(seconds=OfflineReplayService.RETRY_DELAY))
+        self.assertEqual((waiting.synced, waiting.retry_count), (False, 0))
+        self.assertEqual(waiting.last_error, f'Waiting for transaction #{failing.pk}')
+        self.assertEqual(waiting.next_attempt_at, failing.next_attempt_at)
+        self.assertTrue(other.synced)
+        self.assertEqual((self.line_quantity(self.alice), self.line_quantity(self.bob)), (0, 1))
+
+        # Neither is due again until the retry time
+        self.assertEqual(OfflineReplayService.run()['chunks'], 0)
+
+    @override_settings(OFFLINE_REPLAY_MAX_RETRIES=3)
+    def test_backoff_doubles_until_quarantine(self):
+        failing = self.queue(self.alice, quantity=50)
+        waiting = self.queue(self.alice, quantity=1)
+        for attempt, delay in ((1, 60), (2, 120)):
+            before = timezone.now()
+            OfflineReplayService.run()
+            after = timezone.now()
+            failing = self.fetch(failing)[0]
+            self.assertEqual((failing.retry_count, failing.quarantined), (attempt, False))
+            self.assertTrue(before + timedelta(seconds=delay) <= failing.next_attempt_at <= after + timedelta(seconds=delay))
+            self.make_due()
+
+        summary = OfflineReplayService.run()
+        self.assertEqual((summary['failed'], summary['quarantined']), (1, 1))
+        failing = self.fetch(failing)[0]
+        self.assertEqual((failing.retry_count, failing.quarantined, failing.synced), (3, True, False))
+
+        # The counter's queue moves on once the failure is set aside
+        self.make_due()
+        OfflineReplayService.run()
+        self.assertTrue(self.fetch(waiting)[0].synced)
+        self.assertEqual(self.line_quantity(self.alice), 1)
+        self.assertEqual(OfflineReplayService.pending().count(), 0)
+
+    def test_chunk_results_are_written_in_one_update(self):
+        txns = [self.queue(self.alice) for _ in range(5)]
+        held = self.queue(self.bob)
+        chunk = OfflineReplayService.claim('worker-a', 5)
+        self.assertEqual([txn.pk for txn in chunk], [txn.pk for txn in txns])
+        # Another worker's row in the results is left alone
+        OfflineTransaction.objects.filter(pk=held.pk).update(
+            claimed_by='worker-b', lease_expires=timezone.now() + timedelta(minutes=5),
+        )
+        synced, clamped, failed, deferred, rejected = txns
+        results = {
+            synced.pk: ('synced', '', None),
+            clamped.pk: ('clamped', 'cut to 3', None),
+            failed.pk: ('failed', 'Insufficient stock', None),
+            deferred.pk: ('deferred', f'Waiting for transaction #{failed.pk}', failed.pk),
+            rejected.pk: ('rejected', 'Queued against version 1', None),
+            held.pk: ('synced', '', None),
+        }
+        now = timezone.now()
+        with CaptureQueriesContext(connection) as queries:
+            OfflineReplayService._write_results(chunk, results, now, 'worker-a')
+        self.assertEqual(len(queries), 1)
+        self.assertTrue(queries[0]['sql'].startswith('UPDATE'))
+
+        synced, clamped, failed, deferred, rejected, held = self.fetch(*txns, held)
+        for txn in (synced, clamped, failed, deferred, rejected):
+            self.assertEqual((txn.claimed_by, txn.lease_expires), ('', None))
+        self.assertEqual((synced.synced, synced.processed_at, synced.conflict, synced.last_error), (True, now, '', ''))
+        self.assertEqual((clamped.synced, clamped.conflict, clamped.last_error), (True, 'CLAMPED', 'cut to 3'))
+        self.assertEqual((failed.synced, failed.retry_count, failed.quarantined), (False, 1, False))
+        self.assertEqual(failed.next_attempt_at, now + timedelta(seconds=OfflineReplayService.RETRY_DELAY))
+        self.assertEqual((deferred.retry_count, deferred.next_attempt_at), (0, failed.next_attempt_at))
+        self.assertEqual((rejected.synced, rejected.quarantined, rejected.conflict), (False, True, 'REJECTED'))
+        self.assertIsNone(rejected.processed_at)
+        self.assertEqual((held.synced, held.claimed_by), (False, 'worker-b'))
+
+
+
+class OfflineConflictTests(OfflineReplayTestCase):
+    def sell_elsewhere(self, quantity):
+        """Another counter sells online after this counter went offline"""
+        DrugService.add_to_cart(self.bob, 'ncap', self.drug.pk, quantity)
+
+    def test_own_changes_are_not_conflicts(self):
+        version = self.drug_version()
+        first = self.queue(self.alice, quantity=2, version=version)
+        OfflineReplayService.run()
+        # Still offline: the rest of the queue carries the version it saw
+        later = [
+            self.queue(self.alice, quantity=3, version=version),
+            self.queue(self.alice, 'REMOVE_FROM_CART', version=version),
+            self.queue(self.alice, 'REMOVE_FROM_CART', version=version),
+            self.queue(self.alice, quantity=1, version=version),
+        ]
+        summary = OfflineReplayService.run()
+        self.assertEqual((summary['synced'], summary['review']), (4, 0))
+        self.assertTrue(all(txn.synced and not txn.conflict for txn in self.fetch(first, *later)))
+        self.assertEqual(self.fetch(later[2])[0].last_error, OfflineReplayService.NOTHING_TO_REMOVE)
+        self.assertEqual(self.line_quantity(self.alice), 1)
+
+    def test_other_changes_are_conflicts_despite_own_ones(self):
+        version = self.drug_version()
+        self.queue(self.alice, quantity=1, version=version)
+        OfflineReplayService.run()
+        self.sell_elsewhere(1)
+        held = self.queue(self.alice, quantity=1, version=version)
+        self.assertEqual(OfflineReplayService.run()['review'], 1)
+        held = self.fetch(held)[0]
+        self.assertEqual((held.conflict, held.quarantined), ('REVIEW', True))
+        self.assertEqual(
+            held.last_error,
+            f'Queued against version {version}, drug is at version {version + 2} (1 change(s) by this counter)',
+        )
+
+    @override_settings(OFFLINE_REPLAY_CONFLICT_POLICY='reject')
+    def test_reject_policy(self):
+        version = self.drug_version()
+        self.sell_elsewhere(8)
+        rejected = self.queue(self.alice, quantity=1, version=version)
+        self.assertEqual(OfflineReplayService.run()['rejected'], 1)
+        rejected = self.fetch(rejected)[0]
+        self.assertEqual((rejected.conflict, rejected.quarantined, rejected.synced), ('REJECTED', True, False))
+        self.assertEqual(self.line_quantity(self.alice), 0)
+
+    @override_settings(OFFLINE_REPLAY_CONFLICT_POLICY='clamp')
+    def test_clamp_policy(self):
+        version = self.drug_version()
+        self.sell_elsewhere(8)
+        fits, clamped, nothing_left = (
+            self.queue(self.alice, quantity=1, version=version),
+            self.queue(self.alice, quantity=5, version=version),
+            self.queue(self.alice, quantity=1, version=version),
+        )
+        summary = OfflineReplayService.run()
+        self.assertEqual((summary['synced'], summary['clamped'], summary['rejected']), (1, 1, 1))
+        fits, clamped, nothing_left = self.fetch(fits, clamped, nothing_left)
+        self.assertEqual((fits.synced, fits.conflict), (True, ''))
+        self.assertEqual((clamped.synced, clamped.conflict), (True, 'CLAMPED'))
+        self.assertTrue(clamped.last_error.endswith('quantity cut from 5 to 1'))
+        self.assertEqual((nothing_left.conflict, nothing_left.quarantined), ('REJECTED', True))
+        self.assertEqual(self.line_quantity(self.alice), 2)
+        self.drug.refresh_from_db()
+        self.assertEqual(self.drug.stock, 0)
+
+    def test_review_policy_is_the_default(self):
+        version = self.drug_version()
+        self.sell_elsewhere(1)
+        held = self.queue(self.alice, quantity=1, version=version)
+        self.assertEqual(OfflineReplayService.run()['review'], 1)
+        held = self.fetch(held)[0]
+        self.assertEqual((held.conflict, held.quarantined, held.synced), ('REVIEW', True, False))
+        self.assertEqual(self.line_quantity(self.alice), 0)
+
+
+class OfflineClaimTests(OfflineReplayTestCase):
+    def claimed(self, chunk):
+        return [txn.pk for txn in chunk]
+
+    def test_workers_never_share_rows_or_a_counter(self):
+        first, second, third = (self.queue(self.alice) for _ in range(3))
+        other = self.queue(self.bob)
+        now = timezone.now()
+
+        self.assertEqual(self.claimed(OfflineReplayService.claim('worker-a', 2, now)), [first.pk, second.pk])
+        # Alice's third row waits behind the two worker-a holds
+        self.assertEqual(self.claimed(OfflineReplayService.claim('worker-b', 10, now)), [other.pk])
+        self.assertEqual(OfflineReplayService.claim('worker-b', 10, now + timedelta(seconds=1)), [])
+        self.assertEqual(
+            dict(OfflineTransaction.objects.values_list('pk', 'claimed_by')),
+            {first.pk: 'worker-a', second.pk: 'worker-a', third.pk: '', other.pk: 'worker-b'},
+        )
+
+    def test_expired_leases_are_claimed_again(self):
+        first, second = self.queue(self.alice), self.queue(self.alice)
+        now = timezone.now()
+        stale = OfflineReplayService.claim('worker-a', 1, now)
+        self.assertEqual(self.claimed(stale), [first.pk])
+
+        # worker-a stalls past its lease; worker-b takes the counter over in order
+        later = now + timedelta(seconds=OfflineReplayService.lease_seconds() + 1)
+        self.assertEqual(self.claimed(OfflineReplayService.claim('worker-b', 10, later)), [first.pk, second.pk])
+        self.assertEqual(OfflineReplayService.claim('worker-a', 10, later), [])
+
+        # The stalled worker's late write no longer owns the row
+        OfflineReplayService._write_results(stale, {first.pk: ('synced', '', None)}, later, 'worker-a')
+        first = self.fetch(first)[0]
+        self.assertEqual((first.synced, first.claimed_by), (False, 'worker-b'))
@@ -0,0 +1,93 @@
+"""
+Bulk upload of offline counter queues: CSRF, gzip bodies and their size
+cap, de-duplication by (client_id, sequence) and who a row is replayed as.
+"""
+import gzip
+
+import orjson
+from django.test import Client, TestCase, override_settings
+from django.urls import reverse
+
+from pharmacy.models import User, OfflineTransaction
+
+CSRF_TOKEN = 'a' * 32
+
+
+class OfflineSyncTests(TestCase):
+    def setUp(self):
+        self.counter = User.objects.create_user(mobile='08000000001', username='counter', password='pass')
+        self.other = User.objects.create_user(mobile='08000000002', username='other', password='pass')
+        self.client = Client(enforce_csrf_checks=True)
+        self.client.force_login(self.counter)
+        self.client.cookies['csrftoken'] = CSRF_TOKEN
+        self.url = reverse('store:offline_sync')
+
+    def item(self, sequence, **data):
+        return {
+            'client_id': 'till-1', 'sequence': sequence, 'type': 'ADD_TO_CART', 'version': 1,
+            'data': {'drug_type': 'ncap', 'drug_id': 1, 'quantity': 1, **data},
+        }
+
+    def upload(self, body, **headers):
+        if not isinstance(body, bytes):
+            body = orjson.dumps(body)
+        headers.setdefault('HTTP_X_CSRFTOKEN', CSRF_TOKEN)
+        return self.client.post(self.url, body, content_type='application/json', **headers)
+
+    def test_csrf_token_is_required(self):
+        response = self.client.post(self.url, b'[]', content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(self.upload([]).status_code, 200)
+
+    def test_gzip_bodies_are_decoded(self):
+        body = gzip.compress(orjson.dumps([self.item(1), self.item(2)]))
+        response = self.upload(body, HTTP_CONTENT_ENCODING='gzip')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['inserted'], 2)
+        # Recognised by its magic number without the header too
+        self.assertEqual(self.upload(gzip.compress(orjson.dumps([self.item(3)]))).json()['inserted'], 1)
+        self.assertEqual(self.upload(b'\x1f\x8bnot gzip').status_code, 400)
+
+    @override_settings(OFFLINE_SYNC_MAX_BYTES=1024)
+    def test_decompressed_size_is_capped(self):
+        body = gzip.compress(orjson.dumps([self.item(sequence) for sequence in range(100)]))
+        self.assertLess(len(body), 1024)
+        response = self.upload(body, HTTP_CONTENT_ENCODING='gzip')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('exceeds 1024 bytes', response.json()['error'])
+        self.assertFalse(OfflineTransaction.objects.exists())
+
+    def test_reuploads_are_deduplicated_by_client_and_sequence(self):
+        self.upload([self.item(1), self.item(2)])
+        response = self.upload([self.item(2), self.item(2), self.item(3), dict(self.item(3), client_id='till-2')])
+        summary = response.json()
+        self.assertEqual((summary['received'], summary['inserted'], summary['duplicates']), (4, 2, 2))
+        self.assertEqual(summary['acknowledged'], {'till-1': 3, 'till-2': 3})
+        self.assertEqual(
+            list(OfflineTransaction.objects.order_by('client_id', 'sequence').values_list('client_id', 'sequence')),
+            [('till-1', 1), ('till-1', 2), ('till-1', 3), ('till-2', 3)],
+        )
+
+    def test_counters_cannot_upload_for_other_users(self):
+        self.upload([self.item(1, user_id=self.other.pk)])
+        self.assertEqual(OfflineTransaction.objects.get().data['user_id'], self.counter.pk)
+
+        self.counter.is_staff = True
+        self.counter.save()
+        self.upload([self.item(2, user_id=self.other.pk)])
+        self.assertEqual(OfflineTransaction.objects.get(sequence=2).data['user_id'], self.other.pk)
+
+    def test_invalid_items_are_reported(self):
+        summary = self.upload([self.item(1), {'client_id': 'till-1', 'type': 'ADD_TO_CART'}, 'x']).json()
+        self.assertEqual(summary['inserted'], 1)
+        self.assertEqual([error['index'] for error in summary['errors']], [1, 2])
+
+    def test_adds_and_removes_need_a_version(self):
+        unversioned = {key: value for key, value in self.item(1).items() if key != 'version'}
+        checkout = dict(unversioned, sequence=2, type='CHECKOUT', data={})
+        summary = self.upload([unversioned, dict(unversioned, type='REMOVE_FROM_CART'), checkout]).json()
+        self.assertEqual(
+            [error['error'] for error in summary['errors']],
+            ['version is required for ADD_TO_CART', 'version is required for REMOVE_FROM_CART'],
+        )
+        self.assertEqual(OfflineTransaction.objects.get().transaction_type, 'CHECKOUT')
@@ -0,0 +1,241 @@
+"""
+Per-view query budgets.
+Every route in pharmacy/urls.py is requested against a seeded dataset and
+must stay within its budget without repeating a statement shape per row.
+Adding a route without a budget entry fails test_every_route_has_a_budget.
+"""
+import re
+from datetime import timedelta
+from decimal import Decimal
+
+from django.contrib.auth.models import Group
+from django.db import transaction
+from django.test import TestCase
+from django.utils import timezone
+
+from pharmacy import urls as pharmacy_urls
+from pharmacy.models import (
+    User,
+    LpacemakerDrugs,
+    NcapDrugs,
+    OncologyPharmacy,
+    Cart,
+    Form,
+    FormItem,
+    StockLot,
+)
+from pharmacy.services import ExportService
+from .query_budget import QueryBudget, N_PLUS_ONE_THRESHOLD, sql_shape, find_repeated_queries
+
+# Rows seeded per relation; must exceed N_PLUS_ONE_THRESHOLD so that a
+# per-row query shows up as a repeated shape.
+SEED_ROWS = N_PLUS_ONE_THRESHOLD + 2
+
+# route -> (HTTP method, max queries). Budgets include the session and auth
+# lookups made by middleware on every request.
+ROUTE_BUDGETS = {
+    '': ('get', 5),
+    # Includes the expiry forecast's cache miss: a range query and a
+    # window aggregate per store
+    'store/': ('get', 20),
+    'dashboard/': ('get', 11),
+    'dispense/': ('get', 14),
+    'cart/': ('get', 9),
+    'receipt/': ('get', 9),
+    'receipt/<str:receipt_id>/': ('get', 9),
+    'logout/': ('get', 8),
+    'add-item/': ('get', 8),
+    'import-inventory/': ('get', 8),
+    'edit-item/<str:drug_type>/<int:pk>/': ('get', 9),
+    'delete-item/<str:drug_type>/<int:pk>/': ('get', 3),
+    'cart/clear/': ('get', 13),
+    'return/<str:drug_type>/<int:pk>/': ('get', 3),
+    'quick-dispense/<str:drug_type>/<int:pk>/': ('get', 14),
+    'add-to-cart/<str:drug_type>/<int:pk>/': ('get', 15),
+    'update-cart/<str:pk>/': ('get', 9),
+    'remove-from-cart/<str:pk>/': ('get', 11),
+    'search/': ('get', 13),
+    'register/': ('get', 8),
+    'profile/': ('get', 8),
+    'forms/': ('get', 12),
+    'export/forms/': ('get', 6),
+    'export/form-items/': ('get', 6),
+    'export/inventory/': ('get', 6),
+    'export/<int:job_id>/': ('get', 9),
+    'export/<int:job_id>/download/': ('get', 6),
+    'forms/<str:form_id>/': ('get', 11),
+    'forms/<str:form_id>/edit/': ('get', 6),
+    'forms/<str:form_id>/items/add/': ('get', 6),
+    'forms/<str:form_id>/items/<int:item_id>/edit/': ('get', 7),
+    'forms/<str:form_id>/items/<int:item_id>/remove/': ('get', 21),
+    'search-items/': ('get', 8),
+    'get-category-drugs/': ('get', 6),
+    'analytics/': ('get', 11),
+    'reports/expiring/': ('get', 11),
+    'admin/': ('get', 14),
+    'admin/users/': ('get', 13),
+    'admin/users/create/': ('get', 8),
+    'admin/users/<int:user_id>/edit/': ('get', 12),
+    'admin/users/<int:user_id>/delete/': ('get', 9),
+    'admin/users/<int:user_id>/permissions/': ('get', 15),
+    'admin/groups/': ('get', 11),
+    'admin/groups/create/': ('get', 9),
+    'admin/groups/<int:group_id>/edit/': ('get', 13),
+    'admin/groups/<int:group_id>/delete/': ('get', 11),
+    'admin/groups/<int:group_id>/': ('get', 4),
+    'admin/users/category/<str:category>/': ('get', 13),
+    'admin/users/<int:user_id>/change-password/': ('get', 8),
+    'admin/users/<int:user_id>/set-password/': ('get', 8),
+    'profile/change-password/': ('get', 8),
+    'admin/model-browser/': ('get', 11),
+    'admin/model-browser/select/': ('get', 8),
+    'admin/model-browser/<str:category>/': ('get', 10),
+    'admin/model-browser/<str:category>/<int:drug_id>/edit/': ('get', 9),
+    'api/extend-session/': ('post', 5),
+    'api/offline-sync/': ('post', 5),
+    'api/catalog/<str:category>/changes/': ('get', 7),
+}
+
+# Routes that currently fail to render (missing templates or bad {% url %}
+# arguments). Their queries are still counted, but a server error is tolerated.
+# Remove an entry once the view is fixed.
+BROKEN_ROUTES = {
+    'delete-item/<str:drug_type>/<int:pk>/',
+    'return/<str:drug_type>/<int:pk>/',
+    'forms/<str:form_id>/edit/',
+    'forms/<str:form_id>/items/add/',
+    'forms/<str:form_id>/items/<int:item_id>/edit/',
+    'admin/groups/<int:group_id>/',
+}
+
+# Routes that legitimately write one row per cart line
+ALLOW_REPEATS = set()
+
+# Extra query string for routes whose interesting path needs parameters
+ROUTE_QUERY = {
+    'dispense/': {'q': 'drug'},
+    'search/': {'q': 'drug'},
+    'search-items/': {'q': 'drug'},
+    'get-category-drugs/': {'category': 'ncap', 'q': 'drug'},
+    'forms/': {'filter': 'month'},
+}
+
+_CONVERTER = re.compile(r'<(?:\w+:)?(\w+)>')
+
+
+class SqlShapeTests(TestCase):
+    def test_literals_are_normalised(self):
+        self.assertEqual(
+            sql_shape("SELECT * FROM t WHERE id = 12 AND name = 'it''s'"),
+            sql_shape("SELECT * FROM t WHERE id = 7 AND name = 'x'"),
+        )
+
+    def test_repeats_below_threshold_are_ignored(self):
+        queries = [{'sql': f'SELECT 1 FROM t WHERE id = {i}'} for i in range(N_PLUS_ONE_THRESHOLD - 1)]
+        self.assertEqual(find_repeated_queries(queries), [])
+        queries.append({'sql': 'SELECT 1 FROM t WHERE id = 99'})
+        self.assertEqual(len(find_repeated_queries(queries)), 1)
+
+
+class ViewQueryBudgetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser(
+            mobile='08000000000', username='admin', password='pass', is_staff=True
+        )
+        cls.admin.profile.user_type = 'Admin'
+        cls.admin.profile.save()
+
+        user_types = ['Pharmacist', 'Pharm-Tech', 'Admin']
+        cls.staff = []
+        for i in range(SEED_ROWS):
+            user = User.objects.create_user(mobile=f'0810000000{i}', username=f'staff{i}', password='pass')
+            user.profile.user_type = user_types[i % len(user_types)]
+            user.profile.save()
+            cls.staff.append(user)
+        cls.group = Group.objects.create(name='Counter')
+        cls.group.pharmacy_user_groups.add(*cls.staff)
+
+        next_year = timezone.now().date() + timedelta(days=365)
+        drugs = {}
+        for model in (LpacemakerDrugs, NcapDrugs, OncologyPharmacy):
+            drugs[model] = [
+                model.objects.create(
+                    name=f'drug {model.__name__} {i}', brand='brand', unit='Tab', dosage_form='Tablet',
+                    cost=Decimal('10.00'), markup='10', stock=100, exp_date=next_year,
+                )
+                for i in range(SEED_ROWS)
+            ]
+        lot_fields = {LpacemakerDrugs: 'lpacemaker_drug', NcapDrugs: 'ncap_drug', OncologyPharmacy: 'oncology_drug'}
+        lots = {}
+        for model, field in lot_fields.items():
+            for drug in drugs[model]:
+                lots[drug] = StockLot.objects.create(**{field: drug}, exp_date=drug.exp_date, quantity=drug.stock)
+        cls.drug = drugs[NcapDrugs][0]
+
+        for model, field in lot_fields.items():
+            for drug in drugs[model]:
+                Cart.objects.create(
+                    user=cls.admin, quantity=1, price=drug.price, unit='Tab',
+                    lot_allocations={str(lots[drug].pk): 1}, **{field: drug},
+                )
+        cls.cart_item = Cart.objects.filter(user=cls.admin).first()
+        cls.export = ExportService.enqueue('forms', 'csv', {}, cls.admin)
+
+        cls.forms = []
+        for i in range(SEED_ROWS):
+            form = Form.objects.create(
+                buyer_name=f'patient {i}', hospital_no=f'H{i}', total_amount=Decimal('22.00'),
+                dispensed_by=cls.staff[i],
+            )
+            for drug_type in ('LPACEMAKER', 'NCAP', 'ONCOLOGY'):
+                FormItem.objects.create(
+                    form=form, drug_name='drug', drug_type=drug_type, unit='Tab',
+                    quantity=1, price=Decimal('11.00'), subtotal=Decimal('11.00'),
+                )
+            cls.forms.append(form)
+
+    def route_kwargs(self):
+        form = self.forms[0]
+        return {
+            'receipt_id': form.form_id,
+            'form_id': form.form_id,
+            'item_id': form.items.first().pk,
+            'drug_type': 'ncap',
+            'category': 'ncap',
+            'pk': self.drug.pk,
+            'drug_id': self.drug.pk,
+            'user_id': self.staff[0].pk,
+            'group_id': self.group.pk,
+            'job_id': self.export.pk,
+        }
+
+    def build_path(self, route, kwargs):
+        if route.startswith('update-cart/') or route.startswith('remove-from-cart/'):
+            kwargs = dict(kwargs, pk=self.cart_item.pk)
+        if route.startswith('admin/users/category/'):
+            kwargs = dict(kwargs, category='Pharmacist')
+        return '/' + _CONVERTER.sub(lambda m: str(kwargs[m.group(1)]), route)
+
+    def test_every_route_has_a_budget(self):
+        routes = {str(pattern.pattern) for pattern in pharmacy_urls.urlpatterns}
+        self.assertEqual(routes - set(ROUTE_BUDGETS), set(), 'Add a query budget for new routes')
+
+    def test_routes_stay_within_budget(self):
+        kwargs = self.route_kwargs()
+        for route, (method, budget) in ROUTE_BUDGETS.items():
+            with self.subTest(route=route):
+                self.client.force_login(self.admin)
+                path = self.build_path(route, kwargs)
+                self.client.raise_request_exception = route not in BROKEN_ROUTES
+                # Several views mutate on GET; roll each request back so
+                # every route sees the same seeded data.
+                with transaction.atomic():
+                    with QueryBudget(budget, label=path, allow_repeats=route in ALLOW_REPEATS):
+                        response = getattr(self.client, method)(path, ROUTE_QUERY.get(route, {}))
+                        if getattr(response, 'streaming', False):
+                            # Exports query while the body is consumed
+                            b''.join(response.streaming_content)
+                    transaction.set_rollback(True)
+                if route not in BROKEN_ROUTES:
+                    self.assertLess(response.status_code, 500)
@@ -0,0 +1,57 @@
+"""
+Stored receipts: reprints are served from ReceiptDocument, and a document
+rendered before an edit is never served after it.
+"""
+from decimal import Decimal
+
+from django.test import TestCase
+from django.urls import reverse
+
+from pharmacy.models import User, Form, FormItem, ReceiptDocument
+from pharmacy.services import ReceiptService
+from .query_budget import QueryBudget
+
+
+class ReceiptDocumentTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(mobile='08000000001', username='counter', password='pass')
+        cls.form = Form.objects.create(buyer_name='patient', total_amount=Decimal('11.00'), dispensed_by=cls.user)
+        cls.item = FormItem.objects.create(
+            form=cls.form, drug_name='Paracetamol', drug_type='NCAP', unit='Tab',
+            quantity=1, price=Decimal('11.00'), subtotal=Decimal('11.00'),
+        )
+
+    def test_stored_receipt_is_served_with_one_query(self):
+        ReceiptService.store(self.form)
+        with QueryBudget(1, label='get_document'):
+            document = ReceiptService.get_document(self.form.form_id)
+        self.assertIn(b'Paracetamol', bytes(document.body))
+
+    def test_reprint_view_reads_only_the_document(self):
+        ReceiptService.store(self.form)
+        self.client.force_login(self.user)
+        path = reverse('store:receipt_detail', args=[self.form.form_id])
+        # Session and user lookups, the document, and the session save
+        with QueryBudget(6, label=path):
+            response = self.client.get(path)
+        self.assertEqual(response.status_code, 200)
+
+    def test_render_racing_an_edit_is_not_served(self):
+        # Read before the edit, stored after it
+        stale = Form.objects.get(pk=self.form.pk)
+        FormItem.objects.filter(pk=self.item.pk).update(drug_name='Ibuprofen')
+        ReceiptService.invalidate(self.form)
+        ReceiptService.store(stale)
+
+        document = ReceiptService.get_document(self.form.form_id)
+        self.assertIn(b'Ibuprofen', bytes(document.body))
+        self.assertEqual(ReceiptDocument.objects.get(form=self.form, variant='html').form_version, 1)
+
+    def test_edit_renders_again(self):
+        ReceiptService.store(self.form)
+        FormItem.objects.filter(pk=self.item.pk).update(drug_name='Ibuprofen')
+        ReceiptService.invalidate(self.form)
+        self.assertIn(b'Ibuprofen', bytes(ReceiptService.get_document(self.form.form_id).body))
+        # The print variant is still stale and is rendered on its own first use
+        self.assertIn(b'Ibuprofen', bytes(ReceiptService.get_document(self.form.form_id, 'print').body))
@@ -0,0 +1,124 @@
+"""
+Reporting reads: inside reporting_reads() queries read the snapshot while it
+is fresh, writes and reads inside a transaction stay on the primary, and a
+snapshot older than REPORTING_MAX_STALENESS (by its user_version stamp)
+sends reads back to the primary until it is refreshed.
+"""
+import os
+import sqlite3
+import time
+import unittest
+from contextlib import ExitStack
+
+from django.db import connection, connections, router, transaction
+from django.test import TransactionTestCase, override_settings
+
+from pharmacy import db
+from pharmacy.db import (
+    REPORTING_DB_ALIAS, categories_split, refresh_reporting_snapshot, reporting_configured,
+    reporting_queryset, reporting_reads, scratch_sqlite_database,
+)
+from pharmacy.models import User
+
+
+@unittest.skipIf(categories_split(), 'the category files of a split run are in-memory test databases')
+@override_settings(REPORTING_MAX_STALENESS=900)
+class ReportingRouterTests(TransactionTestCase):
+    databases = {'default', REPORTING_DB_ALIAS}
+
+    def setUp(self):
+        # The snapshot is copied file to file, so give the primary a scratch
+        # file and the reporting alias a file of its own beside it
+        stack = ExitStack()
+        self.addCleanup(stack.close)
+        path = stack.enter_context(scratch_sqlite_database(connection))
+        reporting = connections[REPORTING_DB_ALIAS]
+        self.snapshot_path = os.path.join(os.path.dirname(path), 'reporting.sqlite3')
+        mirror_name = reporting.settings_dict['NAME']
+        reporting.close()
+        reporting.settings_dict['NAME'] = self.snapshot_path
+        stack.callback(reporting.settings_dict.__setitem__, 'NAME', mirror_name)
+        stack.callback(reporting.close)
+        stack.callback(db._snapshot.update, checked_at=None, taken_at=0)
+        db._snapshot.update(checked_at=None, taken_at=0)
+        User.objects.create_user(mobile='08000000001', username='before', password='pass')
+
+    def usernames(self):
+        return sorted(User.objects.values_list('username', flat=True))
+
+    def stamp_snapshot(self, taken_at):
+        """Rewrite the snapshot's user_version as if it had been copied at `taken_at`"""
+        connections[REPORTING_DB_ALIAS].close()
+        snapshot = sqlite3.connect(self.snapshot_path)
+        try:
+            snapshot.execute(f'PRAGMA user_version = {int(taken_at)}')
+            snapshot.commit()
+        finally:
+            snapshot.close()
+        db._snapshot.update(checked_at=None)
+
+    def test_reads_use_a_fresh_snapshot(self):
+        self.assertTrue(reporting_configured())
+        refresh_reporting_snapshot()
+        User.objects.create_user(mobile='08000000002', username='after', password='pass')
+
+        with reporting_reads():
+            self.assertEqual(router.db_for_read(User), REPORTING_DB_ALIAS)
+            self.assertEqual(User.objects.all().db, REPORTING_DB_ALIAS)
+            # The snapshot does not have the row written since it was taken
+            self.assertEqual(self.usernames(), ['before'])
+            pinned = reporting_queryset(User.objects.all())
+
+        self.assertEqual(pinned.db, REPORTING_DB_ALIAS)
+        self.assertEqual(router.db_for_read(User), 'default')
+        self.assertEqual(self.usernames(), ['after', 'before'])
+
+    def test_writes_and_transactions_stay_on_the_primary(self):
+        refresh_reporting_snapshot()
+
+        with reporting_reads():
+            self.assertEqual(router.db_for_write(User), 'default')
+            User.objects.create_user(mobile='08000000002', username='written', password='pass')
+            # A read inside a transaction must see that transaction's writes
+            with transaction.atomic():
+                self.assertEqual(router.db_for_read(User), 'default')
+                self.assertEqual(self.usernames(), ['before', 'written'])
+            self.assertEqual(self.usernames(), ['before'])
+
+        self.assertEqual(self.usernames(), ['before', 'written'])
+
+    def test_stale_snapshot_falls_back_until_refreshed(self):
+        refresh_reporting_snapshot()
+        self.stamp_snapshot(time.time() - 901)
+        User.objects.create_user(mobile='08000000002', username='after', password='pass')
+
+        with reporting_reads():
+            self.assertEqual(router.db_for_read(User), 'default')
+            self.assertEqual(self.usernames(), ['after', 'before'])
+
+        refresh_reporting_snapshot()
+
+        with reporting_reads():
+            self.assertEqual(router.db_for_read(User), REPORTING_DB_ALIAS)
+            self.assertEqual(self.usernames(), ['after', 'before'])
+
+    def test_snapshot_age_is_rechecked_periodically(self):
+        refresh_reporting_snapshot()
+        with reporting_reads():
+            self.assertEqual(router.db_for_read(User), REPORTING_DB_ALIAS)
+
+        self.stamp_snapshot(time.time() - 901)
+        # Within SNAPSHOT_CHECK_SECONDS the cached age is trusted
+        db._snapshot.update(checked_at=time.monotonic())
+        with reporting_reads():
+            self.assertEqual(router.db_for_read(User), REPORTING_DB_ALIAS)
+
+        db._snapshot.update(checked_at=time.monotonic() - db.SNAPSHOT_CHECK_SECONDS - 1)
+        with reporting_reads():
+            self.assertEqual(router.db_for_read(User), 'default')
+
+    def test_missing_snapshot_reads_the_primary(self):
+        # Never refreshed: the empty file has user_version 0
+        with reporting_reads():
+            self.assertEqual(router.db_for_read(User), 'default')
+            self.assertEqual(self.usernames(), ['before'])
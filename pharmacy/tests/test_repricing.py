@@ -0,0 +1,100 @@
+"""
+Store-wide repricing: prices computed in SQL match markup_price() to the
+kobo for every tier, rows without a cost keep their manual price, dry runs
+write nothing and applied runs leave a price history.
+"""
+from decimal import Decimal
+
+from django.test import TestCase
+
+from pharmacy.models import MARKUP_CHOICES, NcapDrugs, PriceChange, User, markup_price
+from pharmacy.services import RepricingService
+
+# Costs whose marked-up price lands on or near half a kobo
+COSTS = ['0.05', '0.15', '1.15', '2.35', '12.34', '999.99']
+
+
+class RepricingTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(mobile='08000000001', username='admin', password='pass')
+
+    def drug(self, cost, markup='10', price=None):
+        # bulk_create skips save(), so the price is whatever the test sets
+        return NcapDrugs.objects.bulk_create([NcapDrugs(
+            name=f'Drug {cost} {markup}', cost=Decimal(cost), markup=markup,
+            price=Decimal(price) if price is not None else Decimal('0.00'), stock=0,
+        )])[0]
+
+    def test_prices_match_markup_price_for_every_tier(self):
+        markups = [value for value, _ in MARKUP_CHOICES]
+        # Every tier moves to another one
+        tiers = dict(zip(markups, reversed(markups)))
+        drugs = [(self.drug(cost, markup), cost, tiers[markup]) for markup in markups for cost in COSTS]
+
+        summary = RepricingService.reprice('ncap', tiers=tiers)
+
+        self.assertEqual(summary['changed'], len(drugs))
+        for drug, cost, markup in drugs:
+            drug.refresh_from_db()
+            self.assertEqual((drug.markup, drug.price), (markup, markup_price(cost, markup)))
+
+    def test_rows_without_cost_keep_their_price(self):
+        costless = self.drug('0', price='50.00')
+        costed = self.drug('10.00', price='11.00')
+
+        summary = RepricingService.reprice('ncap', tiers={'10': '20'})
+
+        costless.refresh_from_db()
+        costed.refresh_from_db()
+        self.assertEqual((costless.markup, costless.price), ('20', Decimal('50.00')))
+        self.assertEqual((costed.markup, costed.price), ('20', Decimal('12.00')))
+        changes = {change['id']: change for change in summary['changes']}
+        self.assertEqual(changes[costless.pk]['new_price'], Decimal('50.00'))
+        # Recomputing at the current markup leaves the costless row alone
+        self.assertEqual(RepricingService.reprice('ncap')['changed'], 0)
+
+    def test_dry_run_changes_nothing(self):
+        drug = self.drug('10.00', price='11.00')
+
+        summary = RepricingService.reprice('ncap', tiers={'10': '50'}, dry_run=True)
+
+        self.assertTrue(summary['dry_run'])
+        self.assertIsNone(summary['batch'])
+        self.assertEqual(
+            [(change['id'], change['new_markup'], change['new_price'], change['difference']) for change in summary['changes']],
+            [(drug.pk, '50', Decimal('15.00'), Decimal('4.00'))],
+        )
+        drug.refresh_from_db()
+        self.assertEqual((drug.markup, drug.price), ('10', Decimal('11.00')))
+        self.assertFalse(PriceChange.objects.exists())
+
+    def test_history_is_written_for_changed_rows(self):
+        changed = self.drug('10.00', price='11.00')
+        unchanged = self.drug('10.00', markup='20', price='12.00')
+        other_tier = self.drug('20.00', markup='30', price='26.00')
+
+        summary = RepricingService.reprice('ncap', tiers={'10': '25', '20': '20'}, user=self.user)
+
+        self.assertEqual(summary['changed'], 1)
+        history = PriceChange.objects.get()
+        self.assertEqual(
+            (history.batch, history.drug_type, history.drug_id, history.drug_name, history.cost),
+            (summary['batch'], 'NCAP', changed.pk, changed.name, Decimal('10.00')),
+        )
+        self.assertEqual(
+            (history.old_markup, history.new_markup, history.old_price, history.new_price, history.changed_by),
+            ('10', '25', Decimal('11.00'), Decimal('12.50'), self.user),
+        )
+        for drug, price in ((unchanged, '12.00'), (other_tier, '26.00')):
+            drug.refresh_from_db()
+            self.assertEqual(drug.price, Decimal(price))
+
+    def test_ids_limit_the_run(self):
+        selected = self.drug('10.00', price='0.00')
+        other = self.drug('10.00', price='0.00')
+
+        RepricingService.reprice('ncap', ids=[selected.pk])
+
+        selected.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual((selected.price, other.price), (Decimal('11.00'), Decimal('0.00')))
@@ -0,0 +1,60 @@
+"""
+Incremental rollup maintenance must leave the same rows as a rebuild.
+"""
+from decimal import Decimal
+
+from django.test import TestCase
+
+from pharmacy.models import User, Form, FormItem, DailySalesRollup, DailyDrugSalesRollup
+from pharmacy.services import SalesRollupService
+
+
+def rollup_rows():
+    by_text = lambda row: tuple(str(value) for value in row)
+    return (
+        sorted(DailySalesRollup.objects.values_list(
+            'day', 'drug_type', 'dispensed_by', 'form_count', 'line_count', 'quantity', 'revenue'), key=by_text),
+        sorted(DailyDrugSalesRollup.objects.values_list(
+            'day', 'drug_type', 'drug_name', 'line_count', 'quantity', 'revenue'), key=by_text),
+    )
+
+
+class SalesRollupTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(mobile='08000000001', username='counter', password='pass')
+
+    def add_item(self, form, name, drug_type, quantity, price):
+        return FormItem.objects.create(
+            form=form, drug_name=name, drug_type=drug_type, unit='Tab',
+            quantity=quantity, price=price, subtotal=quantity * price,
+        )
+
+    def test_checkout_and_edits_match_rebuild(self):
+        # A form whose dispenser was deleted has a NULL key part
+        for dispensed_by in (self.user, None):
+            form = Form.objects.create(buyer_name='patient', total_amount=0, dispensed_by=dispensed_by)
+            item = self.add_item(form, 'A', 'ncap', 2, Decimal('1.50'))
+            self.add_item(form, 'B', 'ONCOLOGY', 1, Decimal('2.25'))
+            SalesRollupService.apply_form(form)
+
+            rollup = SalesRollupService.snapshot(form)
+            item.quantity, item.subtotal = 5, Decimal('7.50')
+            item.save()
+            SalesRollupService.apply_form(form, rollup)
+
+            rollup = SalesRollupService.snapshot(form)
+            FormItem.objects.filter(form=form, drug_name='B').delete()
+            SalesRollupService.apply_form(form, rollup)
+
+        incremental = rollup_rows()
+        SalesRollupService.rebuild()
+        self.assertEqual(incremental, rollup_rows())
+        self.assertFalse(DailyDrugSalesRollup.objects.filter(drug_name='B').exists())
+
+    def test_first_sales_of_a_key_share_one_row(self):
+        for _ in range(2):
+            form = Form.objects.create(buyer_name='patient', total_amount=0, dispensed_by=self.user)
+            self.add_item(form, 'A', 'NCAP', 1, Decimal('4.00'))
+            SalesRollupService.apply_form(form)
+        rollup = DailySalesRollup.objects.get()
+        self.assertEqual((rollup.form_count, rollup.quantity, rollup.revenue), (2, 2, Decimal('8.00')))
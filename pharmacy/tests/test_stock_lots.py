@@ -0,0 +1,193 @@
+"""
+Lot-based stock: FEFO allocation, releases back to the same lots, cart
+quantity edits, reconciliation after direct and admin edits and inventory
+imports.
+"""
+from datetime import timedelta
+from decimal import Decimal
+
+from django.contrib import admin
+from django.forms.models import model_to_dict
+from django.test import RequestFactory, TestCase
+from django.urls import reverse
+from django.utils import timezone
+
+from pharmacy.admin import NcapDrugsAdmin
+from pharmacy.models import User, NcapDrugs, Cart, StockLot
+from pharmacy.services import DrugService, InventoryImportService, StockLotService
+
+
+class StockLotTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(mobile='08000000001', username='counter', password='pass')
+        self.today = timezone.now().date()
+        self.drug = NcapDrugs.objects.create(
+            name='Paracetamol', brand='brand', unit='Tab', dosage_form='Tablet',
+            cost=Decimal('10.00'), markup='10', stock=0, exp_date=self.today + timedelta(days=90),
+        )
+
+    def add_lot(self, days, quantity):
+        exp_date = self.today + timedelta(days=days) if days is not None else None
+        return StockLotService.receive('ncap', self.drug.pk, quantity, exp_date=exp_date)
+
+    def quantities(self, *lots):
+        return [StockLot.objects.get(pk=lot.pk).quantity for lot in lots]
+
+    def stock(self):
+        self.drug.refresh_from_db()
+        return self.drug.stock
+
+    def cart_line(self):
+        return Cart.objects.get(user=self.user, form__isnull=True, ncap_drug=self.drug)
+
+    def assert_line_consistent(self, line):
+        self.assertEqual(sum(line.lot_allocations.values()), line.quantity)
+
+    def test_sales_take_earliest_expiry_first(self):
+        undated, late, early = self.add_lot(None, 5), self.add_lot(60, 5), self.add_lot(30, 5)
+        success, _, _ = DrugService.add_to_cart(self.user, 'ncap', self.drug.pk, 7)
+        self.assertTrue(success)
+        self.assertEqual(self.quantities(early, late, undated), [0, 3, 5])
+        self.assertEqual(self.cart_line().lot_allocations, {str(early.pk): 5, str(late.pk): 2})
+        self.assertEqual(self.stock(), 8)
+
+    def test_expired_lots_are_not_sold(self):
+        expired, fresh = self.add_lot(-1, 10), self.add_lot(30, 3)
+        self.assertTrue(DrugService.add_to_cart(self.user, 'ncap', self.drug.pk, 3)[0])
+        success, message, _ = DrugService.add_to_cart(self.user, 'ncap', self.drug.pk, 1)
+        self.assertFalse(success)
+        # The drug's expiry is its earliest lot still holding stock
+        self.assertEqual(message, 'Item has expired')
+        self.assertEqual(self.quantities(expired, fresh), [10, 0])
+
+    def test_removing_a_line_returns_stock_to_its_lots(self):
+        early, late = self.add_lot(30, 5), self.add_lot(60, 5)
+        DrugService.add_to_cart(self.user, 'ncap', self.drug.pk, 7)
+        # A delivery to the early lot's date meanwhile must not absorb the return
+        newer = StockLotService.receive('ncap', self.drug.pk, 4, exp_date=early.exp_date, lot_number='B2')
+        self.assertEqual(DrugService.remove_from_cart(self.user, 'ncap', self.drug.pk), 7)
+        self.assertEqual(self.quantities(early, late, newer), [5, 5, 4])
+        self.assertEqual(self.stock(), 14)
+        self.assertFalse(Cart.objects.exists())
+
+    def test_cart_quantity_edits_move_only_the_difference(self):
+        early, late = self.add_lot(30, 5), self.add_lot(60, 5)
+        self.client.force_login(self.user)
+        DrugService.add_to_cart(self.user, 'ncap', self.drug.pk, 4)
+        path = reverse('store:update_cart', args=[self.cart_line().pk])
+
+        self.client.post(path, {'quantity': 7})
+        line = self.cart_line()
+        self.assertEqual((line.quantity, self.quantities(early, late)), (7, [0, 3]))
+        self.assert_line_consistent(line)
+
+        # Units go back to the latest-expiring lot first
+        self.client.post(path, {'quantity': 3})
+        line = self.cart_line()
+        self.assertEqual((line.quantity, self.quantities(early, late)), (3, [2, 5]))
+        self.assertEqual(line.lot_allocations, {str(early.pk): 3})
+        self.assertEqual(line.subtotal, line.price * 3)
+        self.assertEqual(self.stock(), 7)
+
+        self.client.post(path, {'quantity': 20})
+        self.assertEqual(self.cart_line().quantity, 3)
+
+        self.client.post(path, {'quantity': 0})
+        self.assertFalse(Cart.objects.exists())
+        self.assertEqual((self.quantities(early, late), self.stock()), ([5, 5], 10))
+
+    def test_sync_after_direct_edits_and_counts(self):
+        early, late = self.add_lot(30, 5), self.add_lot(60, 5)
+
+        # Counted 4 more than the lots hold: added at the drug's (earliest) expiry
+        NcapDrugs.objects.filter(pk=self.drug.pk).update(stock=14)
+        StockLotService.sync('ncap', self.drug)
+        self.assertEqual(self.quantities(early, late), [9, 5])
+
+        # Counted 7 fewer: taken from the earliest-expiring lots
+        NcapDrugs.objects.filter(pk=self.drug.pk).update(stock=7)
+        StockLotService.sync('ncap', self.drug)
+        self.assertEqual(self.quantities(early, late), [2, 5])
+
+        # The expiry date was edited: lots on the old date move with it
+        new_exp = self.today + timedelta(days=120)
+        NcapDrugs.objects.filter(pk=self.drug.pk).update(exp_date=new_exp)
+        StockLotService.sync('ncap', self.drug, previous_exp_date=early.exp_date)
+        self.assertEqual(StockLot.objects.get(pk=early.pk).exp_date, new_exp)
+        self.assertEqual(self.drug.exp_date, late.exp_date)
+        self.assertEqual(self.stock(), 7)
+
+    def test_import_delivery_creates_lots_and_count_reconciles(self):
+        early = self.add_lot(30, 5)
+        exp = (self.today + timedelta(days=200)).isoformat()
+        InventoryImportService.import_csv([
+            'category,name,brand,unit,cost,stock,exp_date',
+            f'ncap,Paracetamol,brand,Tab,10.00,6,{exp}',
+            f'ncap,Ibuprofen,,Tab,5.00,3,{exp}',
+        ])
+        delivered = StockLot.objects.get(ncap_drug=self.drug, exp_date=exp)
+        self.assertEqual((delivered.quantity, self.stock()), (6, 11))
+        # The drug's expiry is the earliest still in stock
+        self.assertEqual(self.drug.exp_date, early.exp_date)
+        ibuprofen = NcapDrugs.objects.get(name='Ibuprofen')
+        self.assertEqual(list(StockLot.objects.filter(ncap_drug=ibuprofen).values_list('quantity', flat=True)), [3])
+
+        InventoryImportService.import_csv([
+            'category,name,brand,unit,cost,stock,exp_date',
+            f'ncap,Paracetamol,brand,Tab,10.00,4,{exp}',
+        ], replace_stock=True)
+        self.assertEqual(self.stock(), 4)
+        self.assertEqual(sum(StockLot.objects.filter(ncap_drug=self.drug).values_list('quantity', flat=True)), 4)
+
+    def test_sale_during_import_is_kept(self):
+        self.add_lot(30, 10)
+        other = NcapDrugs.objects.create(
+            name='Ibuprofen', unit='Tab', dosage_form='Tablet', cost=Decimal('5.00'), markup='10', stock=0,
+        )
+        exp = (self.today + timedelta(days=200)).isoformat()
+
+        def sell(summary):
+            # Between the first chunk and the one delivering Paracetamol
+            if summary['processed'] == 1:
+                self.assertTrue(DrugService.add_to_cart(self.user, 'ncap', self.drug.pk, 4)[0])
+
+        InventoryImportService.import_csv([
+            'category,name,brand,unit,cost,stock,exp_date',
+            f'ncap,Ibuprofen,,Tab,5.00,3,{exp}',
+            f'ncap,Paracetamol,brand,Tab,10.00,6,{exp}',
+        ], chunk_size=1, progress=sell)
+        self.assertEqual(self.stock(), 12)
+        self.assertEqual(sum(StockLot.objects.filter(ncap_drug=self.drug).values_list('quantity', flat=True)), 12)
+        other.refresh_from_db()
+        self.assertEqual(other.stock, 3)
+
+    def admin_edit(self, **changes):
+        model_admin = NcapDrugsAdmin(NcapDrugs, admin.site)
+        request = RequestFactory().post('/')
+        request.user = self.admin_user
+        drug = NcapDrugs.objects.get(pk=self.drug.pk)
+        data = {key: value for key, value in model_to_dict(drug).items() if value is not None}
+        form = model_admin.get_form(request, drug, change=True)({**data, **changes}, instance=drug)
+        self.assertTrue(form.is_valid(), form.errors)
+        model_admin.save_model(request, model_admin.save_form(request, form, change=True), form, change=True)
+
+    def lot_total(self):
+        return sum(StockLot.objects.filter(ncap_drug=self.drug).values_list('quantity', flat=True))
+
+    def test_admin_edits_reach_the_lots(self):
+        self.admin_user = User.objects.create_superuser(mobile='08000000009', username='admin', password='pass')
+        early, late = self.add_lot(30, 5), self.add_lot(60, 5)
+
+        self.admin_edit(stock=14)
+        self.assertEqual((self.stock(), self.lot_total()), (14, 14))
+
+        self.admin_edit(stock=3)
+        self.assertEqual((self.stock(), self.lot_total()), (3, 3))
+        # Taken from the earliest-expiring lots first
+        self.assertEqual(self.quantities(early, late), [0, 3])
+
+        # Moving the expiry moves the lots on the old date with it
+        new_exp = self.today + timedelta(days=120)
+        self.admin_edit(exp_date=new_exp)
+        self.assertEqual(StockLot.objects.get(pk=late.pk).exp_date, new_exp)
+        self.assertEqual(self.lot_total(), 3)
@@ -0,0 +1,42 @@
+"""
+The admin user list's prefix search matches case-insensitively and is
+answered from the LOWER(username) and mobile indexes.
+"""
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from pharmacy.models import User
+
+
+class UserSearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_user(mobile='08000000000', username='admin', password='pass')
+        cls.admin.profile.user_type = 'Admin'
+        cls.admin.profile.save()
+        User.objects.create_user(mobile='08011111111', username='Amaka', password='pass')
+        User.objects.create_user(mobile='07022222222', username='bola', password='pass')
+
+    def search(self, query):
+        self.client.force_login(self.admin)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('store:admin_users_list'), {'q': query})
+        usernames = sorted(user.username for user in response.context['page_obj'])
+        return usernames, queries
+
+    def test_prefix_matches(self):
+        self.assertEqual(self.search('am')[0], ['Amaka'])
+        self.assertEqual(self.search('AD')[0], ['admin'])
+        self.assertEqual(self.search('070')[0], ['bola'])
+        self.assertEqual(self.search('mak')[0], [])
+
+    def test_search_uses_the_indexes(self):
+        _, queries = self.search('am')
+        sql = next(query['sql'] for query in queries if 'LOWER' in query['sql'] and 'LIMIT' in query['sql'])
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+            plan = ' '.join(row[-1] for row in cursor.fetchall())
+        self.assertIn('user_username_lower_idx', plan)
+        self.assertNotIn('SCAN pharmacy_user', plan)
@@ -0,0 +1,29 @@
+"""
+The cached staff statistics survive logins but not changes to users.
+"""
+from django.core.cache import cache
+from django.test import TestCase
+
+from pharmacy.models import User, USER_STATS_CACHE_KEY
+from pharmacy.services import DashboardService
+
+
+class UserStatsCacheTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(mobile='08000000001', username='counter', password='pass')
+        cache.delete(USER_STATS_CACHE_KEY)
+        DashboardService.user_stats()
+
+    def test_login_keeps_the_cache(self):
+        self.assertTrue(self.client.login(mobile='08000000001', password='pass'))
+        self.assertIsNotNone(cache.get(USER_STATS_CACHE_KEY))
+
+    def test_user_change_drops_the_cache(self):
+        self.user.profile.user_type = 'Pharmacist'
+        self.user.profile.save()
+        self.assertIsNone(cache.get(USER_STATS_CACHE_KEY))
+
+        DashboardService.user_stats()
+        self.user.is_staff = True
+        self.user.save()
+        self.assertIsNone(cache.get(USER_STATS_CACHE_KEY))
@@ -13,6 +13,7 @@ urlpatterns = [
     path('receipt/<str:receipt_id>/', views.receipt_detail, name='receipt_detail'),
     path('logout/', views.logout_user, name='logout_user'),
     path('add-item/', views.add_item, name='add_item'),
+    path('import-inventory/', views.import_inventory, name='import_inventory'),
     path('edit-item/<str:drug_type>/<int:pk>/', views.edit_item, name='edit_item'),
     path('delete-item/<str:drug_type>/<int:pk>/', views.delete_item, name='delete_item'),
 
@@ -32,6 +33,11 @@ urlpatterns = [
     path('register/', views.register_user, name='register'),
     path('profile/', views.profile, name='profile'),
     path('forms/', views.form_list, name='forms'),
+    path('export/forms/', views.export_forms, name='export_forms'),
+    path('export/form-items/', views.export_form_items, name='export_form_items'),
+    path('export/inventory/', views.export_inventory, name='export_inventory'),
+    path('export/<int:job_id>/', views.export_status, name='export_status'),
+    path('export/<int:job_id>/download/', views.export_download, name='export_download'),
     path('forms/<str:form_id>/', views.view_form, name='view_form'),
     path('forms/<str:form_id>/edit/', views.edit_form, name='edit_form'),
     path('forms/<str:form_id>/items/add/', views.add_form_item, name='add_form_item'),
@@ -39,6 +45,8 @@ urlpatterns = [
     path('forms/<str:form_id>/items/<int:item_id>/remove/', views.remove_form_item, name='remove_form_item'),
     path('search-items/', views.search_items, name='search_items'),
     path('get-category-drugs/', views.get_category_drugs, name='get_category_drugs'),
+    path('analytics/', views.sales_analytics, name='sales_analytics'),
+    path('reports/expiring/', views.expiry_report, name='expiry_report'),
 
     # Admin User & Permission Management URLs
     path('admin/', views.admin_dashboard, name='admin_dashboard'),
@@ -68,4 +76,6 @@ urlpatterns = [
     
     # API endpoints
     path('api/extend-session/', views.extend_session, name='extend_session'),
+    path('api/offline-sync/', views.offline_sync, name='offline_sync'),
+    path('api/catalog/<str:category>/changes/', views.catalog_changes, name='catalog_changes'),
 ]
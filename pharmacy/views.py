@@ -1,9 +1,12 @@
 from django.db import transaction
 from collections import defaultdict
+import io
+import hashlib
 from decimal import Decimal
 import json
 from django.views.decorators.csrf import csrf_exempt
-from django.http import HttpResponse, JsonResponse
+from django.http import FileResponse, HttpResponse, JsonResponse, Http404
+from django.utils.cache import get_conditional_response, patch_cache_control
 from django.shortcuts import get_object_or_404, render, redirect
 from django.urls import reverse
 from django.forms import formset_factory
@@ -14,6 +17,8 @@ from .models import (
     Cart,
     Form,
     FormItem,
+    DailySalesRollup,
+    Job,
     DOSAGE_FORM,
     UNIT,
     Profile
@@ -24,17 +29,25 @@ from django.db import transaction
 from datetime import datetime, timedelta
 from django.utils import timezone
 from django.views.decorators.http import require_POST
-from django.db.models import Q, F, ExpressionWrapper, Sum, DecimalField
+from django.db.models import Q, F, Count, ExpressionWrapper, Sum, DecimalField
+from django.core.paginator import Paginator
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.contrib.auth import authenticate, login, logout, update_session_auth_hash
-from django.db.models.functions import TruncDay
+from django.db.models.functions import Lower, TruncDay
 from shortuuid.django_fields import ShortUUIDField
 from .forms import UserRegistrationForm
 from django.contrib.auth.forms import PasswordChangeForm
 from .forms import UserProfileForm, ProfileForm, CustomPasswordChangeForm, EditFormForm, FormItemForm
 from .forms import UserPermissionForm, UserManageForm, GroupManageForm, UserCategoryFilterForm, AdminPasswordChangeForm, UserSelfPasswordChangeForm, ModelCategoryFilterForm, ModelNameEditForm
 
-from .services import DrugService
+from .services import DrugService, FormService, ExpiryForecastService, StockLotService, SalesRollupService, SalesAnalyticsService, DashboardService, ReceiptService, InventoryImportService, InventoryImportError, OfflineIngestService, OfflineIngestError, CatalogSyncService, JobQueueService, ExportService
+from .pagination import keyset_page
+from . import exports
+from .db import reporting_reads, reporting_view, stock_atomic
+
+FORMS_PAGE_SIZE = 25
+USERS_PAGE_SIZE = 50
+RECEIPTS_PAGE_SIZE = 25
 
 # Create your views here.
 def is_admin(user):
@@ -111,49 +124,36 @@ def logout_user(request):
 @login_required
 def dashboard(request):
     
-    # Count items in each category
-    lpacemaker_count = LpacemakerDrugs.objects.count()
-    ncap_count = NcapDrugs.objects.count()
-    oncology_count = OncologyPharmacy.objects.count()
-    
-    # Count cart items for current user
-    cart_count = Cart.objects.filter(user=request.user).count()
+    # Catalog and cart counts in one query
+    counts = DashboardService.counts(request.user)
     
     # Recent forms
-    recent_forms = Form.objects.all().order_by('-date')[:5]
+    recent_forms = DashboardService.recent_forms()
     
-    # User statistics (for staff/superusers)
+    # User statistics (for staff/superusers), cached between visits
     user_stats = {}
     if request.user.is_staff or request.user.is_superuser:
-        from django.contrib.auth.models import Group
-        
-        # User counts by category
-        admin_users = User.objects.filter(profile__user_type='Admin').count()
-        pharmacist_users = User.objects.filter(profile__user_type='Pharmacist').count()
-        tech_users = User.objects.filter(profile__user_type='Pharm-Tech').count()
-        total_users = User.objects.count()
-        active_staff = User.objects.filter(is_staff=True, is_active=True).count()
-        
-        user_stats = {
-            'admin_users': admin_users,
-            'pharmacist_users': pharmacist_users,
-            'tech_users': tech_users,
-            'total_users': total_users,
-            'active_staff': active_staff,
-            'total_groups': Group.objects.count(),
-        }
+        user_stats = DashboardService.user_stats()
     
     context = {
-        'lpacemaker_count': lpacemaker_count,
-        'ncap_count': ncap_count,
-        'oncology_count': oncology_count,
-        'cart_count': cart_count,
+        **counts,
         'recent_forms': recent_forms,
         'user_stats': user_stats,
     }
     
     return render(request, 'store/dashboard.html', context)
 
+def _stock_valuation(queryset):
+    """Item count and stock value of a drug queryset, in one aggregate"""
+    stats = queryset.order_by().aggregate(
+        total_items=Count('id'),
+        total_stock_value=Sum(
+            ExpressionWrapper(F('price') * F('stock'), output_field=DecimalField(max_digits=20, decimal_places=2))
+        ),
+    )
+    stats['total_stock_value'] = Decimal(stats['total_stock_value'] or 0).quantize(Decimal('0.01'))
+    return stats
+
 @login_required
 def store(request):
     
@@ -161,25 +161,26 @@ def store(request):
     ncap = NcapDrugs.objects.all().order_by('name')
     oncology = OncologyPharmacy.objects.all().order_by('name')
     
-    # Calculate statistics for each category
+    # Calculate statistics for each category. Everything here reads the
+    # primary: the totals must agree with the live lists beside them
     lpacemaker_stats = {
-        'total_items': lpacemaker.count(),
-        'total_stock_value': sum(item.price * item.stock for item in lpacemaker),
+        **_stock_valuation(lpacemaker),
         'low_stock_items': [item for item in lpacemaker if item.stock < 10]
     }
     
     ncap_stats = {
-        'total_items': ncap.count(),
-        'total_stock_value': sum(item.price * item.stock for item in ncap),
+        **_stock_valuation(ncap),
         'low_stock_items': [item for item in ncap if item.stock < 10]
     }
     
     oncology_stats = {
-        'total_items': oncology.count(),
-        'total_stock_value': sum(item.price * item.stock for item in oncology),
+        **_stock_valuation(oncology),
         'low_stock_items': [item for item in oncology if item.stock < 10]
     }
     
+    # Expiring-soon badges from the daily forecast
+    expiring_window, expiring_counts = ExpiryForecastService.badge_counts()
+    
     context = {
         'lpacemaker': lpacemaker,
         'ncap': ncap,
@@ -187,6 +188,8 @@ def store(request):
         'lpacemaker_stats': lpacemaker_stats,
         'ncap_stats': ncap_stats,
         'oncology_stats': oncology_stats,
+        'expiring_window': expiring_window,
+        'expiring_counts': expiring_counts,
     }
     
     return render(request, 'store/store.html', context)
@@ -207,7 +210,7 @@ def add_item(request):
         exp_date = request.POST.get('exp_date')
         
         if category == 'lpacemaker':
-            LpacemakerDrugs.objects.create(
+            drug = LpacemakerDrugs.objects.create(
                 name=name,
                 dosage_form=dosage_form,
                 brand=brand,
@@ -219,7 +222,7 @@ def add_item(request):
                 exp_date=exp_date
             )
         elif category == 'ncap':
-            NcapDrugs.objects.create(
+            drug = NcapDrugs.objects.create(
                 name=name,
                 dosage_form=dosage_form,
                 brand=brand,
@@ -231,7 +234,7 @@ def add_item(request):
                 exp_date=exp_date
             )
         elif category == 'oncology':
-            OncologyPharmacy.objects.create(
+            drug = OncologyPharmacy.objects.create(
                 name=name,
                 dosage_form=dosage_form,
                 brand=brand,
@@ -243,6 +246,10 @@ def add_item(request):
                 exp_date=exp_date
             )
         
+        # Opening stock becomes the item's first lot
+        if category in ('lpacemaker', 'ncap', 'oncology'):
+            StockLotService.sync(category, drug)
+        
         messages.success(request, 'Item added successfully!')
         return redirect('store:store')
     
@@ -252,6 +259,40 @@ def add_item(request):
         'markup_choices': [('5', '5%'), ('10', '10%'), ('15', '15%'), ('20', '20%'), ('25', '25%'), ('30', '30%'), ('35', '35%'), ('40', '40%'), ('45', '45%'), ('50', '50%'), ('55', '55%'), ('60', '60%'), ('65', '65%'), ('70', '70%'), ('75', '75%'), ('80', '80%'), ('85', '85%'), ('90', '90%'), ('100', '100%')]
     })
 
+@login_required
+@superuser_or_staff_required
+def import_inventory(request):
+    """Bulk stock intake from an uploaded CSV file"""
+    summary = None
+    
+    if request.method == 'POST':
+        upload = request.FILES.get('file')
+        if not upload:
+            messages.error(request, 'Choose a CSV file to import.')
+            return redirect('store:import_inventory')
+        
+        # Decode the upload lazily so large files are parsed chunk by chunk
+        lines = io.TextIOWrapper(upload.file, encoding='utf-8-sig', newline='')
+        try:
+            summary = InventoryImportService.import_csv(
+                lines, replace_stock=request.POST.get('replace_stock') == 'on'
+            )
+        except (InventoryImportError, UnicodeDecodeError) as e:
+            messages.error(request, f'Import failed: {e}')
+            return redirect('store:import_inventory')
+        
+        messages.success(
+            request,
+            f"Imported {summary['created']} new and {summary['updated']} existing item(s).",
+        )
+        if summary['errors']:
+            messages.warning(request, f"{len(summary['errors'])} row(s) were skipped.")
+    
+    return render(request, 'store/import_inventory.html', {
+        'summary': summary,
+        'columns': ['category', 'name', 'brand', 'dosage_form', 'unit', 'cost', 'markup', 'stock', 'exp_date'],
+    })
+
 @login_required
 def edit_item(request, drug_type, pk):
     
@@ -269,9 +310,13 @@ def edit_item(request, drug_type, pk):
         return redirect('store:store')
     
     if request.method == 'POST':
+        previous_exp_date = item.exp_date
         form = form_class(request.POST, instance=item)
         if form.is_valid():
-            form.save()
+            with stock_atomic(drug_type):
+                drug = form.save()
+                # Carry stock and expiry edits through to the lots
+                StockLotService.sync(drug_type, drug, previous_exp_date)
             messages.success(request, 'Item updated successfully!')
             return redirect('store:store')
     else:
@@ -359,10 +404,10 @@ def cart(request):
     from decimal import Decimal
     
     # Get all cart items that are not yet part of a form (pending cart)
-    cart_items = Cart.objects.filter(
+    cart_items = DrugService.with_drugs(Cart.objects.filter(
         user=request.user, 
         form__isnull=True
-    ).order_by('-created_at')
+    )).order_by('-created_at')
     
     # Calculate total
     total = sum(item.subtotal for item in cart_items)
@@ -380,7 +425,7 @@ def update_cart(request, pk):
     
     # Handle database cart for authenticated users
     try:
-        cart_item = Cart.objects.get(pk=pk, user=request.user)
+        cart_item = Cart.objects.get(pk=pk, user=request.user, form__isnull=True)
         
         # Handle form data from POST or query param from GET
         if request.method == 'POST':
@@ -388,44 +433,12 @@ def update_cart(request, pk):
         else:
             quantity = int(request.GET.get('quantity', 1))
         
-        # Get the related drug
-        drug = cart_item.get_item
-        
-        if quantity <= 0:
-            cart_item.delete()
-            messages.success(request, 'Item removed from cart')
-            return redirect('store:cart')
-        
-        # Check stock availability
-        current_cart_items = Cart.objects.filter(
-            user=request.user, 
-            form__isnull=True
-        ).exclude(pk=pk)
-        
-        # Calculate what stock would be left after this update
-        # Use the drug type to filter correctly
-        drug_type = cart_item.get_drug_type()
-        if drug_type == 'lpacemaker':
-            same_drug_other_carts = current_cart_items.filter(lpacemaker_drug=drug)
-        elif drug_type == 'ncap':
-            same_drug_other_carts = current_cart_items.filter(ncap_drug=drug)
-        elif drug_type == 'oncology':
-            same_drug_other_carts = current_cart_items.filter(oncology_drug=drug)
+        # Take or give back only the difference, lot by lot
+        success, message = DrugService.update_cart_quantity(cart_item, quantity)
+        if success:
+            messages.success(request, message)
         else:
-            same_drug_other_carts = current_cart_items.none()
-        
-        total_in_carts = sum(item.quantity for item in same_drug_other_carts)
-        
-        if drug.stock + cart_item.quantity < quantity + total_in_carts:
-            messages.error(request, 'Insufficient stock')
-            return redirect('store:cart')
-        
-        # Update quantity and recalculate subtotal
-        cart_item.quantity = quantity
-        cart_item.subtotal = cart_item.calculate_subtotal
-        cart_item.save()
-        
-        messages.success(request, 'Cart updated successfully')
+            messages.error(request, message)
         return redirect('store:cart')
         
     except Cart.DoesNotExist:
@@ -439,14 +452,9 @@ def remove_from_cart(request, pk):
     # Handle database cart for authenticated users
     try:
         cart_item = Cart.objects.get(pk=pk, user=request.user)
-        drug = cart_item.get_item
-        
-        # Restore stock
-        if drug:
-            drug.stock += cart_item.quantity
-            drug.save()
         
-        cart_item.delete()
+        # Restore stock to the lots it was taken from
+        DrugService.discard_cart_lines([cart_item])
         
         messages.success(request, 'Item removed from cart')
         return redirect('store:cart')
@@ -459,14 +467,8 @@ def clear_cart(request):
     # Handle database cart for authenticated users
     cart_items = Cart.objects.filter(user=request.user, form__isnull=True)
     
-    # Restore stock for all items
-    for item in cart_items:
-        drug = item.get_item
-        if drug:
-            drug.stock += item.quantity
-            drug.save()
-    
-    cart_items.delete()
+    # Restore stock for all items to the lots it was taken from
+    DrugService.discard_cart_lines(cart_items)
     messages.success(request, 'Cart cleared successfully!')
     return redirect('store:cart')
 
@@ -477,7 +479,9 @@ def dispense(request):
     form = dispenseForm()
     
     # Get cart items
-    cart_items = Cart.objects.filter(user=request.user, form__isnull=True)
+    cart_items = Cart.objects.filter(user=request.user, form__isnull=True).select_related(
+        'lpacemaker_drug', 'ncap_drug', 'oncology_drug'
+    )
     total = sum(item.subtotal for item in cart_items)
     
     # Handle search functionality
@@ -587,39 +591,16 @@ def dispense(request):
             return render(request, 'store/dispense.html', context)
         
         try:
-            with transaction.atomic():
-                # Create form
-                buyer_name = request.POST.get('buyer_name')
-                hospital_no = request.POST.get('hospital_no')
-                ncap_no = request.POST.get('ncap_no')
-                
-                form_record = Form.objects.create(
-                    buyer_name=buyer_name,
-                    hospital_no=hospital_no,
-                    ncap_no=ncap_no,
-                    total_amount=total,
-                    dispensed_by=request.user
-                )
-                
-                # Move cart items to form items
-                for cart_item in cart_items:
-                    drug = cart_item.get_item
-                    
-                    FormItem.objects.create(
-                        form=form_record,
-                        drug_name=drug.name,
-                        drug_brand=drug.brand if hasattr(drug, 'brand') else None,
-                        drug_type=cart_item.get_drug_type().upper(),
-                        dosage_form=drug.dosage_form if hasattr(drug, 'dosage_form') else None,
-                        unit=cart_item.unit,
-                        quantity=cart_item.quantity,
-                        price=cart_item.price,
-                        subtotal=cart_item.subtotal
-                    )
-                    
-                    # Link cart item to form
-                    cart_item.form = form_record
-                    cart_item.save()
+            form_record = DrugService.checkout(
+                request.user,
+                request.POST.get('buyer_name'),
+                request.POST.get('hospital_no'),
+                request.POST.get('ncap_no'),
+            )
+            
+            # The worker renders the receipt once and reprints are served from
+            # the stored copy; opening it first renders it on demand
+            JobQueueService.enqueue('render_receipt', {'form_id': form_record.pk})
             
             messages.success(request, f'Dispensing successful! Form ID: {form_record.form_id}')
             return redirect('store:receipt')
@@ -631,26 +612,59 @@ def dispense(request):
     
     return render(request, 'store/dispense.html', context)
 
+def _receipt_date_range(request):
+    """
+    Parse the receipts ?start=/?end= dates (YYYY-MM-DD) into an aware
+    [start, end) datetime range; invalid or missing dates are ignored.
+    """
+    bounds = []
+    for param, offset in (('start', 0), ('end', 1)):
+        value = request.GET.get(param, '').strip()
+        try:
+            day = datetime.strptime(value, '%Y-%m-%d') + timedelta(days=offset) if value else None
+        except ValueError:
+            day = None
+        bounds.append(timezone.make_aware(day) if day else None)
+    return bounds
+
 @login_required
 def receipt(request):
     
-    # Get all forms (receipts)
-    forms = Form.objects.all().order_by('-date')
+    # Receipts newest first, filtered on the indexed date column
+    forms = Form.objects.select_related('dispensed_by')
+    range_start, range_end = _receipt_date_range(request)
+    if range_start:
+        forms = forms.filter(date__gte=range_start)
+    if range_end:
+        forms = forms.filter(date__lt=range_end)
     
-    return render(request, 'store/receipt.html', {'forms': forms})
+    cursor = request.GET.get('cursor')
+    page = keyset_page(forms, cursor, field='date', page_size=RECEIPTS_PAGE_SIZE)
+    
+    context = {
+        'page': page,
+        'start': request.GET.get('start', ''),
+        'end': request.GET.get('end', ''),
+    }
+    
+    # HTMX "load more" requests only need the next rows
+    if request.headers.get('HX-Request') == 'true' and cursor:
+        return render(request, 'partials/receipt_rows.html', context)
+    
+    return render(request, 'store/receipts.html', context)
 
 @login_required
 def receipt_detail(request, receipt_id):
     
-    form = get_object_or_404(Form, form_id=receipt_id)
-    form_items = FormItem.objects.filter(form=form)
-    
-    context = {
-        'form': form,
-        'form_items': form_items,
-    }
+    # Serve the stored receipt bytes; ?variant=print opens the print dialog
+    document = ReceiptService.get_document(receipt_id, request.GET.get('variant', 'html'))
+    if document is None:
+        raise Http404('Receipt not found')
     
-    return render(request, 'store/receipt_detail.html', context)
+    response = HttpResponse(bytes(document.body), content_type='text/html; charset=utf-8')
+    response['ETag'] = f'"{document.content_hash}"'
+    patch_cache_control(response, private=True, no_cache=True)
+    return get_conditional_response(request, etag=response['ETag'], response=response)
 
 @login_required
 def search_item(request):
@@ -910,88 +924,145 @@ def profile(request):
     
     return render(request, 'store/profile.html', context)
 
+def _filter_forms(request):
+    """
+    Apply the forms list search and date filters from the query string.
+    Returns (forms, search_query, filter_type, today_start, period_start).
+    """
+    return FormService.search(request.GET)
+
 @login_required
 def form_list(request):
     
-    # Import necessary function for aggregation
-    from django.db.models import Sum
-    from datetime import timedelta
-    from django.utils import timezone
-    
-    # Get filter parameters from request
-    search_query = request.GET.get('q', '').strip()
-    filter_type = request.GET.get('filter', 'all')
-    
-    # Base queryset
-    forms = Form.objects.all().order_by('-date')
-    
-    # Apply search filter
-    if search_query:
-        from django.db.models import Q
-        forms = forms.filter(
-            Q(form_id__icontains=search_query) | 
-            Q(buyer_name__icontains=search_query) | 
-            Q(hospital_no__icontains=search_query) |
-            Q(ncap_no__icontains=search_query)
-        )
+    from django.db.models import Count
     
-    # Apply date filters
-    today = timezone.now().date()
-    if filter_type == 'today':
-        forms = forms.filter(date__date=today)
-    elif filter_type == 'week':
-        week_ago = today - timedelta(days=7)
-        forms = forms.filter(date__gte=week_ago)
-    elif filter_type == 'month':
-        month_ago = today - timedelta(days=30)
-        forms = forms.filter(date__gte=month_ago)
+    cursor = request.GET.get('cursor')
+    forms, search_query, filter_type, today_start, period_start = _filter_forms(request)
     
-    # Calculate statistics for the dashboard cards
-    total_forms = forms.count()
-    total_revenue = forms.aggregate(total=Sum('total_amount'))['total'] or 0
+    page = keyset_page(forms.select_related('dispensed_by'), cursor, field='date', page_size=FORMS_PAGE_SIZE)
     
-    # Get today's forms count
-    today_forms_count = forms.filter(date__date=today).count() if filter_type != 'today' else total_forms
+    # HTMX "load more" requests only need the next rows
+    is_htmx = request.headers.get('HX-Request') == 'true'
+    if is_htmx and cursor:
+        return render(request, 'partials/form_rows.html', {
+            'page': page,
+            'search_query': search_query,
+            'filter_type': filter_type,
+            'first_page': False,
+        })
     
-    # Get monthly total (current month)
-    first_day_of_month = today.replace(day=1)
-    monthly_total = forms.filter(date__gte=first_day_of_month).aggregate(total=Sum('total_amount'))['total'] or 0
+    month_start = today_start.replace(day=1)
+    # The card statistics may come from the reporting snapshot; the list
+    # itself stays on the primary so a new form shows up at once
+    with reporting_reads():
+        if search_query:
+            # All card statistics in a single conditional aggregate over the same filter
+            stats = forms.aggregate(
+                total_forms=Count('id'),
+                total_revenue=Sum('total_amount'),
+                today_forms_count=Count('id', filter=Q(date__gte=today_start)),
+                monthly_total=Sum('total_amount', filter=Q(date__gte=month_start)),
+            )
+        else:
+            # Without a text search, revenue comes from the daily rollup table and
+            # only the cheap indexed counts touch Form
+            stats = forms.aggregate(
+                total_forms=Count('id'),
+                today_forms_count=Count('id', filter=Q(date__gte=today_start)),
+            )
+            rollups = DailySalesRollup.objects.all()
+            if period_start:
+                rollups = rollups.filter(day__gte=period_start.date())
+            stats.update(rollups.aggregate(
+                total_revenue=Sum('revenue'),
+                monthly_total=Sum('revenue', filter=Q(day__gte=month_start.date())),
+            ))
     
     # Get cart count for quick actions
     cart_count = Cart.objects.filter(user=request.user, form__isnull=True).count() if request.user.is_authenticated else 0
     
     context = {
-        'forms': forms,
+        'page': page,
+        'first_page': not cursor,
         'search_query': search_query,
         'filter_type': filter_type,
-        'total_revenue': total_revenue,
-        'today_forms_count': today_forms_count,
-        'monthly_total': monthly_total,
+        'total_forms': stats['total_forms'],
+        'total_revenue': stats['total_revenue'] or 0,
+        'today_forms_count': stats['today_forms_count'],
+        'monthly_total': stats['monthly_total'] or 0,
         'cart_count': cart_count,
     }
     return render(request, 'store/forms.html', context)
 
+def _export_format(request):
+    """Requested export format, or None if XLSX was asked for but is unavailable"""
+    export_format = request.GET.get('format', 'csv')
+    if export_format == 'xlsx' and not exports.xlsx_available():
+        return None
+    return 'xlsx' if export_format == 'xlsx' else 'csv'
+
+def _queue_export(request, export, back):
+    """Queue the export job and send the user to its page; `back` is where an unavailable format returns to"""
+    export_format = _export_format(request)
+    if export_format is None:
+        messages.error(request, 'XLSX export is not available on this server.')
+        return redirect(back)
+    job = ExportService.enqueue(export, export_format, request.GET, request.user)
+    return redirect('store:export_status', job_id=job.pk)
+
+@login_required
+def export_forms(request):
+    """Export forms matching the forms list filters as CSV or XLSX"""
+    return _queue_export(request, 'forms', 'store:forms')
+
+@login_required
+def export_form_items(request):
+    """Export the items of forms matching the forms list filters as CSV or XLSX"""
+    return _queue_export(request, 'form_items', 'store:forms')
+
+@login_required
+def export_inventory(request):
+    """Export the stock of all three drug categories as CSV or XLSX"""
+    return _queue_export(request, 'inventory', 'store:store')
+
+def _export_job(request, job_id):
+    """The export job `job_id`, if it was queued by the user (or the user is an admin)"""
+    job = get_object_or_404(Job, pk=job_id, name='export')
+    if job.payload.get('user_id') != request.user.pk and not request.user.is_superuser:
+        raise Http404('No such export')
+    return job
+
+@login_required
+def export_status(request, job_id):
+    """Progress of an export; HTMX polls the status card until the file is ready"""
+    job = _export_job(request, job_id)
+    context = {
+        'job': job,
+        'title': ExportService.EXPORTS[job.payload['export']][1],
+        'ready': ExportService.download(job) is not None,
+        'pending': job.status in ('QUEUED', 'RUNNING'),
+    }
+    if request.headers.get('HX-Request') == 'true':
+        return render(request, 'partials/export_status.html', context)
+    return render(request, 'store/export_status.html', context)
+
+@login_required
+def export_download(request, job_id):
+    """The file of a finished export"""
+    job = _export_job(request, job_id)
+    path = ExportService.download(job)
+    if path is None:
+        raise Http404('This export is not ready')
+    return FileResponse(open(path, 'rb'), as_attachment=True, filename=job.payload['filename'])
+
 @login_required
 def view_form(request, form_id):
     
-    form = get_object_or_404(Form, form_id=form_id)
+    form = get_object_or_404(Form.objects.select_related('dispensed_by'), form_id=form_id)
     items = FormItem.objects.filter(form=form)
     
-    # Calculate category totals
-    category_totals = {
-        'LPACEMAKER': sum(item.subtotal for item in items if item.drug_type.upper() == 'LPACEMAKER'),
-        'NCAP': sum(item.subtotal for item in items if item.drug_type.upper() == 'NCAP'),
-        'ONCOLOGY': sum(item.subtotal for item in items if item.drug_type.upper() == 'ONCOLOGY'),
-    }
-    
-    context = {
-        'form': form,
-        'items': items,
-        'category_totals': category_totals,
-        'total_amount': form.total_amount,
-    }
-    
-    return render(request, 'store/form_detail.html', context)
+    # Category totals are stored on the form; items are only listed
+    return render(request, 'store/form_detail.html', ReceiptService.context(form, items))
 
 @login_required
 def edit_form(request, form_id):
@@ -1001,7 +1072,9 @@ def edit_form(request, form_id):
     if request.method == 'POST':
         form = EditFormForm(request.POST, instance=form_obj)
         if form.is_valid():
-            form.save()
+            with transaction.atomic():
+                form.save()
+                ReceiptService.invalidate(form_obj)
             messages.success(request, 'Form updated successfully!')
             return redirect('store:view_form', form_id=form_id)
     else:
@@ -1017,13 +1090,19 @@ def add_form_item(request, form_id):
     if request.method == 'POST':
         form = FormItemForm(request.POST)
         if form.is_valid():
-            form_item = form.save(commit=False)
-            form_item.form = form_obj
-            form_item.save()
-            
-            # Update form total
-            form_obj.total_amount = sum(item.subtotal for item in FormItem.objects.filter(form=form_obj))
-            form_obj.save()
+            with transaction.atomic():
+                rollup = SalesRollupService.snapshot(form_obj)
+                
+                form_item = form.save(commit=False)
+                form_item.form = form_obj
+                form_item.subtotal = form_item.quantity * form_item.price
+                form_item.save()
+                
+                # Recompute form totals in the database
+                FormService.refresh_totals(form_obj)
+                
+                SalesRollupService.apply_form(form_obj, rollup)
+                ReceiptService.invalidate(form_obj)
             
             messages.success(request, 'Form item added successfully!')
             return redirect('store:view_form', form_id=form_id)
@@ -1036,16 +1115,23 @@ def add_form_item(request, form_id):
 def edit_form_item(request, form_id, item_id):
     
     form_obj = get_object_or_404(Form, form_id=form_id)
-    form_item = get_object_or_404(FormItem, id=item_id)
+    form_item = get_object_or_404(FormItem, id=item_id, form=form_obj)
     
     if request.method == 'POST':
         form = FormItemForm(request.POST, instance=form_item)
         if form.is_valid():
-            form.save()
-            
-            # Update form total
-            form_obj.total_amount = sum(item.subtotal for item in FormItem.objects.filter(form=form_obj))
-            form_obj.save()
+            with transaction.atomic():
+                rollup = SalesRollupService.snapshot(form_obj)
+                
+                form_item = form.save(commit=False)
+                form_item.subtotal = form_item.quantity * form_item.price
+                form_item.save()
+                
+                # Recompute form totals in the database
+                FormService.refresh_totals(form_obj)
+                
+                SalesRollupService.apply_form(form_obj, rollup)
+                ReceiptService.invalidate(form_obj)
             
             messages.success(request, 'Form item updated successfully!')
             return redirect('store:view_form', form_id=form_id)
@@ -1058,13 +1144,18 @@ def edit_form_item(request, form_id, item_id):
 def remove_form_item(request, form_id, item_id):
     
     form_obj = get_object_or_404(Form, form_id=form_id)
-    form_item = get_object_or_404(FormItem, id=item_id)
+    form_item = get_object_or_404(FormItem, id=item_id, form=form_obj)
     
-    form_item.delete()
-    
-    # Update form total
-    form_obj.total_amount = sum(item.subtotal for item in FormItem.objects.filter(form=form_obj))
-    form_obj.save()
+    with transaction.atomic():
+        rollup = SalesRollupService.snapshot(form_obj)
+        
+        form_item.delete()
+        
+        # Recompute form totals in the database
+        FormService.refresh_totals(form_obj)
+        
+        SalesRollupService.apply_form(form_obj, rollup)
+        ReceiptService.invalidate(form_obj)
     
     messages.success(request, 'Form item removed successfully!')
     return redirect('store:view_form', form_id=form_id)
@@ -1100,18 +1191,78 @@ def return_item(request, drug_type, pk):
     })
 
 
+@login_required
+@superuser_or_staff_required
+@reporting_view
+def expiry_report(request):
+    """Items expiring within the forecast windows, with stock value at risk"""
+    report = ExpiryForecastService.report()
+    windows = report['windows']
+    
+    try:
+        days = int(request.GET.get('days', windows[len(windows) // 2]))
+    except ValueError:
+        days = windows[len(windows) // 2]
+    if days not in windows:
+        days = windows[len(windows) // 2]
+    
+    context = {
+        'report': report,
+        'days': days,
+        'items': [item for item in report['items'] if item['days_left'] <= days],
+        'category_rows': [
+            (category, [totals[window] for window in windows])
+            for category, totals in report['categories'].items()
+        ],
+        'total_row': [report['totals'][window] for window in windows],
+    }
+    return render(request, 'store/expiry_report.html', context)
+
+@login_required
+@superuser_or_staff_required
+@reporting_view
+def sales_analytics(request):
+    """Revenue per category over time, top-selling drugs and pharmacist throughput"""
+    bucket = request.GET.get('bucket', 'day')
+    if bucket not in SalesAnalyticsService.BUCKETS:
+        bucket = 'day'
+    
+    report = SalesAnalyticsService.report(bucket)
+    
+    label_format = {'day': '%d %b', 'week': 'Wk %d %b', 'month': '%b %Y'}[bucket]
+    chart_data = {
+        'labels': [period.strftime(label_format) for period in report['periods']],
+        'datasets': [
+            {'label': category, 'data': [float(value) for value in values]}
+            for category, values in report['revenue_by_category'].items()
+        ],
+    }
+    
+    context = {
+        'report': report,
+        'bucket': bucket,
+        'buckets': [('day', 'Daily'), ('week', 'Weekly'), ('month', 'Monthly')],
+        'chart_data': chart_data,
+    }
+    return render(request, 'store/analytics.html', context)
+
+
 # ========== ADMIN USER & PERMISSION MANAGEMENT VIEWS ==========
 
+def _prefix_range(lookup, prefix):
+    """Q matching values of `lookup` that start with `prefix`, as a range an index can answer"""
+    following = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return Q(**{f'{lookup}__gte': prefix, f'{lookup}__lt': following})
+
+
 @login_required
 @user_passes_test(is_admin)
 def admin_users_list(request, category=None):
-    """Admin view to list all users with filtering and categories"""
-    # Get all users for stats
-    all_users = User.objects.all()
-    
+    """Admin view to list all users with filtering, search and categories"""
     # Handle filtering from GET params or URL parameter
     filter_category = request.GET.get('category', category or '')
     status = request.GET.get('status', 'all')
+    search_query = request.GET.get('q', '').strip()
     
     # Filter by category
     users = User.objects.all()
@@ -1126,25 +1277,34 @@ def admin_users_list(request, category=None):
     elif status == 'staff':
         users = users.filter(is_staff=True)
     
-    users = users.order_by('-date_joined')
+    # Prefix search as index ranges: LOWER(username) has an index of its
+    # own and mobile is unique. SQLite's LIKE (which istartswith and
+    # startswith both become) is case-insensitive and cannot use either.
+    if search_query:
+        users = users.alias(username_lower=Lower('username')).filter(
+            _prefix_range('username_lower', search_query.lower()) | _prefix_range('mobile', search_query)
+        )
     
-    # Calculate statistics
-    total_users = all_users.count()
-    user_stats = {}
+    users = users.select_related('profile').prefetch_related('groups', 'user_permissions').order_by('-date_joined', '-id')
     
+    paginator = Paginator(users, USERS_PAGE_SIZE)
+    page_obj = paginator.get_page(request.GET.get('page'))
+    
+    # Calculate statistics with a single grouped aggregate
+    category_totals = {
+        row['profile__user_type']: row
+        for row in User.objects.values('profile__user_type')
+        .annotate(count=Count('pk'), active=Count('pk', filter=Q(is_active=True)))
+        .order_by()
+    }
+    user_stats = {}
     for user_type in ['Admin', 'Pharmacist', 'Pharm-Tech']:
+        totals = category_totals.get(user_type, {})
         user_stats[user_type] = {
-            'count': all_users.filter(profile__user_type=user_type).count(),
-            'active': all_users.filter(profile__user_type=user_type, is_active=True).count(),
+            'count': totals.get('count', 0),
+            'active': totals.get('active', 0),
         }
-    
-    # Group users by category
-    users_by_category = {}
-    for user in users:
-        category_name = user.profile.user_type or 'Unassigned'
-        if category_name not in users_by_category:
-            users_by_category[category_name] = []
-        users_by_category[category_name].append(user)
+    total_users = sum(row['count'] for row in category_totals.values())
     
     # Initialize form
     filter_form = UserCategoryFilterForm(initial={
@@ -1152,14 +1312,20 @@ def admin_users_list(request, category=None):
         'status': status,
     })
     
+    # Current filters, carried over by the pagination links
+    query_params = request.GET.copy()
+    query_params.pop('page', None)
+    
     context = {
-        'users': users,
-        'users_by_category': users_by_category,
+        'users': page_obj,
+        'page_obj': page_obj,
         'filter_form': filter_form,
         'total_users': total_users,
         'user_stats': user_stats,
         'selected_category': filter_category,
         'selected_status': status,
+        'search_query': search_query,
+        'query_string': query_params.urlencode(),
     }
     return render(request, 'store/admin/users_list.html', context)
 
@@ -1272,7 +1438,7 @@ def admin_user_permissions(request, user_id):
         form = UserPermissionForm(instance=user)
     
     # Get user's current permissions for display
-    user_perms = user.user_permissions.all().order_by('content_type__model', 'codename')
+    user_perms = user.user_permissions.select_related('content_type').order_by('content_type__model', 'codename')
     user_groups = user.groups.all()
     
     return render(request, 'store/admin/user_permissions.html', {
@@ -1378,7 +1544,7 @@ def admin_group_view(request, group_id):
     from django.contrib.auth.models import Group
     
     group = get_object_or_404(Group, id=group_id)
-    group_permissions = group.permissions.all().order_by('content_type__model', 'codename')
+    group_permissions = group.permissions.select_related('content_type').order_by('content_type__model', 'codename')
     group_members = group.user_set.all().order_by('username')
     
     context = {
@@ -1401,7 +1567,7 @@ def admin_dashboard(request):
     superusers = User.objects.filter(is_superuser=True).count()
     total_groups = Group.objects.count()
     
-    recent_users = User.objects.order_by('-date_joined')[:5]
+    recent_users = User.objects.select_related('profile').order_by('-date_joined')[:5]
     
     context = {
         'total_users': total_users,
@@ -1582,8 +1748,8 @@ def admin_model_list(request, category):
     
     model = model_map[category]
     
-    # Get all drugs from the selected category
-    drugs = model.objects.all().order_by('name')
+    # Get all drugs from the selected category, with their expiry status
+    drugs = ExpiryForecastService.annotate_status(model.objects.all()).order_by('name')
     
     # Get total count
     total_count = drugs.count()
@@ -1681,3 +1847,44 @@ def extend_session(request):
     
     return JsonResponse({'success': False, 'error': 'Unauthorized'}, status=401)
 
+
+@login_required
+def offline_sync(request):
+    """
+    Accept a (gzip-compressed) JSON array of actions queued by an offline
+    counter. Items are stored for replay; re-sent items are ignored.
+    Counters send the CSRF token in the X-CSRFToken header.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'success': False, 'error': 'POST required'}, status=405)
+    
+    try:
+        items = OfflineIngestService.parse(request.body, request.headers.get('Content-Encoding', ''))
+    except OfflineIngestError as e:
+        return JsonResponse({'success': False, 'error': str(e)}, status=400)
+    
+    summary = OfflineIngestService.ingest(items, request.user, default_client=request.headers.get('X-Client-Id'))
+    return JsonResponse({'success': True, **summary})
+
+
+@login_required
+def catalog_changes(request, category):
+    """
+    Drugs in one store changed or deleted since ?cursor= (all of them without
+    one). Clients repeat with the returned cursor while has_more is true.
+    """
+    try:
+        limit = int(request.GET.get('limit', 0)) or None
+    except ValueError:
+        limit = None
+    
+    try:
+        changes = CatalogSyncService.changes(category, request.GET.get('cursor'), limit)
+    except ValueError:
+        raise Http404('Unknown category')
+    
+    # Unchanged pages are answered with 304 Not Modified
+    response = JsonResponse(changes)
+    response['ETag'] = f'"{hashlib.sha256(response.content).hexdigest()}"'
+    patch_cache_control(response, private=True, no_cache=True)
+    return get_conditional_response(request, etag=response['ETag'], response=response)